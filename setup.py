@@ -48,7 +48,8 @@ setup(
     scripts=['bin/submit_to_cluster',
              'bin/cfin_flash_bem',
              'bin/cfin_watershed_bem',
-             'bin/cfin_organize_dicom'],
+             'bin/cfin_organize_dicom',
+             'bin/cluster_batch'],
     long_description=read('README.md'),
     classifiers=[
         "Development Status :: 3 - Alpha",
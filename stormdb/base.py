@@ -11,6 +11,16 @@ import inspect
 from six import string_types
 
 
+def _exit_status(wait_status):
+    """Exit status of a process from its wait status (-N if killed by N)
+
+    Like os.waitstatus_to_exitcode, which needs Python 3.9.
+    """
+    if os.WIFSIGNALED(wait_status):
+        return -os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+
 def check_destination_exists(dest):
     return os.access(dest, os.F_OK)
 
@@ -35,6 +45,18 @@ def enforce_path_exists(test_dir):
                       '{0}'.format(test_dir))
 
 
+def _get_cache_dir():
+    """Return path to the stormdb cache directory (created if necessary)
+
+    Defaults to ~/.stormdb, override with the STORMDB_CACHE_DIR environment
+    variable.
+    """
+    cache_dir = os.environ.get('STORMDB_CACHE_DIR',
+                               os.path.expanduser('~/.stormdb'))
+    mkdir_p(cache_dir)
+    return cache_dir
+
+
 def parse_arguments(func):
     # argspec = inspect.getargspec(Raw.filter)
     argspec = inspect.getargspec(func)
@@ -9,14 +9,30 @@ Classes to process data in StormDB layout on Hyades cluster
 # License: MIT
 import os
 import sys
+import json
+import asyncio
+import functools
 import logging
 import subprocess as subp
 import re
 import math
+import signal
+import time
+import heapq
+import tempfile
+import threading
+import uuid
+import weakref
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from six import string_types
 from os.path import expanduser
+from getpass import getuser
 from .access import Query
-from .base import enforce_path_exists
+from .base import enforce_path_exists, _exit_status
+from .history import JobHistory
+from .incremental import DigestStore, is_up_to_date
 
 QSUB_SCHEMA = """
 #$ -S /bin/bash
@@ -47,6 +63,13 @@ echo "Done executing"
 class Cluster(object):
     """Class to represent the cluster itself, with diagnostic methods.
 
+    This is the default scheduler backend (Sun Grid Engine, as on hyades).
+    Other backends subclass it and override the methods used by `ClusterJob`
+    and `ClusterBatch`: `queues`, `get_memlimit_per_process`,
+    `_check_queue`, `_check_parallel_env`, `get_load_dict` and the private
+    `_threads_for_memory`, `_create_script`, `_submit`, `_submit_array`,
+    `_job_states` and `_kill`.
+
     Parameters
     ----------
     name : str
@@ -63,28 +86,45 @@ class Cluster(object):
     def __init__(self, name='hyades'):
         self.name = name
         self._highmem_qs = ['highmem.q']
-
-    def _query(self, cmd):
-        """Return list of outputs from a shell call"""
+        self._script_schema = QSUB_SCHEMA
+        self._supports_arrays = False
+        self._log_suffix = '.qsub'
+        self._queue_list = None  # queue names and configurations are cached
+        self._queue_confs = dict()
+
+    def _call(self, args):
+        """Return list of output lines from a command (no shell)"""
         try:
-            output = subp.check_output([cmd], stderr=subp.STDOUT, shell=True)
+            output = subp.check_output(args, stderr=subp.STDOUT, shell=False)
         except subp.CalledProcessError as cpe:
             raise RuntimeError('Command {:s} failed with error code {:d}, '
                                'output is:\n\n{:s}'.format(
-                                   cmd, cpe.returncode, cpe.output))
-        # NB the decode-step here is important: in Py3, check_output
-        # returns a byte-string! This is tested to work on Py2
-        output = output.decode('ascii', 'ignore')
-        # first strip whitespace (incl. \n), then split on newline
-        return (output.rstrip().split('\n'))
+                                   ' '.join(args), cpe.returncode,
+                                   cpe.output.decode('ascii', 'ignore')))
+        except OSError as err:  # e.g., the command is not installed
+            raise RuntimeError('Command {:s} could not be run: {}'.format(
+                args[0], err))
+        output = output.decode('ascii', 'ignore').rstrip()
+        return output.split('\n') if len(output) > 0 else []
 
     @property
     def queues(self):
-        return (self._query('qconf -sql'))
+        if self._queue_list is None:
+            self._queue_list = self._call(['qconf', '-sql'])
+        return list(self._queue_list)
 
     @property
     def parallel_envs(self):
-        return (self._query('qconf -spl'))
+        return (self._call(['qconf', '-spl']))
+
+    def _queue_conf(self, queue):
+        """Return the configuration of a queue as a dict (from qconf)"""
+        if queue not in self._queue_confs:
+            if queue not in self.queues:
+                raise ValueError('Unknown queue: {:s}'.format(queue))
+            self._queue_confs[queue] = _parse_qconf(
+                self._call(['qconf', '-sq', queue]))
+        return self._queue_confs[queue]
 
     def get_memlimit_per_process(self, queue):
         """Get value of h_vmem (memory limit/process) for specified queue.
@@ -100,44 +140,888 @@ class Cluster(object):
             A string defining the memory limit per process for jobs in the
             queue. The format is in the style "8G".
         """
-        if queue not in self.queues:
-            raise ValueError('Unknown queue: {:s}'.format(queue))
+        # the default limit, not those of specific hosts ("8G,[node1=16G]")
+        lim = self._queue_conf(queue)['h_vmem'].split(',')[0]
 
-        lim = self._query('qconf -sq ' + queue +
-                          '| grep h_vmem | awk {\'print $2\'}')[0]
-
-        _, lim_int, lim_units = re.split('(\d+)', lim)
+        _, lim_int, lim_units = re.split(r'(\d+)', lim)
         assert isinstance(int(lim_int), int)
         assert isinstance(lim_units, string_types)
 
         return (lim)
 
+    def _check_queue(self, queue):
+        """Check that a queue exists on the cluster"""
+        if queue not in self.queues:
+            raise ValueError('Unknown queue ({0})!'.format(queue))
+
     def _check_parallel_env(self, queue, pe_name):
         """Check that a PE is in the pe_list for a given queue"""
-        pes = self._query('qconf -sq ' + queue +
-                          '| grep pe_list')[0]  # just one line
-        pe_list = pes.split()[1:]
+        pe_list = re.split(r'[\s,\[\]=]+',
+                           self._queue_conf(queue).get('pe_list', ''))
         if pe_name not in pe_list:
             raise ValueError('Queue \'{0}\' does not support the \'{1}\' '
                              'parallel environment.'.format(queue, pe_name))
 
     def get_load_dict(self):
         '''Return list of queue load dictionaries'''
-        # throw away header lines and \n
-        loads = self._query('qstat -g c')[2:-1]
+        loads = _parse_qstat_summary(self._call(['qstat', '-g', 'c']))
+        return [dict(name=q.name, load=q.load, used=str(q.used),
+                     avail=str(q.avail), total=str(q.total)) for q in loads]
+
+    def _queue_loads(self):
+        """Return a dict of the (free, total) slots of each queue"""
+        return dict((load['name'], (int(load['avail']), int(load['total'])))
+                    for load in self.get_load_dict())
+
+    def _select_queues(self, requests, queues):
+        """Choose a queue for each of many jobs, based on the current load
+
+        Parameters
+        ----------
+        requests : list of tuple
+            The (n_threads, total_memory) of each job, see `ClusterJob`.
+        queues : list of str
+            The queues to choose from, in order of preference.
+
+        Returns
+        -------
+        selected : list of str
+            The queue for each job: the one with the most free slots (left
+            after the jobs before it) among those that can run the job, or if
+            none has enough free slots, the one with the fewest waiting slots
+            per slot in the queue.
+        """
+        loads = self._queue_loads()
+        free = dict((queue, loads.get(queue, (0, 0))[0]) for queue in queues)
+        size = dict((queue, loads.get(queue, (0, 0))[1]) for queue in queues)
+        memlimits, threaded = dict(), dict()
+
+        def _slots(queue, n_threads, total_memory):
+            # slots needed by the job in the queue, None if it cannot run
+            if queue not in memlimits:
+                try:
+                    self._check_queue(queue)
+                    memlimits[queue] = self.get_memlimit_per_process(queue)
+                except ValueError:
+                    memlimits[queue] = None
+            if memlimits[queue] is None:
+                return None
+            if total_memory is not None:
+                n_threads = self._threads_for_memory(total_memory,
+                                                     memlimits[queue])
+            if n_threads > 1:
+                if queue not in threaded:
+                    try:
+                        self._check_parallel_env(queue, 'threaded')
+                        threaded[queue] = True
+                    except ValueError:
+                        threaded[queue] = False
+                if not threaded[queue]:
+                    return None
+            if size[queue] > 0 and n_threads > size[queue]:
+                return None
+            return n_threads
+
+        selected = []
+        for n_threads, total_memory in requests:
+            options = [(queue, _slots(queue, n_threads, total_memory))
+                       for queue in queues]
+            options = [(queue, slots) for queue, slots in options
+                       if slots is not None]
+            if len(options) == 0:
+                raise ValueError('None of the queues {0} can run a job with '
+                                 '{1} threads and {2} memory.'.format(
+                                     queues, n_threads,
+                                     total_memory or 'default'))
+            queue, slots = min(options, key=lambda option: (
+                (0, -free[option[0]]) if free[option[0]] >= option[1] else
+                (1, float(option[1] - free[option[0]]) /
+                 max(size[option[0]], 1))))
+            free[queue] -= slots
+            selected.append(queue)
+        return selected
+
+    def _threads_for_memory(self, total_memory, memlimit):
+        """Number of slots needed for total_memory, given memory per slot"""
+        # XXX would be nice with some sanity checking here...
+        _, totmem, totmem_unit = re.split(r'(\d+)', total_memory)
+        _, memlim, memlim_unit = re.split(r'(\d+)', memlimit)
+
+        if totmem_unit != memlim_unit:
+            units = dict(k=1e3, m=1e6, g=1e9, t=1e12)
+            try:
+                ratio = units[totmem_unit.lower()] /\
+                            units[memlim_unit.lower()]
+            except KeyError:
+                raise ValueError('Something is wrong with the memory units'
+                                 ', likely {:s}'.format(total_memory))
+        else:
+            ratio = 1.
+
+        return int(math.ceil(ratio * float(totmem) / float(memlim)))
+
+    def _create_script(self, job):
+        """Return the submission script for a (configured) ClusterJob"""
+        cwd_flag = ''
+        if job.working_dir is not None:
+            if job._use_cwd:
+                cwd_flag = '#$ -cwd'
+            else:
+                cwd_flag = '#$ -wd {:s}'.format(job.working_dir)
+        opt_threaded_flag = ''
+        if job.n_threads > 1:
+            opt_threaded_flag = "#$ -pe threaded {:d}".format(job.n_threads)
+        # NB this has to be explicitly set, see Issue #53
+        opt_h_vmem_flag = "#$ -l h_vmem={:s}".format(job._h_vmem)
+
+        return self._script_schema.format(
+            opt_threaded_flag=opt_threaded_flag,
+            opt_h_vmem_flag=opt_h_vmem_flag, cwd_flag=cwd_flag,
+            queue=job.queue, log_name_prefix=job._log_name_prefix,
+            exec_cmd=job.cmd, job_name=job.job_name)
+
+    def _submit(self, sh_file, job, dependencies=()):
+        """Submit a job script, return the job ID (str)
+
+        NB: jobs are held until the dependencies have finished, regardless
+        of their exit status (qsub -hold_jid).
+        """
+        hold_flag = []
+        if len(dependencies) > 0:
+            hold_flag = ['-hold_jid', ','.join(dependencies)]
+        try:
+            output = self._call(['qsub'] + hold_flag + [sh_file])
+        except RuntimeError as err:
+            raise RuntimeError('qsub submission failed: {0}'.format(err))
+        m = re.search(r'(\d+)', '\n'.join(output))
+        if m is None:
+            raise RuntimeError('qsub returned no job ID, output is:\n\n'
+                               '{0}'.format('\n'.join(output)))
+        return m.group(1)
+
+    def _submit_array(self, jobs):
+        """Submit jobs as one array job, return list of job (task) IDs"""
+        raise NotImplementedError('Job arrays are not supported on the {0} '
+                                  'cluster.'.format(self.name))
+
+    def _job_states(self, jobids):
+        """Return dict of (state, queue@host)-tuples of queued/running jobs
+
+        Jobs that are no longer known to the scheduler are not included.
+        """
+        jobids = set(jobids)
+        output = self._call(['qstat', '-xml', '-u', getuser()])
+        return dict((job.jobid, (job.state, job.queue_host))
+                    for job in _parse_qstat_xml('\n'.join(output))
+                    if job.jobid in jobids)
+
+    def _accounting(self, jobids, since=None):
+        """Return dict of accounting records of finished jobs (from qacct)
+
+        Jobs without an accounting record (yet) are not included. For more
+        than one job, a single call to qacct lists all jobs of the user
+        started after `since` (a time.time()-timestamp), and the records of
+        the requested jobs are picked from it.
+        """
+        if len(jobids) == 0:
+            return dict()
+        elif len(jobids) == 1:
+            args = ['qacct', '-j', jobids[0]]
+        else:
+            args = ['qacct', '-o', getuser()]
+            if since is not None:
+                args += ['-b', time.strftime('%Y%m%d%H%M',
+                                             time.localtime(since - 60))]
+            args += ['-j']
+        try:
+            output = self._call(args)
+        except RuntimeError:
+            return dict()  # accounting records not written (yet)
+        records = _parse_qacct(output)
+        return dict((jobid, records[jobid]) for jobid in jobids
+                    if jobid in records)
+
+    def _log_fname(self, job, jobid):
+        """Return the name of the log file of a job"""
+        working_dir = (job.working_dir if job.working_dir is not None
+                       else os.getcwd())
+        return os.path.join(working_dir, '{:s}_{:s}{:s}'.format(
+            job._log_name_prefix, jobid, self._log_suffix))
+
+    def _kill_ids(self, jobids, active):
+        """The IDs to kill jobids with, given all active jobs of the batch"""
+        return list(jobids)
+
+    def _kill(self, jobids):
+        """Kill (delete) jobs"""
+        self._call(['qdel'] + list(jobids))
+
+
+LOCAL_SCHEMA = """#!/bin/bash
+# Make sure process uses max requested number of threads!
+export NSLOTS={n_threads:d}
+export OMP_NUM_THREADS=$NSLOTS
+
+echo "Executing following command on $NSLOTS threads:"
+echo -e {exec_cmd:s}
+
+{exec_cmd:s}  # remember to escape quotes on command-liners!
+"""
+
+
+def _parse_memory(value):
+    """Convert a memory string (e.g. "1.5G", "300M" or "1024") to bytes"""
+    m = re.match(r'^\s*([\d.]+)\s*([kmgtp]?)i?b?\s*$', value, re.IGNORECASE)
+    if m is None:
+        raise ValueError('Cannot interpret memory value: {0}'.format(value))
+    return float(m.group(1)) * 1024 ** ' kmgtp'.index(m.group(2).lower()
+                                                      or ' ')
+
+
+def _format_memory(value):
+    """Convert bytes to a memory string (e.g. "12G"), rounding up"""
+    if value >= 1024 ** 3:
+        return '{:d}G'.format(int(math.ceil(value / 1024. ** 3)))
+    return '{:d}M'.format(int(math.ceil(value / 1024. ** 2)))
+
+
+def _parse_duration(value):
+    """Convert a duration (e.g. "61s", "61.5" or "1-02:03:04.5") to sec"""
+    value = value.strip().rstrip('s')
+    days = 0
+    if '-' in value:
+        days, value = value.split('-')
+    seconds = 0.
+    for part in value.split(':'):
+        seconds = 60. * seconds + float(part)
+    return 86400. * int(days) + seconds
+
+
+_QstatJob = namedtuple('_QstatJob', ['jobid', 'name', 'owner', 'state',
+                                     'queue_host', 'slots', 'tasks'])
+_QueueLoad = namedtuple('_QueueLoad', ['name', 'load', 'used', 'reserved',
+                                       'avail', 'total'])
+
+
+def _parse_qstat_xml(output):
+    """Parse the output of qstat -xml into a list of _QstatJob-records"""
+    jobs = []
+    for elem in ElementTree.fromstring(output).iter('job_list'):
+        jobs.append(_QstatJob(
+            jobid=elem.findtext('JB_job_number', ''),
+            name=elem.findtext('JB_name', ''),
+            owner=elem.findtext('JB_owner', ''),
+            state=elem.findtext('state', ''),
+            queue_host=elem.findtext('queue_name') or '',
+            slots=int(elem.findtext('slots', '1')),
+            tasks=elem.findtext('tasks')))
+    return jobs
+
+
+def _parse_qconf(output):
+    """Parse the output of qconf -sq (etc.) into a dict of values"""
+    conf = dict()
+    key = None
+    for line in output:
+        if key is not None and line[:1].isspace():  # continued value
+            conf[key] += ' ' + line.strip().rstrip('\\').strip()
+        elif len(line.split()) > 1:
+            key, value = line.split(None, 1)
+            conf[key] = value.strip().rstrip('\\').strip()
+        if not line.rstrip().endswith('\\'):
+            key = None
+    return conf
+
+
+def _parse_qstat_summary(output):
+    """Parse the output of qstat -g c into a list of _QueueLoad-records"""
+    loads = []
+    for line in output:
+        cols = line.split()
+        # skip the header lines
+        if len(cols) < 6 or not all(col.isdigit() for col in cols[2:6]):
+            continue
+        loads.append(_QueueLoad(name=cols[0], load=cols[1],
+                                used=int(cols[2]), reserved=int(cols[3]),
+                                avail=int(cols[4]), total=int(cols[5])))
+    return loads
+
+
+def _parse_qacct(output):
+    """Parse the output of qacct -j into a dict of records per job ID"""
+    records = dict()
+    fields = dict()
+    for line in output + ['=' * 10]:
+        if line.startswith('=' * 10):
+            if 'jobnumber' in fields:
+                jobid = fields['jobnumber']
+                if fields.get('taskid', 'undefined') != 'undefined':
+                    jobid += '_' + fields['taskid']
+                queue_host = '{0}@{1}'.format(fields.get('qname', ''),
+                                              fields.get('hostname', ''))
+                records[jobid] = dict(
+                    exit_status=int(fields['exit_status'].split()[0]),
+                    failed=int(fields.get('failed', '0').split()[0]),
+                    wallclock=_parse_duration(fields['ru_wallclock']),
+                    cpu=_parse_duration(fields['cpu']),
+                    maxvmem=_parse_memory(fields['maxvmem']),
+                    queue_host=queue_host)
+            fields = dict()
+        elif len(line.split()) > 1:
+            key, value = line.split(None, 1)
+            fields[key] = value.strip()
+    return records
+
+
+def _run_local_job(script, working_dir, log_fname, pid_fname):
+    """Execute a job script in a worker process of LocalCluster"""
+    start = time.time()
+    with open(log_fname, 'w') as log:
+        proc = subp.Popen(['bash', script], cwd=working_dir, stdout=log,
+                          stderr=subp.STDOUT, start_new_session=True)
+        with open(pid_fname, 'w') as fid:
+            fid.write(str(proc.pid))
+        # resource usage of the job and all the processes it waited for
+        _, wait_status, usage = os.wait4(proc.pid, 0)
+    return dict(exit_status=_exit_status(wait_status),
+                wallclock=time.time() - start,
+                cpu=usage.ru_utime + usage.ru_stime,
+                maxvmem=usage.ru_maxrss * 1024.)  # kilobytes on Linux
+
+
+class LocalCluster(Cluster):
+    """Run cluster jobs in a process pool on the current machine.
+
+    Jobs are run in the order they are submitted, as long as enough CPU
+    slots are free: a job occupies `n_threads` slots. Any queue name is
+    accepted (all queues map onto the local machine), so that batches built
+    for the cluster can be run unchanged.
+
+    Parameters
+    ----------
+    n_slots : int | None
+        Number of CPU slots to use. If None (default), all CPUs are used.
+    name : str
+        Name of the cluster (default: local)
+
+    Attributes
+    ----------
+    n_slots : int
+        The total number of CPU slots.
+    """
+
+    def __init__(self, n_slots=None, name='local'):
+        super(LocalCluster, self).__init__(name=name)
+        self._highmem_qs = []
+        self._script_schema = LOCAL_SCHEMA
+        self._log_suffix = '.log'
+        self.n_slots = n_slots if n_slots is not None else os.cpu_count()
+        self._executor = None
+        self._tmpdir = None
+        self._counter = 0
+        self._pending = []  # list of job dicts waiting for free slots
+        self._running = dict()  # jobid: job dict
+        self._finished = dict()  # jobid: result dict
+        self._free_slots = self.n_slots
+        self._cond = threading.Condition()
+
+    @property
+    def queues(self):
+        return ([self.name])
+
+    @property
+    def parallel_envs(self):
+        return (['threaded'])
+
+    def get_memlimit_per_process(self, queue):
+        """Get the memory per CPU slot on the local machine (e.g. "2000M")."""
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        return '{:d}M'.format(int(total / self.n_slots / 1024 ** 2))
+
+    def _check_queue(self, queue):
+        pass  # all queues run locally
+
+    def _check_parallel_env(self, queue, pe_name):
+        if pe_name not in self.parallel_envs:
+            raise ValueError('Local cluster does not support the \'{0}\' '
+                             'parallel environment.'.format(pe_name))
+
+    def get_load_dict(self):
+        '''Return list of queue load dictionaries'''
+        with self._cond:
+            used = self.n_slots - self._free_slots
+        return [dict(name=self.name, load='{:.2f}'.format(
+                     float(used) / self.n_slots), used=str(used),
+                     avail=str(self.n_slots - used),
+                     total=str(self.n_slots))]
+
+    def _create_script(self, job):
+        return self._script_schema.format(n_threads=job.n_threads,
+                                          exec_cmd=job.cmd)
+
+    def _start(self):
+        """Start the process pool and the dispatcher thread (once)"""
+        if self._executor is not None:
+            return
+        self._tmpdir = tempfile.mkdtemp(prefix='stormdb_local_')
+        self._executor = ProcessPoolExecutor(max_workers=self.n_slots)
+        dispatcher = threading.Thread(target=self._dispatch_loop)
+        dispatcher.daemon = True
+        dispatcher.start()
+
+    def _submit(self, sh_file, job, dependencies=()):
+        """Queue a job script, return the job ID (str)
+
+        Jobs with dependencies only start once all of them have finished
+        successfully; if one fails, the job is not run.
+        """
+        if job.n_threads > self.n_slots:
+            raise RuntimeError('Job requires {:d} slots, but only {:d} are '
+                               'available locally.'.format(job.n_threads,
+                                                           self.n_slots))
+        self._start()
+        with self._cond:
+            self._counter += 1
+            jobid = str(self._counter)
+            script = os.path.join(self._tmpdir, 'job_{:s}.sh'.format(jobid))
+            # copy the script, the original may be cleaned up right away
+            with open(sh_file, 'r') as fid_in, open(script, 'w') as fid_out:
+                fid_out.write(fid_in.read())
+            working_dir = (job.working_dir if job.working_dir is not None
+                           else os.getcwd())
+            log_fname = self._log_fname(job, jobid)
+            self._pending.append(dict(
+                jobid=jobid, slots=job.n_threads, queue=job.queue,
+                dependencies=list(dependencies),
+                args=(script, working_dir, log_fname,
+                      os.path.join(self._tmpdir, 'job_{:s}.pid'.format(
+                          jobid)))))
+            self._cond.notify_all()
+        return jobid
+
+    def _dispatch_loop(self):
+        """Move pending jobs to the process pool when slots become free"""
+        while True:
+            with self._cond:
+                n_failed = 0
+                for pending in list(self._pending):
+                    deps = [self._finished.get(dep, dict(exit_status=0))
+                            for dep in pending['dependencies']
+                            if dep not in self._pending_ids()]
+                    if len(deps) < len(pending['dependencies']):
+                        continue  # dependencies not finished yet
+                    if any(dep['exit_status'] != 0 for dep in deps):
+                        self._pending.remove(pending)
+                        self._finished[pending['jobid']] = dict(
+                            exit_status=None, error='Dependency failed')
+                        n_failed += 1
+                    elif pending['slots'] <= self._free_slots:
+                        self._pending.remove(pending)
+                        self._free_slots -= pending['slots']
+                        pending['future'] = self._executor.submit(
+                            _run_local_job, *pending['args'])
+                        self._running[pending['jobid']] = pending
+                        pending['future'].add_done_callback(
+                            lambda fut, jobid=pending['jobid']:
+                                self._job_done(jobid, fut))
+                if n_failed == 0:  # else check jobs depending on failed ones
+                    self._cond.wait()
+
+    def _pending_ids(self):
+        """IDs of jobs that have not finished yet (call with lock held)"""
+        return ([job['jobid'] for job in self._pending] +
+                list(self._running.keys()))
+
+    def _job_done(self, jobid, future):
+        with self._cond:
+            job = self._running.pop(jobid)
+            self._free_slots += job['slots']
+            if future.cancelled():
+                result = dict(exit_status=None)
+            elif future.exception() is not None:
+                result = dict(exit_status=None,
+                              error=str(future.exception()))
+            else:
+                result = future.result()
+            self._finished[jobid] = result
+            for fname in (job['args'][0], job['args'][3]):
+                if os.path.exists(fname):
+                    os.unlink(fname)
+            self._cond.notify_all()
+
+    def _job_states(self, jobids):
+        """Return dict of (state, queue@host)-tuples
+
+        Finished jobs are reported with the state 'z' (as in `qstat -s z`).
+        """
+        states = dict()
+        with self._cond:
+            for pending in self._pending:
+                states[pending['jobid']] = ('qw', '')
+            for jobid, job in self._running.items():
+                states[jobid] = ('r', '{:s}@{:s}'.format(job['queue'],
+                                                         self.name))
+            for jobid in self._finished:
+                states[jobid] = ('z', '')
+        return dict((jobid, states[jobid]) for jobid in jobids
+                    if jobid in states)
+
+    def _accounting(self, jobids, since=None):
+        """Return dict of accounting records of finished jobs
+
+        The exit status is None for jobs that were killed before they ran.
+        """
+        with self._cond:
+            records = dict((jobid, dict(self._finished[jobid]))
+                           for jobid in jobids if jobid in self._finished)
+        for record in records.values():
+            record.setdefault('queue_host', '')
+        return records
+
+    def _kill(self, jobids):
+        jobids = set(jobids)
+        with self._cond:
+            for pending in list(self._pending):
+                if pending['jobid'] in jobids:
+                    self._pending.remove(pending)
+                    self._finished[pending['jobid']] = dict(exit_status=None)
+            pid_fnames = [job['args'][3] for jobid, job in
+                          self._running.items() if jobid in jobids]
+        for pid_fname in pid_fnames:
+            try:
+                with open(pid_fname, 'r') as fid:
+                    os.killpg(int(fid.read()), signal.SIGTERM)
+            except (IOError, OSError, ValueError):
+                pass  # job finished in the meantime
+
+    def shutdown(self, wait=True):
+        """Shut down the process pool.
+
+        Parameters
+        ----------
+        wait : bool
+            If True (default), wait for all running jobs to finish. Jobs that
+            are still waiting for free slots are not run.
+        """
+        with self._cond:
+            self._pending = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+SBATCH_SCHEMA = """#!/bin/bash
+#SBATCH --job-name={job_name:s}
+#SBATCH --output={log_name_prefix:s}_{log_suffix:s}.slurm
+#SBATCH --partition={partition:s}
+#SBATCH --cpus-per-task={n_threads:d}
+{opt_mem_flag:s}
+{opt_array_flag:s}
+{cwd_flag:s}
+# Pass on all environment variables
+#SBATCH --export=ALL
+
+# Make sure process uses max requested number of threads!
+export NSLOTS=$SLURM_CPUS_PER_TASK
+export OMP_NUM_THREADS=$NSLOTS
+
+{exec_block:s}
+echo "Done executing"
+"""
+
+EXEC_SCHEMA = """echo "Executing following command on $NSLOTS threads:"
+echo -e {exec_cmd:s}
+
+{exec_cmd:s}  # remember to escape quotes on command-liners!
+"""
+
+# squeue compact state codes mapped onto their qstat-equivalents
+SLURM_STATES = dict(PD='qw', R='r', CG='r', CF='qw')
+# sacct states of jobs that have not finished
+SLURM_ACTIVE = ('PENDING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED',
+                'CONFIGURING', 'COMPLETING')
+
+
+class SlurmCluster(Cluster):
+    """Class to represent a SLURM cluster.
+
+    Jobs are submitted with sbatch, monitored with squeue and killed with
+    scancel. The queue names used by the processing classes (such as
+    'short.q' or 'maxfilter.q') are mapped onto partitions, the number of
+    threads onto --cpus-per-task, and the total memory onto --mem.
+
+    Parameters
+    ----------
+    queue_map : dict | None
+        Mapping from queue names to SLURM partitions, e.g.,
+        ``dict(short.q='short', long.q='long')``. Partition names can always
+        be used directly as queue names.
+    name : str
+        Name of the cluster (default: slurm)
+    """
+
+    def __init__(self, queue_map=None, name='slurm'):
+        super(SlurmCluster, self).__init__(name=name)
+        self._highmem_qs = []
+        self._script_schema = SBATCH_SCHEMA
+        self._supports_arrays = True
+        self._log_suffix = '.slurm'
+        self.queue_map = dict() if queue_map is None else dict(queue_map)
+
+    @property
+    def partitions(self):
+        """List of partitions defined on the cluster."""
+        # the default partition is marked with an asterisk
+        if self._queue_list is None:
+            self._queue_list = [p.rstrip('*') for p in
+                                self._call(['sinfo', '-h', '-o', '%P'])]
+        return list(self._queue_list)
+
+    @property
+    def queues(self):
+        return (list(self.queue_map.keys()) + self.partitions)
+
+    @property
+    def parallel_envs(self):
+        return (['threaded'])
+
+    def _partition(self, queue):
+        return self.queue_map.get(queue, queue)
+
+    def _check_queue(self, queue):
+        if self._partition(queue) not in self.partitions:
+            raise ValueError('Unknown queue ({0})!'.format(queue))
+
+    def _check_parallel_env(self, queue, pe_name):
+        pass  # multi-threading is requested using --cpus-per-task
+
+    def get_memlimit_per_process(self, queue):
+        """Get the memory per CPU (e.g. "4000M") for the queue (partition).
+
+        The smallest memory per CPU of the nodes in the partition is used.
+        """
+        self._check_queue(queue)
+        partition = self._partition(queue)
+        if partition not in self._queue_confs:
+            nodes = self._call(['sinfo', '-h', '-p', partition,
+                                '-o', '%m %c'])
+            mem_per_cpu = min(int(node.split()[0].rstrip('+')) //
+                              int(node.split()[1].rstrip('+'))
+                              for node in nodes)
+            self._queue_confs[partition] = dict(
+                memlimit='{:d}M'.format(mem_per_cpu))
+        return self._queue_confs[partition]['memlimit']
+
+    def get_load_dict(self):
+        '''Return list of partition (queue) load dictionaries'''
         q_list = []
-        for q in loads:
-            qq = q.split()
+        for line in self._call(['sinfo', '-h', '-o', '%P %C']):
+            name, cpus = line.split()
+            alloc, idle, other, total = cpus.split('/')
             q_list += [
                 dict(
-                    name=qq[0],
-                    load=qq[1],
-                    used=qq[2],
-                    avail=qq[4],
-                    total=qq[5])
+                    name=name.rstrip('*'),
+                    load='{:.2f}'.format(float(alloc) / max(int(total), 1)),
+                    used=alloc,
+                    avail=idle,
+                    total=total)
             ]
         return (q_list)
 
+    def _queue_loads(self):
+        loads = super(SlurmCluster, self)._queue_loads()
+        for queue, partition in self.queue_map.items():
+            if partition in loads:
+                loads[queue] = loads[partition]
+        return loads
+
+    def _threads_for_memory(self, total_memory, memlimit):
+        return 1  # memory is requested independently of the CPUs
+
+    def _script_flags(self, job):
+        opt_mem_flag = '#SBATCH --mem-per-cpu={:s}'.format(job._h_vmem)
+        if job.total_memory is not None:
+            opt_mem_flag = '#SBATCH --mem={:s}'.format(job.total_memory)
+        return dict(job_name=job.job_name, n_threads=job.n_threads,
+                    partition=self._partition(job.queue),
+                    log_name_prefix=job._log_name_prefix,
+                    opt_mem_flag=opt_mem_flag)
+
+    def _create_script(self, job):
+        cwd_flag = ''
+        if job.working_dir is not None:
+            cwd_flag = '#SBATCH --chdir={:s}'.format(job.working_dir)
+        return self._script_schema.format(
+            log_suffix='%j', opt_array_flag='', cwd_flag=cwd_flag,
+            exec_block=EXEC_SCHEMA.format(exec_cmd=job.cmd),
+            **self._script_flags(job))
+
+    def _create_array_script(self, jobs):
+        """Script running each job as a task of an array job"""
+        exec_block = 'case $SLURM_ARRAY_TASK_ID in\n'
+        for itask, job in enumerate(jobs):
+            exec_block += '{:d})\n'.format(itask)
+            if job.working_dir is not None:
+                exec_block += 'cd {:s}\n'.format(job.working_dir)
+            exec_block += EXEC_SCHEMA.format(exec_cmd=job.cmd) + ';;\n'
+        exec_block += 'esac\n'
+        return self._script_schema.format(
+            log_suffix='%A_%a', cwd_flag='', exec_block=exec_block,
+            opt_array_flag='#SBATCH --array=0-{:d}'.format(len(jobs) - 1),
+            **self._script_flags(jobs[0]))
+
+    def _submit(self, sh_file, job, dependencies=()):
+        """Submit a job script, return the job ID (str)
+
+        Jobs with dependencies only start once all of them have finished
+        successfully (sbatch --dependency=afterok); if one fails, the job is
+        cancelled rather than left pending forever.
+        """
+        dep_flag = []
+        if len(dependencies) > 0:
+            dep_flag = ['--dependency=afterok:' + ':'.join(dependencies),
+                        '--kill-on-invalid-dep=yes']
+        try:
+            output = self._call(['sbatch', '--parsable'] + dep_flag +
+                                [sh_file])
+        except RuntimeError as err:
+            raise RuntimeError('sbatch submission failed: {0}'.format(err))
+        # output is "jobid" or "jobid;cluster"
+        return output[-1].split(';')[0].strip()
+
+    def _submit_array(self, jobs):
+        """Submit jobs as one array job, return list of job (task) IDs
+
+        All jobs must request the same resources.
+        """
+        resources = set((self._partition(job.queue), job.n_threads,
+                         job.total_memory, job._h_vmem) for job in jobs)
+        if len(resources) > 1:
+            raise ValueError('All jobs of an array must request the same '
+                             'resources.')
+        fd, sh_file = tempfile.mkstemp(
+            prefix='submit_{:s}_'.format(jobs[0].job_name), suffix='.sh',
+            dir=expanduser('~'))
+        with os.fdopen(fd, 'w') as bash_file:
+            bash_file.write(self._create_array_script(jobs))
+        try:
+            arrayid = self._submit(sh_file, jobs[0])
+        finally:
+            os.unlink(sh_file)
+        return ['{:s}_{:d}'.format(arrayid, itask)
+                for itask in range(len(jobs))]
+
+    def _job_states(self, jobids):
+        """Return dict of (state, queue@host)-tuples of queued/running jobs
+
+        Array tasks are listed individually (with IDs like "1234_5").
+        """
+        output = self._call(['squeue', '-h', '-r', '-u', getuser(),
+                             '-o', '%i %t %P %N'])
+        states = dict()
+        for line in output:
+            cols = line.split()
+            if len(cols) < 3 or cols[0] not in jobids:
+                continue
+            queue_host = ''
+            if len(cols) > 3:
+                queue_host = '{:s}@{:s}'.format(cols[2], cols[3])
+            states[cols[0]] = (SLURM_STATES.get(cols[1], cols[1]),
+                               queue_host)
+        return states
+
+    def _accounting(self, jobids, since=None):
+        """Return dict of accounting records of finished jobs (from sacct)
+
+        Jobs killed by a signal get the exit status 128 + signal number, and
+        jobs cancelled before they ran none (with an 'error'). The peak
+        memory use is the largest MaxRSS of the steps of the job.
+        """
+        if len(jobids) == 0:
+            return dict()
+        output = self._call(['sacct', '-n', '-P', '-j', ','.join(jobids),
+                             '-o', 'JobID,State,ExitCode,ElapsedRaw,TotalCPU,'
+                             'MaxRSS,Partition,NodeList'])
+        records = dict()
+        maxrss = dict()
+        for line in output:
+            (jobid, state, exit_code, elapsed, cpu, rss, partition,
+             nodes) = line.split('|')
+            jobid, _, step = jobid.partition('.')
+            if len(rss) > 0:
+                maxrss[jobid] = max(maxrss.get(jobid, 0.), _parse_memory(rss))
+            if (len(step) > 0 or jobid not in jobids or
+                    state.split()[0] in SLURM_ACTIVE):
+                continue
+            code, sig = exit_code.split(':')
+            records[jobid] = dict(
+                exit_status=int(code) if int(sig) == 0 else 128 + int(sig),
+                wallclock=float(elapsed), cpu=_parse_duration(cpu),
+                queue_host='{0}@{1}'.format(partition, nodes))
+            if (state.split()[0] == 'CANCELLED' and nodes == 'None assigned'
+                    and exit_code == '0:0'):
+                # e.g., a dependency failed (--kill-on-invalid-dep)
+                records[jobid].update(exit_status=None, wallclock=None,
+                                      error='Cancelled before it ran')
+        for jobid, record in records.items():
+            record['maxvmem'] = maxrss.get(jobid, 0.)
+        return records
+
+    def _kill_ids(self, jobids, active):
+        """The IDs to kill jobids with, given all active jobs of the batch
+
+        Array tasks are cancelled by the ID of the array, if all its active
+        tasks are to be killed.
+        """
+        tasks = dict()
+        for jobid in active:
+            arrayid, sep, _ = jobid.partition('_')
+            if len(sep) > 0:
+                tasks.setdefault(arrayid, set()).add(jobid)
+        jobids = set(jobids)
+        kill_ids = []
+        for arrayid, array_tasks in sorted(tasks.items()):
+            if array_tasks <= jobids:
+                kill_ids.append(arrayid)
+                jobids -= array_tasks
+        return kill_ids + sorted(jobids)
+
+    def _kill(self, jobids):
+        """Kill (cancel) jobs"""
+        self._call(['scancel'] + list(jobids))
+
+
+_CLUSTER_BACKENDS = dict(sge=Cluster, hyades=Cluster, local=LocalCluster,
+                         slurm=SlurmCluster)
+
+
+def get_cluster(cluster=None):
+    """Get a Cluster (scheduler backend) instance.
+
+    Parameters
+    ----------
+    cluster : str | instance of Cluster | None
+        A Cluster-instance is returned as-is. A string selects the backend
+        by name: 'sge' (or 'hyades'), 'slurm' or 'local'. If None
+        (default), the SGE-cluster hyades is used.
+
+    Returns
+    -------
+    cluster : instance of Cluster
+        The cluster to submit jobs to.
+    """
+    if cluster is None:
+        return Cluster()
+    elif isinstance(cluster, Cluster):
+        return cluster
+    elif isinstance(cluster, string_types):
+        try:
+            return _CLUSTER_BACKENDS[cluster.lower()]()
+        except KeyError:
+            raise ValueError('Unknown cluster backend: {0}, use one of: '
+                             '{1}'.format(cluster,
+                                          sorted(_CLUSTER_BACKENDS.keys())))
+    raise ValueError('cluster must be a string or a Cluster-instance.')
+
 
 class ClusterJob(object):
     """Class to represent a single job on the cluster.
@@ -149,8 +1033,10 @@ class ClusterJob(object):
     proj_name : str | None
         The name of the project. If None, will read MINDLABPROJ from
         environment.
-    queue : str
-        The name of the queue to submit the job to (default: 'short.q').
+    queue : str | list of str
+        The name of the queue to submit the job to (default: 'short.q'). If
+        a list, the queue with the most free slots is chosen among those that
+        can run the job (see also `ClusterBatch.distribute`).
     total_memory : str | None
         The amount of memory required for the job (format is in the style
         "50G"). NB: If this option is set, only single-threaded jobs are
@@ -169,6 +1055,21 @@ class ClusterJob(object):
         is used.
     cleanup : bool
         Delete qsub bash-script after submission (default: True)
+    cluster : str | instance of Cluster | None
+        The cluster (scheduler backend) to run the job on, see
+        `stormdb.cluster.get_cluster`. If None, the SGE-cluster is used.
+    depends_on : ClusterJob | str | list | None
+        Job(s) (or job IDs) that must finish before this job starts. Jobs
+        must be submitted before the jobs that depend on them.
+    inputs : list of str | None
+        The input files of the job. Their total size is used to estimate the
+        resources needed, see `suggest_resources`.
+    outputs : list of str | None
+        The output files of the job, used to skip jobs that are up to date
+        with their inputs, see `ClusterBatch.submit`.
+    subject : str | None
+        The subject whose data the job processes, used to select jobs (see
+        `ClusterBatch.kill`).
 
     Attributes
     ----------
@@ -183,6 +1084,13 @@ class ClusterJob(object):
     cmd : str
         The command (if several, separated by ';') to be submitted (cannot
         be modified once defined).
+    exit_status : int | None
+        Exit status of the finished job (None if unknown or not finished).
+    attempts : list of tuple
+        The (job ID, accounting record)-tuples of earlier, failed runs of the
+        job (see `RetryPolicy`).
+    subject : str | None
+        The subject whose data the job processes.
     """
 
     def __init__(self,
@@ -195,8 +1103,13 @@ class ClusterJob(object):
                  working_dir='cwd',
                  job_name=None,
                  log_dir=None,
-                 cleanup=True):
-        self.cluster = Cluster()
+                 cleanup=True,
+                 cluster=None,
+                 depends_on=None,
+                 inputs=None,
+                 outputs=None,
+                 subject=None):
+        self.cluster = get_cluster(cluster)
 
         if not cmd:
             raise (ValueError('You must specify the command to run!'))
@@ -205,16 +1118,17 @@ class ClusterJob(object):
         Query(proj_name)._check_login_credentials()
         self.proj_name = proj_name
 
-        if queue not in self.cluster.queues:
-            raise ValueError('Unknown queue ({0})!'.format(queue))
-
-        self.queue = queue
-        self.n_threads = n_threads
-        self.total_memory = total_memory
         # self.mem_free = mem_free
         self.log_dir = log_dir
+        if depends_on is None:
+            depends_on = []
+        elif not isinstance(depends_on, (list, tuple)):
+            depends_on = [depends_on]
+        self.depends_on = list(depends_on)
+        self.inputs = [] if inputs is None else list(inputs)
+        self.outputs = [] if outputs is None else list(outputs)
+        self.subject = subject
 
-        self._qsub_schema = QSUB_SCHEMA
         self._qsub_script = None
         self._initialise_cmd(cmd)  # let the initialiser do the checking
         self._jobid = None
@@ -222,68 +1136,72 @@ class ClusterJob(object):
         self._waiting = False
         self._completed = False
         self._submitted = False
+        self._killed = False
+        self._exit_status = None
+        self._accounting = None
+        self._submit_time = None
+        self._packed_jobs = None  # jobs run by this one, see ClusterBatch.pack
+        self._pack_spec = None
+        self._attempts = []
+        self._held_for = []  # jobs to succeed before submission, see submit
+        self._skipped = False
+        self._digests = None  # DigestStore to record the inputs in
         self._status_msg = 'Job not submitted yet'
         self._cleanup_qsub_job = cleanup
 
-        opt_threaded_flag = ""
-        cwd_flag = ''
-        # Get memory limit info for current queue from qconf, no need to guess
-        h_vmem = self.cluster.get_memlimit_per_process(self.queue)
-        # NB this has to be explicitly set, see Issue #53
-        opt_h_vmem_flag = "#$ -l h_vmem={:s}".format(h_vmem)
-
-        if self.total_memory is not None:
-            if self.n_threads > 1:
-                raise ValueError(
-                    'Maximum number of parallel threads is one (1) when total '
-                    'memory consumption is specified.')
-            # XXX would be nice with some sanity checking here...
-            _, totmem, totmem_unit = re.split('(\d+)', self.total_memory)
-            _, memlim, memlim_unit = re.split('(\d+)', h_vmem)
-
-            if totmem_unit != memlim_unit:
-                units = dict(k=1e3, m=1e6, g=1e9, t=1e12)
-                try:
-                    ratio = units[totmem_unit.lower()] /\
-                                units[memlim_unit.lower()]
-                except KeyError:
-                    raise ValueError('Something is wrong with the memory units'
-                                     ', likely {:s}'.format(self.total_memory))
-            else:
-                ratio = 1.
-
-            self.n_threads = int(
-                math.ceil(ratio * float(totmem) / float(memlim)))
-
-        if self.n_threads > 1:
-            self.cluster._check_parallel_env(self.queue, 'threaded')
-            opt_threaded_flag = "#$ -pe threaded {:d}".format(self.n_threads)
-
         if job_name is None:
             job_name = 'py-wrapper'
+        self.job_name = job_name
         log_name_prefix = job_name
 
+        self._use_cwd = False
         if working_dir is not None and isinstance(working_dir, string_types):
             if working_dir == 'cwd':
-                cwd_flag = '#$ -cwd'
+                self._use_cwd = True
                 working_dir = os.getcwd()  # NB replace with real path to cwd
             else:
                 enforce_path_exists(working_dir)
-                cwd_flag = '#$ -wd {:s}'.format(working_dir)
             # finally, check that we can write the log here!
             if not os.access(working_dir, os.W_OK):
                 raise RuntimeError(
                     'Current working directory not writeable! '
                     'Change directory to somewhere you can write to.')
+        self.working_dir = working_dir
 
         if self.log_dir is not None:
             if not os.path.exists(self.log_dir):
                 raise ValueError('Log directory {} does not exist.'.format(
                     self.log_dir))
             log_name_prefix = os.path.join(self.log_dir, job_name)
+        self._log_name_prefix = log_name_prefix
+
+        if isinstance(queue, (list, tuple)):
+            queue = self.cluster._select_queues([(n_threads, total_memory)],
+                                                list(queue))[0]
+        self._configure(queue, n_threads, total_memory)
 
-        self._create_qsub_script(job_name, cwd_flag, opt_threaded_flag,
-                                 opt_h_vmem_flag, log_name_prefix)
+    def _configure(self, queue, n_threads, total_memory):
+        """Set the queue and resources, and (re-)create the job script"""
+        self.cluster._check_queue(queue)
+
+        # Get memory limit info for current queue from qconf, no need to guess
+        h_vmem = self.cluster.get_memlimit_per_process(queue)
+
+        if total_memory is not None:
+            if n_threads > 1:
+                raise ValueError(
+                    'Maximum number of parallel threads is one (1) when total '
+                    'memory consumption is specified.')
+            n_threads = self.cluster._threads_for_memory(total_memory, h_vmem)
+
+        if n_threads > 1:
+            self.cluster._check_parallel_env(queue, 'threaded')
+
+        self.queue = queue
+        self.n_threads = n_threads
+        self.total_memory = total_memory
+        self._h_vmem = h_vmem
+        self._qsub_script = self.cluster._create_script(self)
 
     @property
     def cmd(self):
@@ -305,35 +1223,55 @@ class ClusterJob(object):
         else:
             self._cmd = value
 
-    def _create_qsub_script(self, job_name, cwd_flag, opt_threaded_flag,
-                            opt_h_vmem_flag, log_name_prefix):
-        """All variables should be defined"""
-        if (self.cmd is None or self.queue is None or job_name is None
-                or cwd_flag is None or opt_threaded_flag is None
-                or opt_h_vmem_flag is None):
-            raise ValueError('This should not happen, please report an Issue!')
-
-        self._qsub_script =\
-            self._qsub_schema.format(opt_threaded_flag=opt_threaded_flag,
-                                     opt_h_vmem_flag=opt_h_vmem_flag,
-                                     cwd_flag=cwd_flag, queue=self.queue,
-                                     log_name_prefix=log_name_prefix,
-                                     exec_cmd=self.cmd, job_name=job_name)
-
-    def _write_qsub_job(self, sh_file='~/submit_job.sh'):
-        """Write temp .sh"""
-        with open(expanduser(sh_file), 'w') as bash_file:
+    def _write_qsub_job(self, sh_file=None):
+        """Write temp .sh, return its full path
+
+        If no file name is given, a unique one is created in the home folder,
+        so that several jobs can be submitted concurrently.
+        """
+        if sh_file is None:
+            fd, sh_file = tempfile.mkstemp(
+                prefix='submit_{:s}_'.format(self.job_name), suffix='.sh',
+                dir=expanduser('~'))
+            os.close(fd)
+        sh_file = expanduser(sh_file)
+        with open(sh_file, 'w') as bash_file:
             bash_file.writelines(self._qsub_script)
+        return sh_file
+
+    def _dependency_ids(self, exclude=()):
+        """Return the job IDs of the jobs this job depends on"""
+        jobids = []
+        for dep in self.depends_on:
+            if isinstance(dep, ClusterJob):
+                if dep._skipped or dep in exclude:  # nothing to wait for
+                    continue
+                if not dep._submitted:
+                    raise RuntimeError('Job depends on a job that has not '
+                                       'been submitted: {0}'.format(dep.cmd))
+                jobids.append(dep._jobid)
+            else:
+                jobids.append(str(dep))
+        return jobids
 
     @staticmethod
-    def _delete_qsub_job(sh_file='~/submit_job.sh'):
+    def _delete_qsub_job(sh_file):
         """Delete temp .sh"""
         os.unlink(expanduser(sh_file))
 
-    def submit(self, fake=False, sh_file='~/submit_job.sh'):
+    def submit(self, fake=False, sh_file=None):
+        """Submit the job to the cluster.
 
-        self._check_status()
+        Parameters
+        ----------
+        fake : bool
+            If True, show what would be submitted (but don't actually submit).
+        sh_file : str | None
+            Name of the qsub bash-script to write. If None (default), a unique
+            file name is generated in the home folder.
+        """
         if self._submitted:
+            self._check_status()
             if self._running:
                 print('Job {0} is already running!'.format(self._jobid))
                 return
@@ -353,86 +1291,877 @@ class ClusterJob(object):
             print(self._cmd)
             return
 
-        self._write_qsub_job()
+        self._submit_script(self._dependency_ids(), sh_file=sh_file)
+
+    def _submit_script(self, dependencies, sh_file=None):
+        """Write the job script and submit it to the cluster"""
+        self._write_pack_spec()
+        sh_file = self._write_qsub_job(sh_file=sh_file)
         try:
-            output = subp.check_output(['qsub', expanduser(sh_file)],
-                                       stderr=subp.STDOUT,
-                                       shell=False)
-        except subp.CalledProcessError as cpe:
-            raise RuntimeError('qsub submission failed with error code {:d}, '
-                               'output is:\n\n{:s}'.format(
-                                   cpe.returncode, cpe.output))
-        else:
-            # py2-3 safety
-            output = output.decode('ascii', 'ignore').rstrip()
-            m = re.search('(\d+)', output)
-            self._jobid = m.group(1)
+            self._jobid = self.cluster._submit(sh_file, self,
+                                               dependencies=dependencies)
+        finally:
             if self._cleanup_qsub_job:
-                self._delete_qsub_job()
-            print('Cluster job submitted, job ID: {0}'.format(self._jobid))
-            self._submitted = True
+                self._delete_qsub_job(sh_file)
+        print('Cluster job submitted, job ID: {0}'.format(self._jobid))
+        self._submitted = True
+        self._submit_time = time.time()
+
+    @property
+    def attempts(self):
+        return self._attempts
+
+    def _log_fnames(self):
+        """Return the log files of the (submitted) job"""
+        fnames = [self.cluster._log_fname(self, self._jobid)]
+        if self._pack_spec is not None:
+            fnames += [task['log'] for task in self._pack_spec['tasks']]
+        return fnames
+
+    def _resubmit(self, queue=None, n_threads=None, total_memory=None):
+        """Submit a finished job again, optionally with other resources
+
+        The jobs it depends on have already finished, so the job is not held.
+        Of a packed job, only the commands that failed are run again.
+        """
+        self._attempts.append((self._jobid, self._accounting))
+        if self._packed_jobs is not None:
+            self._repack_failed()
+        if queue is not None:
+            self._configure(queue, n_threads, total_memory)
+        self._jobid = None
+        self._running, self._waiting, self._completed = False, False, False
+        self._submitted = False
+        self._exit_status = None
+        self._accounting = None
+        self._status_msg = 'Job not submitted yet'
+        self._submit_script([])
 
     @property
     def status(self):
         self._check_status()
         return (self._status_msg)
 
-    def _check_status(self):
-        if self._completed:
+    def _check_status(self, states=None):
+        """Update the job status
+
+        Parameters
+        ----------
+        states : dict | None
+            Output of `Cluster._job_states` (for many jobs at once). If None,
+            the cluster is queried for this job only.
+        """
+        if self._completed or self._killed or not self._submitted:
             return
-        output = self.cluster._query('qstat -u ' + os.environ['USER'] +
-                                     ' | grep {0}'.format(self._jobid) +
-                                     ' | awk \'{print $5, $8}\'')[0]  # ONLY
+        if states is None:
+            states = self.cluster._job_states([self._jobid])
 
-        if len(output) == 0:
-            if (self._submitted and not self._running and not self._completed
-                    and not self._waiting):
+        if self._jobid not in states:
+            if not self._running and not self._waiting:
                 self._status_msg = ('Submission failed, see log for'
                                     ' output errors!')
-            elif self._submitted and not self._completed:
-                if self._running:
-                    self._status_msg = 'Job completed'
-                    self._running, self._waiting = False, False
-                    self._completed = True
-        else:
-            runcode, hostname = output.split(' ')
-
-            if runcode == 'r':
-                queuename, exechost = hostname.split('@')
-                exechost = exechost.split('.')[0]
-                self._running = True
-                self._waiting = False
-                self._completed = False
-                self._status_msg = 'Running on {0} ({1})'.format(
-                    exechost, queuename)
-            elif runcode == 'qw':
-                self._running = False
-                self._waiting = True
-                self._completed = False
-                self._status_msg = 'Waiting in the queue'
             else:
-                self._running = False
-                self._waiting = True
-                self._completed = False
-                self._status_msg = ('Queue status odd (qstat says: {0}), '
-                                    'please check!'.format(runcode))
+                self._status_msg = 'Job completed'
+                self._running, self._waiting = False, False
+                self._completed = True
+            return
+
+        runcode, hostname = states[self._jobid]
+        if runcode == 'r':
+            queuename, exechost = hostname.split('@')
+            exechost = exechost.split('.')[0]
+            self._running = True
+            self._waiting = False
+            self._completed = False
+            self._status_msg = 'Running on {0} ({1})'.format(
+                exechost, queuename)
+        elif runcode in ('qw', 'hqw'):
+            self._running = False
+            self._waiting = True
+            self._completed = False
+            self._status_msg = 'Waiting in the queue'
+        elif runcode == 'z':  # finished local job, its record is at hand
+            self._set_finished(self.cluster._accounting(
+                [self._jobid]).get(self._jobid))
+        else:
+            self._running = False
+            self._waiting = True
+            self._completed = False
+            self._status_msg = ('Queue status odd (qstat says: {0}), '
+                                'please check!'.format(runcode))
+
+    @property
+    def exit_status(self):
+        return self._exit_status
+
+    @property
+    def accounting(self):
+        """Resource usage of the finished job (None if not available).
+
+        A dict with the keys 'exit_status', 'wallclock' (seconds), 'cpu'
+        (CPU time in seconds), 'maxvmem' (peak memory use in bytes) and
+        'queue_host' (queue@host the job ran on).
+        """
+        if self._accounting is None and self._completed:
+            record = self.cluster._accounting([self._jobid])
+            if self._jobid in record:
+                self._set_finished(record[self._jobid])
+        return self._accounting
+
+    def _set_finished(self, record=None, history=True):
+        """Mark the job as finished, with accounting record (if known)"""
+        exit_status = None if record is None else record['exit_status']
+        self._running, self._waiting = False, False
+        self._completed = True
+        if record is not None and self._accounting is None and history:
+            self._record_history(record)
+        self._accounting = record
+        self._exit_status = exit_status
+        if self._packed_jobs is not None:
+            self._set_packed_finished(history=history)
+        if exit_status == 0 and self._digests is not None:
+            self._record_digest()
+            self._digests = None  # once, the job may be set finished again
+        error = None if record is None else record.get('error')
+        if error == 'Dependency failed':
+            self._status_msg = 'Dependency failed'
+        elif error is not None:
+            self._status_msg = 'Job failed ({0})'.format(error)
+        elif exit_status is None or exit_status == 0:
+            self._status_msg = 'Job completed'
+        else:
+            self._status_msg = 'Job failed (exit status {:d})'.format(
+                exit_status)
+
+    def _failed(self):
+        """Whether the finished job failed, or was not run (see accounting)"""
+        return (self._exit_status not in (None, 0) or
+                (self._accounting is not None and
+                 self._accounting.get('error') is not None))
+
+    def is_up_to_date(self, digests=None):
+        """Check whether the outputs of the job are up to date.
+
+        See `stormdb.incremental.is_up_to_date`.
+
+        Parameters
+        ----------
+        digests : instance of DigestStore | None
+            Compare the contents of the inputs to those the outputs were made
+            from. If None (default), only modification times are compared.
+        """
+        return is_up_to_date(self.inputs, self.outputs, digests=digests)
+
+    def _record_digest(self):
+        """Record the digest of the inputs the outputs were made from"""
+        try:
+            if all(os.path.exists(fname) for fname in self.inputs):
+                self._digests.set(self.outputs,
+                                  self._digests.digest(self.inputs))
+                self._digests.save()
+        except (IOError, OSError) as err:
+            print('Could not record input digests: {0}'.format(err))
+
+    @property
+    def packed_jobs(self):
+        """The jobs packed into this one (None if not a packed job).
+
+        Once this job has finished, the exit status and accounting record of
+        each packed job (command) are set.
+        """
+        return self._packed_jobs
+
+    def _repack_failed(self):
+        """Reduce the spec of a packed job to the failed commands"""
+        spec = self._pack_spec
+        # NB results of an earlier attempt must not be taken for this one's
+        if os.path.exists(spec['results']):
+            os.remove(spec['results'])
+        failed = [(idx, task) for idx, task in zip(spec['index'],
+                                                   spec['tasks'])
+                  if self._packed_jobs[idx].exit_status != 0]
+        if len(failed) == 0:  # the runner itself failed, rerun all
+            return
+        spec['index'] = [idx for idx, _ in failed]
+        spec['tasks'] = [task for _, task in failed]
+
+    def _write_pack_spec(self):
+        """Write the spec-file of a packed job (before it is submitted)"""
+        spec = self._pack_spec
+        if spec is None:
+            return
+        with open(spec['fname'], 'w') as fid:
+            json.dump(dict((key, val) for key, val in spec.items()
+                           if key not in ('fname', 'index')), fid, indent=1)
+
+    def _set_packed_finished(self, history=True):
+        """Set the results of the packed jobs from the runner's results"""
+        jobs = [self._packed_jobs[idx] for idx in self._pack_spec['index']]
+        results = [None] * len(jobs)
+        if os.path.exists(self._pack_spec['results']):
+            with open(self._pack_spec['results'], 'r') as fid:
+                results = json.load(fid)
+        for job, result in zip(jobs, results):
+            job._jobid = self._jobid
+            job._submitted = True
+            if result is not None and self._accounting is not None:
+                result['queue_host'] = self._accounting.get('queue_host', '')
+            job._set_finished(result, history=history)
+
+    @property
+    def memory_requested(self):
+        """The memory requested for the job (in bytes)."""
+        if self.total_memory is not None:
+            return _parse_memory(self.total_memory)
+        return self.n_threads * _parse_memory(self._h_vmem)
+
+    def _input_size(self):
+        """Total size of the (existing) input files, None if no inputs"""
+        if len(self.inputs) == 0:
+            return None
+        return sum(os.path.getsize(fname) for fname in self.inputs
+                   if os.path.isfile(fname))
+
+    def _record_history(self, record):
+        """Add the accounting record of the job to the resource history"""
+        if record.get('wallclock') is None:
+            return  # killed before it ran
+        try:
+            JobHistory().record(self.job_name, record, self.n_threads,
+                                self.memory_requested,
+                                input_size=self._input_size(),
+                                cluster=self.cluster.name)
+        except (IOError, OSError) as err:
+            print('Could not record job history: {0}'.format(err))
+
+    def suggest_resources(self, percentile=95., history=None):
+        """Suggest queue, threads and memory based on similar past jobs.
+
+        Past jobs with the same job name on the same cluster are used, see
+        `JobHistory.suggest`. Jobs that need much more memory than their CPU
+        use warrants are moved to the high-memory queue (if the cluster has
+        one), and jobs already there get their total memory adjusted.
+
+        Parameters
+        ----------
+        percentile : float
+            The percentile (0-100) of past resource use to plan for
+            (default: 95).
+        history : instance of JobHistory | None
+            The resource history to use. If None, the default one is used.
+
+        Returns
+        -------
+        suggestion : dict | None
+            Dict with the keys 'queue', 'n_threads' and 'total_memory' (see
+            `apply_resources`), as well as the estimated peak 'memory'
+            (bytes) and 'wallclock' (seconds). None if there are too few
+            past jobs.
+        """
+        if history is None:
+            history = JobHistory()
+        usage = history.suggest(self.job_name, input_size=self._input_size(),
+                                percentile=percentile,
+                                cluster=self.cluster.name)
+        if usage is None:
+            return None
+
+        highmem_qs = self.cluster._highmem_qs
+        n_threads_mem = int(math.ceil(
+            usage['memory'] / _parse_memory(self._h_vmem)))
+        # jobs needing much more memory than threads go to a highmem queue
+        needs_highmem = n_threads_mem > 2 * usage['n_threads']
+        if self.queue in highmem_qs or (len(highmem_qs) > 0 and needs_highmem):
+            queue = self.queue if self.queue in highmem_qs else highmem_qs[0]
+            suggestion = dict(queue=queue, n_threads=1,
+                              total_memory=_format_memory(usage['memory']))
+        else:
+            suggestion = dict(queue=self.queue, total_memory=None,
+                              n_threads=max(usage['n_threads'], n_threads_mem))
+        suggestion.update(memory=usage['memory'],
+                          wallclock=usage['wallclock'])
+        return suggestion
+
+    def apply_resources(self, suggestion):
+        """Change the queue and resources of a job (before submission).
+
+        Parameters
+        ----------
+        suggestion : dict
+            Dict with the keys 'queue', 'n_threads' and 'total_memory', e.g.,
+            the output of `suggest_resources`.
+        """
+        if self._submitted:
+            raise RuntimeError('Job {0} is already submitted.'.format(
+                self._jobid))
+        self._configure(suggestion['queue'], suggestion['n_threads'],
+                        suggestion['total_memory'])
 
     def kill(self):
         self._check_status()
         if self._submitted and (self._running or self._waiting):
+            self.cluster._kill([self._jobid])
+            print('Job {:s} killed. You must manually delete any output '
+                  'it may have created!'.format(self._jobid))
+            self._set_killed()
+
+    def _set_killed(self):
+        self._running = False
+        self._waiting = False
+        self._completed = False
+        self._killed = True
+        self._status_msg = 'Job was previously killed.'
+
+
+def _read_tail(fname, n_bytes=65536):
+    """Return the end of a (log) file, empty if it cannot be read"""
+    try:
+        with open(fname, 'rb') as fid:
+            fid.seek(0, os.SEEK_END)
+            fid.seek(max(0, fid.tell() - n_bytes))
+            return fid.read().decode('utf-8', 'replace')
+    except (IOError, OSError):
+        return ''
+
+
+class RetryPolicy(object):
+    """Policy for resubmitting the failed jobs of a ClusterBatch.
+
+    Jobs that finish with a non-zero exit status are resubmitted after a
+    delay, until they succeed or have been run `max_attempts` times. Jobs
+    that ran out of memory (judged from their log files and peak memory
+    use) can be given more memory, or moved to another queue.
+
+    Parameters
+    ----------
+    max_attempts : int
+        Maximum number of times a job is run (default: 3).
+    backoff : float
+        Time to wait before resubmitting a failed job (in seconds, default:
+        60). The delay is doubled for each further attempt.
+    escalate_queue : str | None
+        Queue to move jobs to that ran out of memory, e.g., 'highmem.q'. If
+        None (default), the jobs stay in their queue.
+    memory_factor : float | None
+        Factor by which to increase the memory of jobs that ran out of memory
+        (default: 2). Jobs without a total memory get more threads (slots)
+        instead, unless they are moved to another queue. If None, the
+        resources are not changed.
+
+    Notes
+    -----
+    Failed jobs are resubmitted while waiting for the batch to finish, see
+    `ClusterBatch.wait` and `ClusterBatch.as_completed`. Jobs that depend on
+    other jobs of the batch are only submitted once those have succeeded,
+    and are not run if one of them fails for good.
+    """
+
+    OOM_SIGNATURES = ('MemoryError', 'Out of memory', 'out of memory',
+                      'Cannot allocate memory', 'std::bad_alloc', 'oom-kill',
+                      'oom_kill', 'OUT_OF_MEMORY', 'exceeded memory limit',
+                      'h_vmem')
+
+    def __init__(self, max_attempts=3, backoff=60., escalate_queue=None,
+                 memory_factor=2.):
+        if not isinstance(max_attempts, int) or max_attempts < 1:
+            raise ValueError('max_attempts must be a positive integer.')
+        if backoff < 0:
+            raise ValueError('backoff must be non-negative (seconds).')
+        if memory_factor is not None and memory_factor < 1:
+            raise ValueError('memory_factor must be at least 1.')
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.escalate_queue = escalate_queue
+        self.memory_factor = memory_factor
+
+    def should_retry(self, job):
+        """Whether a finished job should be resubmitted"""
+        return (not job._killed and job.exit_status not in (None, 0) and
+                len(job.attempts) + 1 < self.max_attempts)
+
+    def delay(self, job):
+        """Time to wait before resubmitting a failed job (in seconds)"""
+        return self.backoff * 2 ** len(job.attempts)
+
+    def out_of_memory(self, job):
+        """Whether a finished job (probably) ran out of memory"""
+        record = job.accounting
+        if record is not None and record.get('maxvmem'):
+            if record['maxvmem'] >= 0.95 * job.memory_requested:
+                return True
+        for fname in job._log_fnames():
+            log = _read_tail(fname)
+            if any(sig in log for sig in self.OOM_SIGNATURES):
+                return True
+        return False
+
+    def escalate(self, job):
+        """Return the resources for the next attempt of a failed job.
+
+        Returns
+        -------
+        resources : dict | None
+            Dict with the keys 'queue', 'n_threads' and 'total_memory' (see
+            `ClusterJob.apply_resources`), None to keep the current ones.
+        """
+        if ((self.escalate_queue is None and self.memory_factor is None) or
+                not self.out_of_memory(job)):
+            return None
+        queue = self.escalate_queue or job.queue
+        factor = 1. if self.memory_factor is None else self.memory_factor
+        if queue == job.queue and job.total_memory is None:
+            return dict(queue=queue, total_memory=None,
+                        n_threads=int(math.ceil(job.n_threads * factor)))
+        return dict(queue=queue, n_threads=1, total_memory=_format_memory(
+            job.memory_requested * factor))
+
+
+class _JobPoller(object):
+    """Follow the status of many jobs, polling the cluster for all at once.
+
+    The polling interval grows by a factor `backoff` after each poll where
+    nothing changed, up to `max_interval`, and is reset on any change. Exit
+    statuses of finished jobs are read from the accounting records, which
+    may lag: a job that has left the queue is considered finished when its
+    record appears, or after `max_misses` polls without one. Failed jobs are
+    resubmitted according to `retry_policy` (if set), and only reported as
+    finished once they are not retried anymore. Held jobs (see
+    `ClusterBatch.submit`) are submitted once the jobs they depend on have
+    succeeded.
+    """
+
+    def __init__(self, cluster, poll_interval=5., max_interval=120.,
+                 backoff=1.5, max_misses=3, retry_policy=None, logger=None):
+        self.cluster = cluster
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_misses = max_misses
+        self.retry_policy = retry_policy
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.journal = None
+        self._finished = set()
+        self._misses = dict()
+        self._retries = dict()  # job: time of resubmission
+
+    def is_finished(self, job):
+        return job in self._finished
+
+    def poll(self, jobs):
+        """Update the status of jobs, return (newly finished, changed)"""
+        newly_finished, changed = self._resubmit_due()
+        pending = [job for job in jobs if job._submitted and
+                   job not in self._finished and job not in self._retries]
+        states = dict()
+        if len(pending) > 0:
+            states = self.cluster._job_states([job._jobid
+                                               for job in pending])
+        gone = []
+        for job in pending:
+            status_msg = job._status_msg
+            job._check_status(states)
+            changed = changed or job._status_msg != status_msg
+            if job._jobid not in states or job._completed:
+                gone.append(job)
+
+        records = dict()
+        if len(gone) > 0:
+            records = self.cluster._accounting(
+                [job._jobid for job in gone],
+                since=min(job._submit_time for job in gone))
+        newly_finished += [job for job in pending if job._killed]
+        for job in gone:
+            if job._killed:
+                continue
+            if job._jobid not in records:
+                self._misses[job] = self._misses.get(job, 0) + 1
+                if self._misses[job] < self.max_misses:
+                    continue
+            self._misses.pop(job, None)
+            job._set_finished(records.get(job._jobid))
+            delay = self._handle_finished(job)
+            if delay is not None:
+                self._retries[job] = time.time() + delay
+                changed = True
+            else:
+                newly_finished.append(job)
+        self._finished.update(newly_finished)
+        not_run, released = self._release_held(jobs)
+        newly_finished += not_run
+        return newly_finished, (changed or len(newly_finished) > 0 or
+                                len(released) > 0)
+
+    def _handle_finished(self, job):
+        """Journal a finished job, return the delay before resubmitting it
+
+        None is returned if the job is not to be resubmitted.
+        """
+        if self.journal is not None:
+            self.journal.finished(job)
+        if (self.retry_policy is None or
+                not self.retry_policy.should_retry(job)):
+            return None
+        delay = self.retry_policy.delay(job)
+        self.logger.info('Job {0} failed (exit status {1:d}), resubmitting in '
+                         '{2:.0f} s (attempt {3:d} of {4:d}).'.format(
+                             job._jobid, job.exit_status, delay,
+                             len(job.attempts) + 2,
+                             self.retry_policy.max_attempts))
+        return delay
+
+    def _resubmit(self, job):
+        """Resubmit a failed job, return False if that failed"""
+        try:
+            resources = self.retry_policy.escalate(job)
+            if resources is not None:
+                self.logger.info(
+                    'Job {0} ran out of memory, resubmitting to {1} with '
+                    '{2} threads and {3} memory.'.format(
+                        job._jobid, resources['queue'],
+                        resources['n_threads'],
+                        resources['total_memory'] or 'default'))
+                job._resubmit(**resources)
+            else:
+                job._resubmit()
+        except (RuntimeError, ValueError) as err:
+            self.logger.error('Resubmission failed for: {0}\n{1}'.format(
+                job.cmd, err))
+            job._set_finished(dict(exit_status=None, error=str(err)))
+            return False
+        if self.journal is not None:
+            self.journal.resubmitted(job)
+        return True
+
+    def _release_held(self, jobs):
+        """Submit the held jobs whose dependencies have all succeeded
+
+        Returns the held jobs that are not run (a dependency failed, or the
+        submission failed), which are finished, and the jobs submitted.
+        """
+        not_run, released = [], []
+        for job in jobs:
+            if len(job._held_for) == 0:
+                continue
+            if job._killed:
+                job._held_for = []
+                not_run.append(job)
+                continue
+            done = [dep for dep in job._held_for if dep in self._finished]
+            # a dependency fails if it finished unsuccessfully for good (it
+            # is not retried), or could not be submitted
+            if (any(dep._failed() or not dep._completed for dep in done) or
+                    any(not (dep._submitted or dep._held_for)
+                        for dep in job._held_for if dep not in done)):
+                job._held_for = []
+                job._set_finished(dict(exit_status=None,
+                                       error='Dependency failed'))
+                not_run.append(job)
+                continue
+            if len(done) < len(job._held_for):
+                continue
+            held_for, job._held_for = job._held_for, []
             try:
-                subp.check_output(['qdel {0}'.format(self._jobid)],
-                                  stderr=subp.STDOUT,
-                                  shell=True)
-            except subp.CalledProcessError:
-                raise RuntimeError('This should not happen, report Issue!')
+                job._submit_script(job._dependency_ids(exclude=held_for))
+            except (RuntimeError, ValueError) as err:
+                self.logger.error('Submission failed for: {0}\n{1}'.format(
+                    job.cmd, err))
+                job._set_finished(dict(exit_status=None, error=str(err)))
+                not_run.append(job)
+                continue
+            if self.journal is not None:
+                self.journal.submitted(job)
+            released.append(job)
+        self._finished.update(not_run)
+        return not_run, released
+
+    def _resubmit_due(self):
+        """Resubmit the failed jobs whose delay has passed
+
+        Returns the jobs that could not be resubmitted (they are finished),
+        and whether any jobs were handled.
+        """
+        now = time.time()
+        due = [job for job, when in self._retries.items() if when <= now]
+        failed = []
+        for job in due:
+            del self._retries[job]
+            if not self._resubmit(job):
+                failed.append(job)
+        self._finished.update(failed)
+        return failed, len(due) > 0
+
+    def next_retry(self):
+        """Time until the next resubmission (in seconds), None if none"""
+        if len(self._retries) == 0:
+            return None
+        return max(0., min(self._retries.values()) - time.time())
+
+    def iter_finished(self, jobs, timeout=None):
+        """Yield jobs as they finish (those already finished first)"""
+        for job in jobs:
+            if job in self._finished:
+                yield job
+        start = time.time()
+        interval = self.poll_interval
+        while True:
+            newly_finished, changed = self.poll(jobs)
+            for job in newly_finished:
+                yield job
+            if len(self._retries) == 0 and all(
+                    job in self._finished for job in jobs
+                    if job._submitted or job._held_for):
+                return
+            if changed:
+                interval = self.poll_interval
             else:
-                print('Job {:s} killed. You must manually delete any output '
-                      'it may have created!'.format(self._jobid))
-                self._running = False
-                self._waiting = False
-                self._completed = False
-                self._status_msg = 'Job was previously killed.'
+                interval = min(interval * self.backoff, self.max_interval)
+            if len(self._retries) > 0:
+                interval = min(interval, self.next_retry())
+            if timeout is not None:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise TimeoutError('Jobs did not finish within {0} '
+                                       'seconds.'.format(timeout))
+                interval = min(interval, remaining)
+            time.sleep(interval)
+
+
+_SHARED_POLLERS = dict()
+
+
+class _SharedPoller(object):
+    """Poll the jobs watched by all batches of a user, in an event loop.
+
+    All watched jobs (of any batch) on a cluster are polled at once, in a
+    worker thread, so that the event loop is not blocked. Each finished job
+    is put in the queue of its watcher as a (job, final)-tuple.
+    """
+
+    def __init__(self, cluster, key, loop):
+        self.key = key
+        self.poller = _JobPoller(cluster)
+        self._loop = weakref.ref(loop)
+        self._watchers = dict()  # job: queue of the watcher
+        self._held = set()  # finished jobs that are to be resubmitted
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @classmethod
+    def get(cls, cluster):
+        """Return the shared poller of the user for the cluster"""
+        # pollers of closed event loops are dropped (their ids can be reused)
+        for key, shared in list(_SHARED_POLLERS.items()):
+            loop = shared._loop()
+            if loop is None or loop.is_closed():
+                del _SHARED_POLLERS[key]
+        # the state of local jobs is only known to their cluster instance
+        cluster_key = (cluster if isinstance(cluster, LocalCluster)
+                       else (type(cluster), cluster.name))
+        loop = asyncio.get_event_loop()
+        key = (id(loop), cluster_key, getuser())
+        if key not in _SHARED_POLLERS:
+            _SHARED_POLLERS[key] = cls(cluster, key, loop)
+        return _SHARED_POLLERS[key]
+
+    def _deregister(self):
+        """Drop the poller once it has no (held) jobs left"""
+        if (len(self._watchers) == 0 and len(self._held) == 0 and
+                _SHARED_POLLERS.get(self.key) is self):
+            del _SHARED_POLLERS[self.key]
+
+    def hold(self, job):
+        """Keep the poller while a finished job waits to be resubmitted"""
+        self._held.add(job)
+
+    def release(self, job):
+        """A held job is not resubmitted after all"""
+        self._held.discard(job)
+        if self._task is None or self._task.done():
+            self._deregister()
+
+    def watch(self, jobs, queue, poll_interval=5.):
+        """Start polling jobs, putting them in the queue once finished"""
+        for job in jobs:
+            self.poller._finished.discard(job)
+            self._held.discard(job)
+            self._watchers[job] = queue
+        self.poller.poll_interval = min(self.poller.poll_interval,
+                                        poll_interval)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+
+    def unwatch(self, jobs):
+        for job in jobs:
+            self._watchers.pop(job, None)
+            self._held.discard(job)
+        if self._task is None or self._task.done():
+            self._deregister()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        poller = self.poller
+        interval = poller.poll_interval
+        try:
+            while len(self._watchers) > 0:
+                self._wakeup.clear()
+                changed = False
+                try:
+                    newly_finished, changed = await loop.run_in_executor(
+                        None, poller.poll, list(self._watchers))
+                except (RuntimeError, OSError) as err:
+                    poller.logger.error('Polling the cluster failed: '
+                                        '{0}'.format(err))
+                    newly_finished = []
+                for job in newly_finished:
+                    queue = self._watchers.pop(job, None)
+                    if queue is not None:
+                        queue.put_nowait((job, False))
+                if changed:
+                    interval = poller.poll_interval
+                else:
+                    interval = min(interval * poller.backoff,
+                                   poller.max_interval)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), interval)
+                    interval = poller.poll_interval  # new jobs to watch
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._deregister()
+
+
+class _RateLimiter(object):
+    """Thread-safe limiter spacing out calls to at most `rate` per second."""
+
+    def __init__(self, rate=None):
+        self._interval = 1. / rate if rate else 0.
+        self._next_time = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        if self._interval == 0.:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _job_entry(job):
+    """Return the definition of a (submitted) job as a JSON-able dict"""
+    entry = dict(jobid=job._jobid, cmd=job.cmd, job_name=job.job_name,
+                 queue=job.queue, n_threads=job.n_threads,
+                 total_memory=job.total_memory, working_dir=job.working_dir,
+                 log_dir=job.log_dir, inputs=job.inputs, outputs=job.outputs,
+                 subject=job.subject,
+                 depends_on=[str(dep._jobid) if isinstance(dep, ClusterJob)
+                             else str(dep) for dep in job.depends_on],
+                 time=job._submit_time)
+    if job._packed_jobs is not None:
+        entry['packed'] = [_job_entry(packed) for packed in job._packed_jobs]
+        entry['pack_spec'] = job._pack_spec
+    return dict((key, val) for key, val in entry.items()
+                if val is not None and val != [])
+
+
+def _job_from_entry(entry, proj_name, cluster):
+    """Re-create a job from its definition, see `_job_entry`"""
+    job = ClusterJob(entry['cmd'], proj_name, queue=entry['queue'],
+                     n_threads=entry['n_threads'],
+                     total_memory=entry.get('total_memory'),
+                     working_dir=entry.get('working_dir'),
+                     job_name=entry['job_name'], log_dir=entry.get('log_dir'),
+                     cluster=cluster, depends_on=entry.get('depends_on'),
+                     inputs=entry.get('inputs'), outputs=entry.get('outputs'),
+                     subject=entry.get('subject'))
+    job._jobid = entry.get('jobid')
+    job._submitted = job._jobid is not None
+    job._submit_time = entry.get('time')
+    if 'packed' in entry:
+        job._packed_jobs = [_job_from_entry(packed, proj_name, cluster)
+                            for packed in entry['packed']]
+        job._pack_spec = entry['pack_spec']
+    return job
+
+
+class _BatchJournal(object):
+    """Append-only record of the submitted jobs of a batch (JSON lines).
+
+    The first line describes the batch; each further line is an event
+    ('submit', 'finish', 'resubmit' or 'kill') of the job with the given
+    index, in order of submission.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._index = dict()  # job: index
+
+    @classmethod
+    def create(cls, batch, log_dir):
+        """Create the journal of a batch in the log directory"""
+        fd, fname = tempfile.mkstemp(
+            prefix='batch_{:s}_{:s}_'.format(
+                type(batch).__name__, time.strftime('%Y%m%d-%H%M%S')),
+            suffix='.jsonl', dir=log_dir)
+        os.close(fd)
+        journal = cls(fname)
+        cluster = batch.cluster
+        backend = [key for key, klass in _CLUSTER_BACKENDS.items()
+                   if type(cluster) is klass]
+        header = dict(event='batch', batch=type(batch).__name__,
+                      proj_name=batch.proj_name,
+                      cluster=backend[0] if len(backend) > 0 else 'sge',
+                      cluster_name=cluster.name,
+                      queue_map=getattr(cluster, 'queue_map', None),
+                      time=time.time())
+        if getattr(batch, 'info', None) is not None:
+            try:
+                header['info'] = json.loads(json.dumps(batch.info))
+            except TypeError:  # not all info can be stored
+                pass
+        journal._write(header)
+        return journal
+
+    def _write(self, entry):
+        try:
+            with open(self.fname, 'a') as fid:
+                fid.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        except (IOError, OSError) as err:
+            print('Could not write batch journal: {0}'.format(err))
+
+    def __contains__(self, job):
+        return job in self._index
+
+    def submitted(self, job):
+        self._index[job] = len(self._index)
+        self._write(dict(_job_entry(job), event='submit',
+                         index=self._index[job]))
+
+    def finished(self, job):
+        if job in self._index:
+            entry = dict(event='finish', index=self._index[job],
+                         record=job._accounting)
+            if job._packed_jobs is not None:
+                entry['packed'] = [packed._accounting
+                                   for packed in job._packed_jobs]
+            self._write(entry)
+
+    def resubmitted(self, job):
+        if job in self._index:
+            self._write(dict(event='resubmit', index=self._index[job],
+                             jobid=job._jobid, queue=job.queue,
+                             n_threads=job.n_threads,
+                             total_memory=job.total_memory,
+                             time=job._submit_time,
+                             pack_spec=job._pack_spec))
+
+    def killed(self, job):
+        if job in self._index:
+            self._write(dict(event='kill', index=self._index[job]))
 
 
 class ClusterBatch(object):
@@ -441,13 +2170,16 @@ class ClusterBatch(object):
     This docstring should be overwritten by the children.
     """
 
-    def __init__(self, proj_name, verbose=False):
-        self.cluster = Cluster()
+    def __init__(self, proj_name, verbose=False, cluster=None):
+        self.cluster = get_cluster(cluster)
         # let fail if bad proj_name
         qy = Query(proj_name)  # if None, read proj_name from env
         qy._check_login_credentials()
         self.proj_name = qy.proj_name
         self._joblist = []
+        self._poller = None
+        self._journal = None
+        self.retry_policy = None
 
         self.logger = logging.getLogger('ClusterBatchLogger')
         # Only create a new handler if none exist
@@ -480,12 +2212,168 @@ class ClusterBatch(object):
         else:
             self.logger.setLevel(logging.INFO)
 
-    def kill(self, jobid=None):
-        """Kill (delete) all the jobs in the batch."""
-        for job in self._joblist:
-            if (jobid is None
-                    or (jobid is not None and int(job._jobid) == int(jobid))):
-                job.kill()
+    def kill(self, jobid=None, state=None, job_name=None, subject=None):
+        """Kill (delete) the jobs in the batch, or those selected.
+
+        The scheduler is queried once for the state of all jobs, and the
+        selected jobs are killed with a single call (of e.g. qdel or
+        scancel). All tasks of an array job are killed by the ID of the
+        array, where supported.
+
+        Parameters
+        ----------
+        jobid : str | int | None
+            Kill only the job with this ID.
+        state : str | None
+            Kill only the jobs that are 'running', or 'waiting' in the queue.
+        job_name : str | None
+            Kill only the jobs with this name.
+        subject : str | None
+            Kill only the jobs processing this subject.
+
+        Returns
+        -------
+        killed : list of ClusterJob
+            The jobs that were killed.
+        """
+        if state not in (None, 'running', 'waiting'):
+            raise ValueError('state must be \'running\', \'waiting\' or '
+                             'None.')
+        submitted = [job for job in self._joblist if job._submitted]
+        states = self.cluster._job_states([job._jobid for job in submitted])
+        for job in submitted:
+            job._check_status(states)
+        active = [job for job in submitted if job._running or job._waiting]
+        # held jobs (see submit) are waiting too, but not in the queue yet
+        held = [job for job in self._joblist
+                if len(job._held_for) > 0 and not job._killed]
+        selected = [job for job in active + held
+                    if (jobid is None or job._jobid == str(jobid)) and
+                    (state is None or (job._running if state == 'running'
+                                       else not job._running)) and
+                    (job_name is None or job.job_name == job_name) and
+                    (subject is None or job.subject == subject)]
+        if len(selected) == 0:
+            self.logger.info('No jobs to kill.')
+            return []
+
+        queued = [job._jobid for job in selected if job._submitted]
+        if len(queued) > 0:
+            self.cluster._kill(self.cluster._kill_ids(
+                queued, [job._jobid for job in active]))
+        for job in selected:
+            job._set_killed()
+            if self._journal is not None:
+                self._journal.killed(job)
+        self.logger.info('{:d} jobs killed. You must manually delete any '
+                         'output they may have created!'.format(len(selected)))
+        return selected
+
+    @property
+    def journal(self):
+        """The file recording the submitted jobs (None until submission).
+
+        Use `ClusterBatch.load` (or the `cluster_batch` script) to follow or
+        kill the jobs of the batch from another session.
+        """
+        return None if self._journal is None else self._journal.fname
+
+    def _journal_submitted(self, jobs):
+        """Add submitted jobs to the journal, creating it if needed"""
+        if len(jobs) == 0:
+            return
+        if self._journal is None:
+            log_dir = getattr(self, 'info', dict()).get('log_dir')
+            if log_dir is None:
+                log_dir = jobs[0].log_dir or jobs[0].working_dir or os.getcwd()
+            try:
+                self._journal = _BatchJournal.create(self, log_dir)
+            except (IOError, OSError) as err:
+                self.logger.warning('Could not create batch journal: '
+                                    '{0}'.format(err))
+                return
+            self.logger.info('Batch journal: {0}'.format(self.journal))
+        for job in jobs:
+            if job not in self._journal:
+                self._journal.submitted(job)
+
+    @classmethod
+    def load(cls, fname):
+        """Load a submitted batch from its journal (see `journal`).
+
+        The loaded batch can be used to follow (`status`, `wait`,
+        `as_completed`, `accounting`) or `kill` the jobs submitted from
+        another session. Jobs run on the local cluster cannot be followed
+        once the session that submitted them has ended, and the retry policy
+        is not stored.
+
+        Parameters
+        ----------
+        fname : str
+            The journal file of the batch.
+
+        Returns
+        -------
+        batch : instance of ClusterBatch
+            The batch with the submitted jobs, in order of submission.
+        """
+        with open(fname, 'r') as fid:
+            entries = [json.loads(line) for line in fid if line.strip()]
+        if len(entries) == 0 or entries[0].get('event') != 'batch':
+            raise ValueError('{0} is not a batch journal.'.format(fname))
+        header = entries[0]
+        if header['cluster'] == 'local':
+            raise ValueError('Jobs run on the local cluster cannot be '
+                             'followed from another session.')
+        kwargs = dict(name=header['cluster_name'])
+        if header.get('queue_map') is not None:
+            kwargs['queue_map'] = header['queue_map']
+        cluster = _CLUSTER_BACKENDS[header['cluster']](**kwargs)
+
+        # replay the events: the latest submission of each job counts
+        states = []
+        for entry in entries[1:]:
+            if entry['event'] == 'submit':
+                states.append(dict(entry=entry, attempts=[], record=None,
+                                   finished=False, killed=False))
+                continue
+            state = states[entry['index']]
+            if entry['event'] == 'finish':
+                state.update(record=entry.get('record'), finished=True,
+                             packed=entry.get('packed'))
+            elif entry['event'] == 'resubmit':
+                state['attempts'].append((state['entry']['jobid'],
+                                          state['record']))
+                state['entry'] = dict(state['entry'], **dict(
+                    (key, entry.get(key)) for key in
+                    ('jobid', 'queue', 'n_threads', 'total_memory', 'time',
+                     'pack_spec')))
+                state.update(record=None, finished=False)
+            elif entry['event'] == 'kill':
+                state['killed'] = True
+
+        batch = cls.__new__(cls)
+        ClusterBatch.__init__(batch, header['proj_name'], cluster=cluster)
+        if 'info' in header:
+            batch.info = header['info']
+        batch._journal = _BatchJournal(fname)
+        poller = batch._get_poller()
+        for state in states:
+            job = _job_from_entry(state['entry'], batch.proj_name, cluster)
+            job._attempts = state['attempts']
+            if state['finished']:
+                job._set_finished(state['record'], history=False)
+                for packed, record in zip(job._packed_jobs or [],
+                                          state.get('packed') or []):
+                    packed._set_finished(record, history=False)
+                poller._finished.add(job)
+            if state['killed']:
+                job._killed = True
+                job._status_msg = 'Job was previously killed.'
+                poller._finished.add(job)
+            batch._journal._index[job] = len(batch._joblist)
+            batch._joblist.append(job)
+        return batch
 
     def build_cmd(self):
         raise RuntimeError('This should be overriden in subclasses!')
@@ -496,30 +2384,708 @@ class ClusterBatch(object):
         cmdlist = [job.cmd for job in self._joblist]
         return cmdlist
 
+    def pack(self, n_per_job, n_threads=None, job_name=None):
+        """Pack many short jobs into fewer cluster jobs.
+
+        Unsubmitted jobs with the same queue, threads and log directory are
+        grouped, up to `n_per_job` per cluster job. Each cluster job runs its
+        commands concurrently (as many at a time as its threads allow), using
+        `python -m stormdb.runner`, saving a log file per command. Jobs with
+        dependencies (or that other jobs depend on) and jobs requesting a
+        total memory are not packed.
+
+        Parameters
+        ----------
+        n_per_job : int
+            Maximum number of commands per cluster job.
+        n_threads : int | None
+            Number of threads for each packed cluster job. If None (default),
+            the number of threads of the commands is used (i.e., the commands
+            run one at a time).
+        job_name : str | None
+            Name of the packed jobs. If None, 'pack.' followed by the name
+            of the first job in the pack is used.
+
+        Notes
+        -----
+        The packed jobs replace the original ones in the batch; the exit
+        status of each command can be found in `ClusterJob.packed_jobs`
+        once a packed job has finished.
+        """
+        if not isinstance(n_per_job, int) or n_per_job < 1:
+            raise ValueError('n_per_job must be a positive integer.')
+        depended_on = set(dep for job in self._joblist
+                          for dep in job.depends_on
+                          if isinstance(dep, ClusterJob))
+        groups = dict()
+        new_joblist = []
+        for job in self._joblist:
+            if (job._submitted or len(job.depends_on) > 0 or
+                    job in depended_on or job.total_memory is not None or
+                    job._packed_jobs is not None):
+                new_joblist.append(job)
+                continue
+            key = (job.queue, job.n_threads, job.log_dir)
+            if key not in groups:
+                groups[key] = []
+                new_joblist.append(key)  # placeholder, keeps the order
+            groups[key].append(job)
+
+        self._joblist = []
+        for item in new_joblist:
+            if isinstance(item, ClusterJob):
+                self._joblist.append(item)
+                continue
+            jobs = groups[item]
+            for first in range(0, len(jobs), n_per_job):
+                pack = jobs[first:first + n_per_job]
+                if len(pack) == 1:
+                    self._joblist.append(pack[0])
+                else:
+                    self._joblist.append(self._pack_jobs(
+                        pack, n_threads=n_threads, job_name=job_name))
+        self.logger.info('Batch now contains {:d} jobs.'.format(
+            len(self._joblist)))
+
+    def _pack_jobs(self, jobs, n_threads=None, job_name=None):
+        """Create a single ClusterJob running the commands of many"""
+        first = jobs[0]
+        if n_threads is None:
+            n_threads = first.n_threads
+        if job_name is None:
+            job_name = 'pack.' + first.job_name
+        spec_dir = first.log_dir
+        if spec_dir is None:
+            spec_dir = first.working_dir if first.working_dir else os.getcwd()
+        # NB the spec-file is only written when the job is submitted
+        base_fname = os.path.join(spec_dir, '{0}_{1}'.format(
+            job_name, uuid.uuid4().hex[:8]))
+        spec_fname = base_fname + '.json'
+        runner, tasks = self._pack_runner(jobs)
+        for itask, task in enumerate(tasks):
+            task.update(working_dir=jobs[itask].working_dir,
+                        n_threads=jobs[itask].n_threads,
+                        log='{:s}_{:d}.log'.format(base_fname, itask))
+        spec = dict(n_workers=max(1, n_threads // first.n_threads),
+                    tasks=tasks, results=base_fname + '_results.json')
+        packed = ClusterJob(runner + ' ' + spec_fname,
+                            self.proj_name, queue=first.queue,
+                            n_threads=n_threads, job_name=job_name,
+                            log_dir=first.log_dir,
+                            working_dir=first.working_dir,
+                            cluster=self.cluster,
+                            inputs=[fname for job in jobs
+                                    for fname in job.inputs],
+                            outputs=[fname for job in jobs
+                                     for fname in job.outputs])
+        packed._packed_jobs = list(jobs)
+        packed._pack_spec = dict(spec, fname=spec_fname,
+                                 index=list(range(len(jobs))))
+        return packed
+
+    def _pack_runner(self, jobs):
+        """The command running a spec-file of packed jobs, and their tasks
+
+        By default, the shell commands of the jobs are run by
+        `stormdb.runner`; batches with their own runner (which must write
+        the same results) override this.
+        """
+        return 'python -m stormdb.runner', [dict(cmd=job.cmd) for job in jobs]
+
+    def distribute(self, queues):
+        """Spread the unsubmitted jobs over queues, based on their load.
+
+        Each job is moved to the queue with the most free slots (left after
+        the jobs moved before it) among those that can run it, given its
+        threads and memory. Once all queues are full, jobs go to the queue
+        with the fewest waiting slots per slot in the queue. Jobs needing
+        most slots are placed first.
+
+        Parameters
+        ----------
+        queues : list of str
+            The queues the jobs may run in, in order of preference.
+        """
+        jobs = sorted([job for job in self._joblist if not job._submitted],
+                      key=lambda job: -job.n_threads)
+        # threads are given by the memory for jobs with a total memory
+        selected = self.cluster._select_queues(
+            [(1 if job.total_memory is not None else job.n_threads,
+              job.total_memory) for job in jobs], list(queues))
+        counts = dict()
+        for job, queue in zip(jobs, selected):
+            if queue != job.queue:
+                job._configure(queue, 1 if job.total_memory is not None
+                               else job.n_threads, job.total_memory)
+            counts[queue] = counts.get(queue, 0) + 1
+        self.logger.info('Jobs per queue: {0}'.format(', '.join(
+            '{0}: {1:d}'.format(queue, counts[queue]) for queue in queues
+            if queue in counts)))
+
     def add_job(self, cmd, **kwargs):
         """This is replaced in __init__ by ClusterJob.__doc__!
         """
+        kwargs.setdefault('cluster', self.cluster)
         self._joblist += [ClusterJob(cmd, self.proj_name, **kwargs)]
 
     @property
     def status(self):
         """Print status of cluster jobs."""
+        # query the scheduler once for all jobs in the batch
+        states = self.cluster._job_states(
+            [job._jobid for job in self._joblist if job._submitted])
         for ij, job in enumerate(self._joblist):
+            job._check_status(states)
             self.logger.info('#{ij:d} ({jid:}): '
                              '{jst}'.format(
-                                 ij=ij + 1, jid=job._jobid, jst=job.status))
+                                 ij=ij + 1, jid=job._jobid,
+                                 jst=job._status_msg))
             self.logger.debug('\t{0}'.format(job.cmd))
 
-    def submit(self, fake=False):
+    @property
+    def accounting(self):
+        """Resource usage of the finished jobs in the batch.
+
+        A list with a dict per finished job: the accounting record (see
+        `ClusterJob.accounting`) extended with the 'jobid', 'job_name',
+        'queue', 'n_threads' and 'memory_requested' (bytes) of the job.
+        Compare 'maxvmem' to 'memory_requested' to right-size jobs. The
+        cluster is queried once for all jobs.
+        """
+        self._get_poller().poll(self._joblist)
+        table = []
+        for job in self._joblist:
+            if job._accounting is None:
+                continue
+            row = dict(jobid=job._jobid, job_name=job.job_name,
+                       queue=job.queue, n_threads=job.n_threads,
+                       memory_requested=job.memory_requested)
+            row.update(job._accounting)
+            table.append(row)
+        return table
+
+    def right_size(self, apply=False, percentile=95.):
+        """Suggest (or apply) resources for the jobs from past usage.
+
+        See `ClusterJob.suggest_resources`. Jobs for which there is not
+        enough history are left unchanged.
+
+        Parameters
+        ----------
+        apply : bool
+            If True, change the resources of the (unsubmitted) jobs. If
+            False (default), only show the suggestions.
+        percentile : float
+            The percentile (0-100) of past resource use to plan for
+            (default: 95).
+
+        Returns
+        -------
+        suggestions : list of dict | None
+            The suggestion for each job (None if not enough history).
+        """
+        history = JobHistory()
+        suggestions = []
+        for ij, job in enumerate(self._joblist):
+            suggestion = None
+            if not job._submitted:
+                suggestion = job.suggest_resources(percentile=percentile,
+                                                   history=history)
+            suggestions.append(suggestion)
+            if suggestion is None:
+                continue
+            self.logger.info(
+                '#{ij:d} ({name:s}): {q:s}, {n:d} threads{mem:s} --> '
+                '{sq:s}, {sn:d} threads{smem:s}'.format(
+                    ij=ij + 1, name=job.job_name, q=job.queue,
+                    n=job.n_threads, sq=suggestion['queue'],
+                    sn=suggestion['n_threads'],
+                    mem=(', ' + job.total_memory if job.total_memory
+                         else ''),
+                    smem=(', ' + suggestion['total_memory']
+                          if suggestion['total_memory'] else '')))
+            if apply:
+                try:
+                    job.apply_resources(suggestion)
+                except ValueError as err:  # e.g., queue lacks threaded PE
+                    self.logger.error('Could not apply resources to job '
+                                      '#{0}: {1}'.format(ij + 1, err))
+        return suggestions
+
+    def plan(self, incremental=False, percentile=50., history=None):
+        """Estimate the cost of the batch before submitting it.
+
+        The slot-hours and makespan are estimated from the runtimes of past
+        jobs with the same job name (see `JobHistory.suggest`). The jobs are
+        scheduled (on paper) in submission order on the slots of their
+        queue: those that are free now, and those in use by other jobs,
+        which are assumed to free up after a typical job of the batch in the
+        queue. Jobs start after the jobs they depend on. Jobs without enough
+        history are counted, but take no time.
+
+        Parameters
+        ----------
+        incremental : bool | str
+            If True or 'hash', leave out the jobs that would be skipped as
+            up to date, see `submit`. Default: False.
+        percentile : float
+            The percentile (0-100) of past runtimes to plan with (default:
+            50, i.e., the median).
+        history : instance of JobHistory | None
+            The resource history to use. If None, the default one is used.
+
+        Returns
+        -------
+        plan : dict
+            The estimates for each queue in 'queues': a dict with the number
+            of jobs ('n_jobs'), of jobs without history ('n_unknown'), the
+            'slot_hours' and 'memory' (bytes) requested and the 'makespan'
+            (hours, None if the load of the queue is unknown). The
+            'makespan' of the whole batch, and the up-to-date jobs that
+            would be 'skipped'.
+        """
+        if incremental not in (False, True, 'hash'):
+            raise ValueError('incremental must be True, False or \'hash\'.')
+        if history is None:
+            history = JobHistory()
+
+        skipped = []
+        if incremental:
+            saved = [(job._skipped, job._status_msg) for job in self._joblist]
+            for job in self._joblist:
+                job._skipped = False
+            self._skip_up_to_date(incremental == 'hash', fake=True)
+            skipped = [job for job in self._joblist if job._skipped]
+            for job, (was_skipped, status_msg) in zip(self._joblist, saved):
+                job._skipped, job._status_msg = was_skipped, status_msg
+        not_run = set(skipped)
+        jobs = [job for job in self._joblist
+                if not job._submitted and job not in not_run]
+
+        hours = dict()  # estimated runtime of each job, None if unknown
+        for job in jobs:
+            usage = history.suggest(job.job_name,
+                                    input_size=job._input_size(),
+                                    percentile=percentile,
+                                    cluster=self.cluster.name)
+            hours[job] = None if usage is None else usage['wallclock'] / 3600.
+
+        queues = dict()
+        for job in jobs:
+            stats = queues.setdefault(job.queue, dict(
+                n_jobs=0, n_unknown=0, slot_hours=0., memory=0.,
+                makespan=None))
+            stats['n_jobs'] += 1
+            stats['memory'] += job.memory_requested
+            if hours[job] is None:
+                stats['n_unknown'] += 1
+            else:
+                stats['slot_hours'] += job.n_threads * hours[job]
+
+        # the times (hours from now) at which the slots of each queue free up
+        loads = self.cluster._queue_loads()
+        slots = dict()
+        for queue in queues:
+            n_free, n_total = loads.get(queue, (0, 0))
+            known = sorted(hours[job] for job in jobs
+                           if job.queue == queue and hours[job] is not None)
+            busy = known[len(known) // 2] if len(known) > 0 else 0.
+            slots[queue] = ([0.] * max(n_free, 0) +
+                            [busy] * max(n_total - n_free, 0))
+            heapq.heapify(slots[queue])
+
+        finish = dict()
+        remaining = jobs
+        while len(remaining) > 0:
+            # jobs whose dependencies (if any) are already scheduled
+            wave = [job for job in remaining
+                    if not any(dep in remaining for dep in job.depends_on)]
+            if len(wave) == 0:
+                break  # circular dependencies, see submit
+            remaining = [job for job in remaining if job not in wave]
+            for job in wave:
+                if len(slots[job.queue]) == 0:
+                    continue  # load unknown
+                ready = max([finish.get(dep, 0.) for dep in job.depends_on] +
+                            [0.])
+                n_slots = min(job.n_threads, len(slots[job.queue]))
+                start = max([ready] + [heapq.heappop(slots[job.queue])
+                                       for _ in range(n_slots)])
+                finish[job] = start + (hours[job] or 0.)
+                for _ in range(n_slots):
+                    heapq.heappush(slots[job.queue], finish[job])
+                stats = queues[job.queue]
+                stats['makespan'] = max(stats['makespan'] or 0.,
+                                        finish[job])
+
+        self.logger.info('{:d} jobs to submit, {:d} up to date.'.format(
+            len(jobs), len(skipped)))
+        for queue, stats in sorted(queues.items()):
+            self.logger.info(
+                '{q:s}: {n:d} jobs ({u:d} without history), {sh:.1f} '
+                'slot-hours, {mem:s} memory, makespan {ms:s}'.format(
+                    q=queue, n=stats['n_jobs'], u=stats['n_unknown'],
+                    sh=stats['slot_hours'],
+                    mem=_format_memory(stats['memory']),
+                    ms=('unknown' if stats['makespan'] is None else
+                        '{:.1f} hours'.format(stats['makespan']))))
+        makespans = [stats['makespan'] for stats in queues.values()
+                     if stats['makespan'] is not None]
+        return dict(queues=queues, skipped=skipped,
+                    makespan=max(makespans) if len(makespans) > 0 else None)
+
+    def _get_poller(self, poll_interval=5.):
+        """Get the poller shared by all waiting methods of the batch"""
+        if self._poller is None:
+            self._poller = _JobPoller(self.cluster, logger=self.logger)
+        self._poller.poll_interval = poll_interval
+        self._poller.retry_policy = self.retry_policy
+        self._poller.journal = self._journal
+        return self._poller
+
+    def as_completed(self, timeout=None, poll_interval=5.):
+        """Iterate over the submitted jobs of the batch as they finish.
+
+        Jobs that have already finished are yielded first. Use the
+        `exit_status` attribute of the jobs to check for failures. Failed
+        jobs are resubmitted according to `retry_policy` (if set, see
+        `submit`), and yielded once they succeed or are not retried anymore.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Maximum time to wait (in seconds). If None (default), wait until
+            all jobs have finished.
+        poll_interval : float
+            Initial time between status checks (in seconds, default: 5). The
+            interval grows while nothing changes.
+
+        Yields
+        ------
+        job : instance of ClusterJob
+            The next finished job.
+
+        Raises
+        ------
+        TimeoutError
+            If the jobs have not all finished within the timeout.
+        """
+        poller = self._get_poller(poll_interval)
+        for job in poller.iter_finished(self._joblist, timeout=timeout):
+            yield job
+
+    def wait(self, timeout=None, poll_interval=5.):
+        """Wait for all submitted jobs in the batch to finish.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Maximum time to wait (in seconds). If None (default), wait until
+            all jobs have finished.
+        poll_interval : float
+            Initial time between status checks (in seconds, default: 5). The
+            interval grows while nothing changes.
+
+        Returns
+        -------
+        finished : bool
+            True if all jobs finished, False if the timeout expired.
+        """
+        try:
+            finished = list(self.as_completed(timeout=timeout,
+                                              poll_interval=poll_interval))
+        except TimeoutError:
+            return False
+        n_failed = len([job for job in finished if job._failed()])
+        self.logger.info('{:d} jobs finished, {:d} failed.'.format(
+            len(finished), n_failed))
+        return True
+
+    async def watch(self, timeout=None, poll_interval=5.):
+        """Asynchronously iterate over the submitted jobs as they finish.
+
+        Like `as_completed`, but for use in an asyncio event loop: ``async
+        for job in batch.watch(): ...``. The jobs of all batches watched in
+        the same event loop (by the same user, on the same cluster) are
+        polled together, without blocking the loop.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Maximum time to wait (in seconds). If None (default), wait until
+            all jobs have finished.
+        poll_interval : float
+            Initial time between status checks (in seconds, default: 5). The
+            interval grows while nothing changes.
+
+        Yields
+        ------
+        job : instance of ClusterJob
+            The next finished job.
+
+        Raises
+        ------
+        TimeoutError
+            If the jobs have not all finished within the timeout.
+        """
+        loop = asyncio.get_event_loop()
+        poller = self._get_poller(poll_interval)
+        shared = _SharedPoller.get(self.cluster)
+        queue = asyncio.Queue()
+        waiting = set()
+        for job in self._joblist:
+            if poller.is_finished(job):
+                yield job
+            elif job._submitted or job._held_for:
+                waiting.add(job)
+        shared.watch([job for job in waiting if job._submitted], queue,
+                     poll_interval)
+
+        async def _release_held():
+            # submit the held jobs whose dependencies have succeeded
+            not_run, released = await loop.run_in_executor(
+                None, poller._release_held, list(waiting))
+            if len(released) > 0:
+                shared.watch(released, queue, poll_interval)
+            for job in not_run:
+                queue.put_nowait((job, True))
+
+        async def _resubmit_later(job, delay):
+            await asyncio.sleep(delay)
+            if await loop.run_in_executor(None, poller._resubmit, job):
+                shared.watch([job], queue, poll_interval)
+            else:
+                shared.release(job)
+                queue.put_nowait((job, True))
+
+        retries = []
+        deadline = None if timeout is None else loop.time() + timeout
+        try:
+            await _release_held()
+            while len(waiting) > 0:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(0., deadline - loop.time())
+                try:
+                    job, final = await asyncio.wait_for(queue.get(),
+                                                        remaining)
+                except asyncio.TimeoutError:
+                    raise TimeoutError('Jobs did not finish within {0} '
+                                       'seconds.'.format(timeout))
+                delay = None if final else poller._handle_finished(job)
+                if delay is not None:
+                    shared.hold(job)
+                    retries.append(asyncio.ensure_future(
+                        _resubmit_later(job, delay)))
+                    continue
+                poller._finished.add(job)
+                waiting.discard(job)
+                if any(len(other._held_for) > 0 for other in waiting):
+                    await _release_held()
+                yield job
+        finally:
+            shared.unwatch(waiting)
+            for task in retries:
+                task.cancel()
+
+    async def submit_async(self, fake=False, n_workers=1, max_rate=None,
+                           array=False, retry=None, incremental=False):
+        """Submit a batch of jobs, without blocking the event loop.
+
+        The submission runs in a worker thread, see `submit` for the
+        parameters and return value: ``failed = await batch.submit_async()``.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(
+            self.submit, fake=fake, n_workers=n_workers, max_rate=max_rate,
+            array=array, retry=retry, incremental=incremental))
+
+    def submit(self, fake=False, n_workers=1, max_rate=None, array=False,
+               retry=None, incremental=False):
         """Submit a batch of jobs.
 
+        Submission failures of individual jobs do not abort the batch: they
+        are logged, and returned once all jobs have been attempted. Jobs are
+        always submitted after the jobs in the batch they depend on. Jobs
+        that have been submitted before are skipped.
+
         Parameters
         ----------
         fake : bool
             If True, show what would be submitted (but don't actually submit).
+        n_workers : int
+            Number of jobs to submit concurrently (default: 1, i.e., serially).
+        max_rate : float | None
+            Maximum number of submissions per second, across all workers. If
+            None (default), submissions are not rate limited.
+        array : bool
+            If True, submit jobs with the same name and resources as a single
+            array job (not supported on all clusters). Default: False.
+        retry : int | instance of RetryPolicy | None
+            Policy for resubmitting jobs that fail, applied while waiting for
+            the batch (see `wait` and `as_completed`). An int gives the
+            maximum number of attempts per job, with the defaults of
+            `RetryPolicy`. If None (default), the current `retry_policy` of
+            the batch is kept (none, unless set). With a retry policy, jobs
+            depending on other jobs of the batch are held, and submitted
+            while waiting once those have succeeded (possibly after
+            retries).
+        incremental : bool | str
+            If True, skip jobs whose outputs are up to date: they all exist
+            and none is older than the inputs of the job. If 'hash', the
+            outputs are also up to date if the contents of the inputs are
+            those the outputs were made from (e.g., if the inputs have just
+            been copied). Jobs depending on jobs that are run are run too.
+            Default: False.
+
+        Returns
+        -------
+        failed : list of tuple
+            A (job, error message)-tuple for each job that failed to submit.
         """
         for job in self._joblist:
-            if type(job) is ClusterJob:
-                job.submit(fake=fake)
-            else:
+            if type(job) is not ClusterJob:
                 raise ValueError('This should never happen, report an Issue!')
+        if not isinstance(n_workers, int) or n_workers < 1:
+            raise ValueError('n_workers must be a positive integer.')
+        if max_rate is not None and max_rate <= 0:
+            raise ValueError('max_rate must be positive (submissions/sec).')
+        if array and not self.cluster._supports_arrays:
+            raise ValueError('Job arrays are not supported on the {0} '
+                             'cluster.'.format(self.cluster.name))
+        if incremental not in (False, True, 'hash'):
+            raise ValueError('incremental must be True, False or \'hash\'.')
+        if isinstance(retry, int):
+            retry = RetryPolicy(max_attempts=retry)
+        if retry is not None:
+            if not isinstance(retry, RetryPolicy):
+                raise ValueError('retry must be an int or a RetryPolicy.')
+            self.retry_policy = retry
+
+        limiter = _RateLimiter(max_rate)
+        for job in self._joblist:
+            job._skipped = False
+        if incremental:
+            n_skipped = self._skip_up_to_date(incremental == 'hash', fake)
+            self.logger.info('{:d} jobs are up to date, not submitted.'.format(
+                n_skipped))
+
+        def _submit_group(jobs):
+            if not fake:
+                limiter.wait()
+            try:
+                if len(jobs) == 1 or fake:
+                    for job in jobs:
+                        job.submit(fake=fake)
+                else:
+                    for job in jobs:
+                        job._write_pack_spec()
+                    jobids = self.cluster._submit_array(jobs)
+                    for job, jobid in zip(jobs, jobids):
+                        job._jobid, job._submitted = jobid, True
+                        job._submit_time = time.time()
+                    print('Array job submitted, job IDs: {0}..{1}'.format(
+                        jobids[0], jobids[-1]))
+            except (RuntimeError, ValueError) as err:
+                return [(job, str(err)) for job in jobs]
+            return [(job, None) for job in jobs]
+
+        results, held = [], []
+        # jobs submitted (or held) before are not submitted again
+        remaining = [job for job in self._joblist if not job._skipped and
+                     job._jobid is None and len(job._held_for) == 0]
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        try:
+            while len(remaining) > 0:
+                # jobs whose dependencies (if any) are already submitted
+                wave = [job for job in remaining
+                        if not any(dep in remaining for dep in job.depends_on)]
+                if len(wave) == 0:
+                    results += [(job, 'Circular job dependencies.')
+                                for job in remaining]
+                    break
+                remaining = [job for job in remaining if job not in wave]
+                if self.retry_policy is not None and not fake:
+                    # the scheduler cannot wait for the retries of a job
+                    for job in wave:
+                        job._held_for = [dep for dep in job.depends_on
+                                         if dep in self._joblist and
+                                         not dep._skipped]
+                        if len(job._held_for) > 0:
+                            job._status_msg = ('Held until the jobs it '
+                                               'depends on have succeeded')
+                            held.append(job)
+                    wave = [job for job in wave if len(job._held_for) == 0]
+
+                groups = [[job] for job in wave]
+                if array:
+                    groups = self._group_array_jobs(wave)
+                if n_workers == 1:
+                    group_results = map(_submit_group, groups)
+                else:
+                    group_results = executor.map(_submit_group, groups)
+                for group_result in group_results:
+                    results += group_result
+        finally:
+            executor.shutdown()
+
+        failed = [(job, err) for job, err in results if err is not None]
+        if not fake:
+            self._journal_submitted([job for job, err in results
+                                     if err is None])
+            self.logger.info('{:d} of {:d} jobs submitted.'.format(
+                len(results) - len(failed), len(results) + len(held)))
+            if len(held) > 0:
+                self.logger.info('{:d} jobs are held until the jobs they '
+                                 'depend on have succeeded.'.format(
+                                     len(held)))
+        for job, err in failed:
+            self.logger.error('Submission failed for: {0}\n{1}'.format(
+                job.cmd, err))
+        return failed
+
+    def _skip_up_to_date(self, use_hash=False, fake=False):
+        """Mark the unsubmitted jobs that are up to date as skipped"""
+        digests = DigestStore() if use_hash else None
+        stale = dict()
+
+        def _is_stale(job):
+            # run jobs that are out of date, or depend on jobs that are run
+            if job not in stale:
+                stale[job] = True  # until known, also ends circular checks
+                stale[job] = any(
+                    _is_stale(dep) for dep in job.depends_on
+                    if isinstance(dep, ClusterJob) and not dep._submitted
+                ) or not job.is_up_to_date(digests)
+            return stale[job]
+
+        n_skipped = 0
+        for job in self._joblist:
+            if job._submitted:
+                continue
+            if _is_stale(job):
+                if digests is not None and not fake:
+                    # record the inputs once the outputs are made
+                    digests.forget(job.outputs)
+                    job._digests = digests
+            else:
+                job._skipped = True
+                job._status_msg = 'Up to date, not submitted'
+                n_skipped += 1
+        if digests is not None and not fake:
+            digests.save()
+        return n_skipped
+
+    @staticmethod
+    def _group_array_jobs(jobs):
+        """Group jobs that can be submitted together as an array job"""
+        groups = dict()
+        singles = []
+        for job in jobs:
+            if len(job.depends_on) > 0 or job._submitted:
+                singles.append([job])
+                continue
+            key = (job.job_name, job.queue, job.n_threads, job.total_memory,
+                   job._log_name_prefix)
+            groups.setdefault(key, []).append(job)
+        return list(groups.values()) + singles
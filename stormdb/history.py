@@ -0,0 +1,203 @@
+"""
+=========================
+Resource usage history of cluster jobs, for right-sizing new jobs
+=========================
+
+"""
+# Author: Chris Bailey <cjb@cfin.au.dk>
+#
+# License: MIT
+import os
+import json
+import math
+import time
+
+from .base import _get_cache_dir
+
+
+def _percentile(values, percentile):
+    """Percentile (0-100) of a list of values, by linear interpolation"""
+    values = sorted(values)
+    pos = (len(values) - 1) * percentile / 100.
+    lower = int(math.floor(pos))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+class JobHistory(object):
+    """Resource usage of finished cluster jobs, per type of job.
+
+    Finished jobs are recorded by their job name (such as 'maxfilter' or
+    'recon-all') and the name of the cluster they ran on, in a file with
+    one JSON record per line. Jobs on different clusters (e.g., a
+    LocalCluster) are thus not mixed up.
+
+    Parameters
+    ----------
+    fname : str | None
+        The history file. If None (default), 'job_history.jsonl' in the
+        stormdb cache directory (~/.stormdb) is used.
+    max_records : int
+        The maximum number of (most recent) records to use per job name
+        (default: 500). Older records are dropped when the file is compacted.
+
+    Attributes
+    ----------
+    fname : str
+        The history file.
+    """
+
+    def __init__(self, fname=None, max_records=500):
+        if fname is None:
+            fname = os.path.join(_get_cache_dir(), 'job_history.jsonl')
+        self.fname = fname
+        self.max_records = max_records
+        self._cache = (None, [])  # (size, mtime) of the file, entries
+
+    def record(self, job_name, record, n_threads, memory_requested,
+               input_size=None, cluster=None):
+        """Add the accounting record of a finished job to the history.
+
+        Parameters
+        ----------
+        job_name : str
+            The name of the job (type).
+        record : dict
+            The accounting record, see `ClusterJob.accounting`.
+        n_threads : int
+            The number of threads (slots) requested.
+        memory_requested : float
+            The memory requested (in bytes).
+        input_size : int | None
+            Total size of the input files of the job (in bytes), if known.
+        cluster : str | None
+            The name of the cluster the job ran on.
+        """
+        entry = dict(job_name=job_name, cluster=cluster, time=time.time(),
+                     n_threads=n_threads, memory_requested=memory_requested,
+                     input_size=input_size)
+        for key in ('exit_status', 'wallclock', 'cpu', 'maxvmem'):
+            entry[key] = record.get(key)
+        with open(self.fname, 'a') as fid:
+            fid.write(json.dumps(entry) + '\n')
+        # keep the file from growing without bounds
+        if os.path.getsize(self.fname) > 10 * 1024 ** 2:
+            self.compact()
+
+    def _read(self):
+        if not os.path.exists(self.fname):
+            return []
+        # the file is only parsed again once it has changed
+        stat = os.stat(self.fname)
+        if self._cache[0] == (stat.st_size, stat.st_mtime):
+            return list(self._cache[1])
+        entries = []
+        with open(self.fname, 'r') as fid:
+            for line in fid:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue  # e.g., a partially written line
+        self._cache = ((stat.st_size, stat.st_mtime), entries)
+        return list(entries)
+
+    def get_records(self, job_name, successful=True, cluster=None):
+        """Get the most recent records of a job (type).
+
+        Parameters
+        ----------
+        job_name : str
+            The name of the job (type).
+        successful : bool
+            If True (default), only include jobs that exited with status 0.
+        cluster : str | None
+            The name of the cluster the jobs ran on.
+
+        Returns
+        -------
+        records : list of dict
+            The records, oldest first.
+        """
+        records = [entry for entry in self._read()
+                   if entry['job_name'] == job_name and
+                   entry.get('cluster') == cluster and
+                   entry.get('wallclock') is not None and
+                   (not successful or entry.get('exit_status') == 0)]
+        return records[-self.max_records:]
+
+    def compact(self):
+        """Drop all but the most recent `max_records` records per job name."""
+        entries = self._read()
+        counts = dict()
+        keep = []
+        for entry in reversed(entries):
+            key = (entry.get('cluster'), entry['job_name'])
+            counts[key] = counts.get(key, 0) + 1
+            if counts[key] <= self.max_records:
+                keep.append(entry)
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as fid:
+            for entry in reversed(keep):
+                fid.write(json.dumps(entry) + '\n')
+        os.rename(tmp_fname, self.fname)
+
+    def suggest(self, job_name, input_size=None, percentile=95.,
+                headroom=1.2, min_records=5, cluster=None):
+        """Estimate the resources needed by a job from the history.
+
+        Peak memory and wallclock time of past jobs are scaled linearly with
+        the size of the inputs (if known for both the past and the new job),
+        before taking the percentile.
+
+        Parameters
+        ----------
+        job_name : str
+            The name of the job (type).
+        input_size : int | None
+            Total size of the input files (in bytes) of the new job.
+        percentile : float
+            The percentile (0-100) of past resource use to plan for
+            (default: 95).
+        headroom : float
+            Factor to multiply the estimated peak memory with (default: 1.2).
+        min_records : int
+            Minimum number of past successful jobs needed (default: 5).
+        cluster : str | None
+            The name of the cluster the new job is to run on.
+
+        Returns
+        -------
+        usage : dict | None
+            The estimated peak 'memory' (bytes), 'wallclock' (seconds) and
+            the number of threads effectively used ('n_threads'), as well as
+            the number of records used ('n_records'). None if there are too
+            few records.
+        """
+        records = self.get_records(job_name, cluster=cluster)
+        if len(records) < min_records:
+            return None
+
+        def _scaled(key, record):
+            if input_size and record.get('input_size'):
+                return record[key] * float(input_size) / record['input_size']
+            return record[key]
+
+        # average number of busy CPUs during each job
+        parallelism = [record['cpu'] / record['wallclock'] for record in
+                       records if record['wallclock'] > 0]
+        n_threads = 1
+        if len(parallelism) > 0:
+            # tolerate some overhead, e.g., 1.05 busy CPUs is one thread
+            n_threads = max(1, int(math.ceil(
+                _percentile(parallelism, percentile) - 0.1)))
+        # NB the peak memory of tasks run in a shared worker may be unknown
+        memories = [_scaled('maxvmem', record) for record in records
+                    if record.get('maxvmem') is not None]
+        if len(memories) == 0:
+            return None
+        return dict(
+            memory=headroom * _percentile(memories, percentile),
+            wallclock=_percentile(
+                [_scaled('wallclock', record) for record in records],
+                percentile),
+            n_threads=n_threads, n_records=len(records))
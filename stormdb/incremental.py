@@ -0,0 +1,129 @@
+"""
+=========================
+Up-to-date checks of job outputs, for incremental batch submission
+=========================
+
+"""
+# Author: Chris Bailey <cjb@cfin.au.dk>
+#
+# License: MIT
+import os
+import json
+import hashlib
+
+from .base import _get_cache_dir
+
+
+class DigestStore(object):
+    """Content digests of the inputs jobs were last run on.
+
+    The digest of each file is kept with its size and modification time, so
+    that files are only read (hashed) again once they have changed.
+
+    Parameters
+    ----------
+    fname : str | None
+        The file to store the digests in. If None (default),
+        'input_digests.json' in the stormdb cache directory (~/.stormdb) is
+        used.
+
+    Attributes
+    ----------
+    fname : str
+        The digest file.
+    """
+
+    def __init__(self, fname=None):
+        if fname is None:
+            fname = os.path.join(_get_cache_dir(), 'input_digests.json')
+        self.fname = fname
+        self._files = dict()  # path: [size, mtime, digest]
+        self._outputs = dict()  # outputs key: digest of the inputs
+        if os.path.exists(fname):
+            with open(fname, 'r') as fid:
+                data = json.load(fid)
+            self._files = data.get('files', dict())
+            self._outputs = data.get('outputs', dict())
+
+    def save(self):
+        """Write the digests to file"""
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as fid:
+            json.dump(dict(files=self._files, outputs=self._outputs), fid)
+        os.rename(tmp_fname, self.fname)
+
+    def file_digest(self, fname):
+        """Return the SHA1-digest of the contents of a file"""
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        known = self._files.get(fname)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime]:
+            return known[2]
+        sha1 = hashlib.sha1()
+        with open(fname, 'rb') as fid:
+            for chunk in iter(lambda: fid.read(1 << 20), b''):
+                sha1.update(chunk)
+        self._files[fname] = [stat.st_size, stat.st_mtime, sha1.hexdigest()]
+        return sha1.hexdigest()
+
+    def digest(self, inputs):
+        """Return the combined digest of (the contents of) input files"""
+        sha1 = hashlib.sha1()
+        for fname in sorted(os.path.abspath(fname) for fname in inputs):
+            sha1.update('{0}:{1}\n'.format(
+                fname, self.file_digest(fname)).encode('utf-8'))
+        return sha1.hexdigest()
+
+    @staticmethod
+    def _key(outputs):
+        return '\n'.join(sorted(os.path.abspath(fname) for fname in outputs))
+
+    def get(self, outputs):
+        """The digest of the inputs the outputs were made from (or None)"""
+        return self._outputs.get(self._key(outputs))
+
+    def set(self, outputs, digest):
+        self._outputs[self._key(outputs)] = digest
+
+    def forget(self, outputs):
+        self._outputs.pop(self._key(outputs), None)
+
+
+def is_up_to_date(inputs, outputs, digests=None):
+    """Check whether the outputs of a job are up to date with its inputs.
+
+    Outputs are up to date if they all exist, and (like Make) none of them
+    is older than any of the inputs. If digests are given, outputs made
+    from inputs with the same contents as now are also up to date (e.g.,
+    if the inputs were copied or touched), while outputs made from inputs
+    with other contents are not. The digests are updated accordingly.
+
+    Parameters
+    ----------
+    inputs : list of str
+        The input files of the job.
+    outputs : list of str
+        The output files of the job.
+    digests : instance of DigestStore | None
+        The digests of the inputs the outputs were made from. If None
+        (default), only the modification times are compared.
+
+    Returns
+    -------
+    up_to_date : bool
+        True if the outputs are up to date. Jobs without outputs, or with
+        missing inputs, are never up to date.
+    """
+    if len(outputs) == 0 or not all(os.path.exists(fname)
+                                    for fname in outputs + inputs):
+        return False
+    if digests is not None:
+        known = digests.get(outputs)
+        if known is not None:
+            return known == digests.digest(inputs)
+    up_to_date = (len(inputs) == 0 or
+                  min(os.path.getmtime(fname) for fname in outputs) >=
+                  max(os.path.getmtime(fname) for fname in inputs))
+    if up_to_date and digests is not None:
+        digests.set(outputs, digests.digest(inputs))
+    return up_to_date
@@ -6,6 +6,9 @@
 # License: MIT
 
 from .maxfilter import Maxfilter
+from .maxfilter_log import parse_maxfilter_log, summarize_maxfilter_logs
+from .headpos import (read_head_pos, summarize_head_pos,
+                      summarize_head_positions)
 from .mne_python import MNEPython
 from .freesurfer import Freesurfer, convert_flash_mris_cfin
 from .simnibs import SimNIBS
@@ -57,6 +57,9 @@ class Freesurfer(ClusterBatch):
         'scratch/qsub_logs' in the project folder.
     verbose : bool
         If True, print out extra information as we go (default: False).
+    cluster : str | instance of Cluster | None
+        The cluster (scheduler backend) to run the jobs on, e.g. 'local' for
+        the current machine. If None (default), the SGE-cluster is used.
 
     Attributes
     ----------
@@ -65,8 +68,9 @@ class Freesurfer(ClusterBatch):
     """
 
     def __init__(self, proj_name=None, subjects_dir=None, t1_series=None,
-                 log_dir='scratch/qsub_logs', verbose=False):
-        super(Freesurfer, self).__init__(proj_name, verbose=verbose)
+                 log_dir='scratch/qsub_logs', verbose=False, cluster=None):
+        super(Freesurfer, self).__init__(proj_name, verbose=verbose,
+                                         cluster=cluster)
 
         if subjects_dir is None:
             if 'SUBJECTS_DIR' in os.environ.keys():
@@ -188,6 +192,7 @@ class Freesurfer(ClusterBatch):
             raise RuntimeError(
                 'Subject {0} not found in database!'.format(subject))
 
+        subject_id = subject
         if analysis_name is not None:
             if not isinstance(analysis_name, string_types):
                 raise ValueError('Analysis name suffix must be a string.')
@@ -230,7 +235,8 @@ class Freesurfer(ClusterBatch):
             cmd += ' -hemi {0}'.format(hemi)
 
         cmd += ' -{}'.format(' -'.join(directives))
-        self.add_job(cmd, job_name='recon-all', **job_options)
+        self.add_job(cmd, job_name='recon-all', subject=subject_id,
+                     **job_options)
 
     def create_bem_surfaces(self, subject, analysis_name=None,
                             flash5=None, flash30=None, make_coreg_head=True,
@@ -412,7 +418,8 @@ class Freesurfer(ClusterBatch):
             # mkheadsurf can be as much as 2GB
             job_options.update({'mem_free': '4G'})
 
-        self.add_job(cmd, job_name='cfin_flash_bem', **job_options)
+        self.add_job(cmd, job_name='cfin_flash_bem', subject=subject,
+                     **job_options)
 
     def _create_bem_surfaces_watershed(self, subject, analysis_name=None,
                                        atlas=False, gcaatlas=True,
@@ -461,7 +468,8 @@ class Freesurfer(ClusterBatch):
             # mkheadsurf can be as much as 2GB
             job_options.update({'mem_free': '4G'})
 
-        self.add_job(cmd, job_name='watershed_bem', **job_options)
+        self.add_job(cmd, job_name='watershed_bem', subject=subject,
+                     **job_options)
 
 
 # NB This is a modified version of that found in mne-python/mne/bem.py
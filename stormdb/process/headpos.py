@@ -0,0 +1,145 @@
+"""
+=========================
+Continuous head positions of MEG recordings
+
+Head positions are stored as NumPy arrays (.npy), with a row per time point
+and the columns of MaxFilter's .pos-files (and of mne.chpi.read_head_pos):
+time (sec), rotation quaternion (q1, q2, q3), translation (x, y, z in m),
+goodness of fit, fit error (m) and velocity (m/s).
+=========================
+
+"""
+# Author: Chris Bailey <cjb@cfin.au.dk>
+#
+# License: MIT
+import os
+import os.path as op
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+
+# the statements computing head positions (head_pos) from raw (in a job)
+_HEAD_POS_SCRIPT = ["from mne.chpi import compute_chpi_amplitudes, "
+                    "compute_chpi_locs, compute_head_pos",
+                    "head_pos = compute_head_pos(raw.info, compute_chpi_locs("
+                    "raw.info, compute_chpi_amplitudes(raw)))"]
+
+
+def _read_pos_text(fname):
+    """Read a MaxFilter head position file (text)"""
+    with open(fname, 'r') as fid:
+        # skip the header line(s)
+        lines = [line for line in fid if len(line.split()) > 0 and
+                 line.split()[0].lstrip('+-.')[:1].isdigit()]
+    pos = np.loadtxt(lines, ndmin=2)
+    if pos.shape[1] != 10:
+        raise ValueError('{0} is not a head position file (it has {1:d} '
+                         'columns, not 10)'.format(fname, pos.shape[1]))
+    return pos
+
+
+def read_head_pos(fname, mmap=True):
+    """Read continuous head positions.
+
+    MaxFilter's text files are converted once: the positions are stored in
+    a .npy-file next to them (if possible), which is read instead for as
+    long as it is newer than the text file.
+
+    Parameters
+    ----------
+    fname : str
+        The .npy-file, or the head position file written by MaxFilter
+        (-hp), e.g. 'rest_raw.pos'.
+    mmap : bool
+        If True (default), memory-map .npy-files instead of reading them.
+
+    Returns
+    -------
+    pos : ndarray, shape (n_times, 10)
+        The head positions.
+    """
+    if not fname.endswith('.npy'):
+        npy_fname = op.splitext(fname)[0] + '.npy'
+        if (not op.exists(npy_fname) or
+                op.getmtime(npy_fname) < op.getmtime(fname)):
+            pos = _read_pos_text(fname)
+            try:
+                np.save(npy_fname, pos)
+            except (IOError, OSError):
+                pass  # e.g., no write permission
+            return pos
+        fname = npy_fname
+    return np.load(fname, mmap_mode='r' if mmap else None)
+
+
+def summarize_head_pos(pos):
+    """Summarize the head movement during a recording.
+
+    Parameters
+    ----------
+    pos : ndarray, shape (n_times, 10)
+        The head positions, see `read_head_pos`.
+
+    Returns
+    -------
+    summary : dict
+        The 'duration' (sec) and number of positions ('n_times'), the
+        largest and mean distance from the initial position
+        ('max_displacement' and 'mean_displacement', in mm), the distance
+        moved ('path_length', mm), the largest rotation from the initial
+        orientation ('max_rotation', degrees), the largest velocity
+        ('max_velocity', mm/s), the mean goodness of fit ('mean_gof') and
+        the largest fit error ('max_error', mm).
+    """
+    pos = np.asarray(pos)
+    if pos.ndim != 2 or pos.shape[0] == 0 or pos.shape[1] != 10:
+        raise ValueError('Head positions must be an array of shape '
+                         '(n_times, 10), got {0}'.format(pos.shape))
+    trans = pos[:, 4:7]
+    displacement = np.linalg.norm(trans - trans[0], axis=1)
+    quats = np.c_[np.sqrt(np.maximum(
+        0., 1. - np.sum(pos[:, 1:4] ** 2, axis=1))), pos[:, 1:4]]
+    rotation = 2. * np.arccos(np.clip(np.abs(np.dot(quats, quats[0])),
+                                      0., 1.))
+    return dict(duration=float(pos[-1, 0] - pos[0, 0]), n_times=len(pos),
+                max_displacement=1e3 * float(displacement.max()),
+                mean_displacement=1e3 * float(displacement.mean()),
+                path_length=1e3 * float(np.linalg.norm(
+                    np.diff(trans, axis=0), axis=1).sum()),
+                max_rotation=float(np.degrees(rotation.max())),
+                max_velocity=1e3 * float(pos[:, 9].max()),
+                mean_gof=float(pos[:, 7].mean()),
+                max_error=1e3 * float(pos[:, 8].max()))
+
+
+def _summarize_file(fname):
+    summary = summarize_head_pos(read_head_pos(fname))
+    summary['fname'] = fname
+    return summary
+
+
+def summarize_head_positions(fnames, n_jobs=None):
+    """Summarize the head movement of many recordings (for QA).
+
+    Parameters
+    ----------
+    fnames : list of str
+        The head position files, see `read_head_pos`.
+    n_jobs : int | None
+        The number of processes to read the files in. If None (default),
+        one per CPU.
+
+    Returns
+    -------
+    summaries : list of dict
+        The summary of each file (see `summarize_head_pos`), with the file
+        name as 'fname'.
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs == 1 or len(fnames) < 2:
+        return [_summarize_file(fname) for fname in fnames]
+    with ProcessPoolExecutor(max_workers=min(n_jobs,
+                                             len(fnames))) as executor:
+        return list(executor.map(_summarize_file, fnames,
+                                 chunksize=max(1, len(fnames) // n_jobs)))
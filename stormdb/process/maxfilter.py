@@ -11,19 +11,221 @@ Credits:
 # Author: Chris Bailey <cjb@cfin.au.dk>
 #
 # License: MIT
+import os
 import os.path as op
+import re
+import math
+import json
+import shutil
+import tempfile
 import warnings
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
-from mne.io import Raw
+from mne.io import read_info, read_raw_fif
 from mne.bem import fit_sphere_to_headshape
+from mne.preprocessing import find_bad_channels_maxwell
 
 from .utils import _get_absolute_proj_path
+from .headpos import _HEAD_POS_SCRIPT
+from .maxfilter_log import summarize_maxfilter_logs
 from ..base import (check_destination_writable, check_source_readable,
-                    check_destination_exists, mkdir_p)
+                    check_destination_exists, mkdir_p, _get_cache_dir)
 from ..cluster import ClusterBatch
 
 
+def _acquisition_key(fname):
+    """The name shared by all split parts of a recording (name-1.fif)
+
+    A '-<N>' suffix is only taken for that of a split part if the first part
+    (name.fif) is next to it, so that e.g. run-1.fif and run-2.fif remain
+    different recordings.
+    """
+    fname = op.abspath(fname)
+    match = re.match(r'(.*)-\d+(\.fif(\.gz)?)$', fname)
+    if match is not None and op.exists(match.group(1) + match.group(2)):
+        return match.group(1) + match.group(2)
+    return fname
+
+
+def _fit_origin(fname, params=None):
+    """Fit a sphere to the headshape points of a recording
+
+    Only the measurement info is read. Returns the radius and the origin in
+    head and device coordinates (in mm).
+    """
+    info = read_info(fname, verbose=False)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('error', category=RuntimeWarning)
+        try:
+            r, o_head, o_dev = fit_sphere_to_headshape(
+                info, dig_kinds='auto', units='mm', verbose=False)
+        except RuntimeWarning as warning:
+            raise RuntimeError('Fitting the head origin of {0} failed: '
+                               '{1}'.format(fname, warning))
+    return float(r), [float(o) for o in o_head], [float(o) for o in o_dev]
+
+
+def _find_bad_channels(fname, params=None):
+    """Find the noisy and flat MEG channels of a recording
+
+    The params are passed to find_bad_channels_maxwell.
+    """
+    raw = read_raw_fif(fname, allow_maxshield=True, preload=True,
+                       verbose=False)
+    noisy, flat = find_bad_channels_maxwell(raw, verbose=False,
+                                            **(params or dict()))
+    return sorted(set(noisy + flat))
+
+
+def _maxwell_filter_cmd(in_fname, out_fname, origin, frame, bad, skip, force,
+                        st, st_buflen, st_corr, trans, movecomp, cal, ctc,
+                        chunk=None):
+    """Build a command running the equivalent of MaxFilter in MNE-Python
+
+    The options are those of `Maxfilter.build_cmd` (origin is a string, in
+    mm, and bad a list of channel names). If chunk is given, only the
+    (tmin, tmax)-part of the recording is filtered, and the (start,
+    stop)-part of that is saved, as (tmin, tmax, start, stop) in seconds
+    from the start of the recording and the part (None for the end).
+    """
+    # MaxFilter's device frame is the 'meg' frame of MNE-Python
+    kwargs = dict(origin=tuple(float(o) / 1000. for o in origin.split()),
+                  coord_frame='meg' if frame == 'device' else frame,
+                  calibration=cal, cross_talk=ctc,
+                  skip_by_annotation=('edge', 'bad_acq_skip', 'bad_skip'))
+    if st:
+        kwargs.update(st_duration=st_buflen, st_correlation=st_corr)
+    if trans == 'default':
+        kwargs['destination'] = (0., 0., 0.04)  # as MaxFilter -trans default
+    elif trans is not None:
+        kwargs['destination'] = trans
+    bad = ['MEG' + ch if not ch.startswith('MEG') else ch for ch in bad]
+
+    script = ["from mne.io import read_raw_fif",
+              "from mne.preprocessing import maxwell_filter",
+              "raw = read_raw_fif({0!r}, allow_maxshield=True)".format(
+                  in_fname),
+              "raw.info['bads'] = sorted(set(raw.info['bads'] + "
+              "{0!r}))".format(bad)]
+    if skip is not None:
+        if not isinstance(skip, list):
+            times = [float(t) for t in skip.split()]
+            skip = list(zip(times[::2], times[1::2]))
+        # annotations are timed from the start of the measurement (if known)
+        script += ["t0 = raw.first_time if raw.annotations.orig_time is not "
+                   "None else 0.",
+                   "raw.annotations.append([t0 + t for t in {0!r}], {1!r}, "
+                   "'bad_skip')".format([float(s[0]) for s in skip],
+                                        [float(s[1] - s[0]) for s in skip])]
+    if chunk is not None:
+        script += ["raw.crop({0!r}, {1!r}).load_data()".format(*chunk[:2])]
+    if movecomp:
+        script += _HEAD_POS_SCRIPT
+        kwargs_str = 'head_pos=head_pos, '
+    else:
+        kwargs_str = ''
+    kwargs_str += ', '.join('{0:s}={1!r}'.format(key, val)
+                            for key, val in sorted(kwargs.items()))
+    script += ["raw_sss = maxwell_filter(raw, {0:s})".format(kwargs_str)]
+    if chunk is not None:  # NB the chunks must not share their edge samples
+        script += ["raw_sss.crop({0!r}, {1!r}, include_tmax=False)".format(
+            *chunk[2:])]
+    script += ["raw_sss.save({0!r}, overwrite={1!r})".format(out_fname,
+                                                             bool(force))]
+    return 'python -c "{0:s}"'.format('; '.join(script))
+
+
+def _stitch_cmd(chunk_fnames, out_fname, force):
+    """Build a command concatenating the chunks of a filtered recording"""
+    script = ["import os",
+              "from mne.io import read_raw_fif, concatenate_raws",
+              "raw = concatenate_raws([read_raw_fif(fname) for fname in "
+              "{0!r}])".format(chunk_fnames),
+              # the chunks are continuous, not separate recordings
+              "raw.annotations.delete([ii for ii, desc in enumerate("
+              "raw.annotations.description) if desc in ('BAD boundary', "
+              "'EDGE boundary')])",
+              "raw.save({0!r}, overwrite={1!r})".format(out_fname,
+                                                        bool(force)),
+              "[os.remove(fname) for fname in {0!r}]".format(chunk_fnames)]
+    return 'python -c "{0:s}"'.format('; '.join(script))
+
+
+def _tee_cmd(cmd, logfile):
+    """Copy the output (and errors) of a command to a log file
+
+    The exit status stays that of the command, not of tee.
+    """
+    return 'set -o pipefail; {0} 2>&1 | tee {1}'.format(cmd, logfile)
+
+
+def _chunk_times(duration, chunk_duration, overlap, st_buflen=None):
+    """Split a recording into chunks, see `_maxwell_filter_cmd`
+
+    If st_buflen is given, the chunks and overlaps are whole numbers of
+    tSSS buffers, so that the buffers are those of the whole recording.
+    """
+    if st_buflen is not None:
+        chunk_duration = max(1, round(chunk_duration / st_buflen)) * st_buflen
+        overlap = math.ceil(overlap / st_buflen) * st_buflen
+    n_chunks = max(1, int(duration // chunk_duration))
+    chunks = []
+    for ii in range(n_chunks):
+        start = ii * chunk_duration
+        tmin = max(0., start - overlap)
+        tmax = start + chunk_duration + overlap
+        stop = start + chunk_duration - tmin
+        if ii == n_chunks - 1:  # the last chunk gets the rest
+            tmax, stop = None, None
+        elif tmax > duration:
+            tmax = None
+        chunks.append((tmin, tmax, start - tmin, stop))
+    return chunks
+
+
+class _RecordingCache(object):
+    """Results computed from recordings (e.g. head origins), kept on disk
+
+    Results are stored by the path of the recording, and are only used
+    while its size and modification time, and the parameters used, are
+    unchanged.
+    """
+
+    def __init__(self, name):
+        self.fname = op.join(_get_cache_dir(), name)
+        self._results = dict()  # path: [size, mtime, params, result]
+        if op.exists(self.fname):
+            try:
+                with open(self.fname, 'r') as fid:
+                    self._results = json.load(fid)
+            except ValueError:
+                pass  # e.g., partially written, start afresh
+
+    @staticmethod
+    def _stat(fname):
+        stat = os.stat(fname)
+        return [stat.st_size, stat.st_mtime]
+
+    def get(self, fname, params=None):
+        """The result for a recording, None if not cached"""
+        known = self._results.get(op.abspath(fname))
+        if (known is None or len(known) != 4 or
+                known[:3] != self._stat(fname) + [params]):
+            return None
+        return known[3]
+
+    def set(self, fname, result, params=None):
+        self._results[op.abspath(fname)] = self._stat(fname) + [params,
+                                                                result]
+
+    def save(self):
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as fid:
+            json.dump(self._results, fid)
+        os.rename(tmp_fname, self.fname)
+
+
 class Maxfilter(ClusterBatch):
     """ Object for maxfiltering data from database into StormDB filesystem
 
@@ -35,6 +237,9 @@ class Maxfilter(ClusterBatch):
         List of a priori bad channels (default: empty list)
     verbose : bool
         If True, print out extra information as we go (default: False).
+    cluster : str | instance of Cluster | None
+        The cluster (scheduler backend) to run the jobs on, e.g. 'local' for
+        the current machine. If None (default), the SGE-cluster is used.
 
     Attributes
     ----------
@@ -43,15 +248,173 @@ class Maxfilter(ClusterBatch):
     """
 
     def __init__(self, proj_name, bad=[], log_dir='scratch/qsub_logs',
-                 verbose=False):
-        super(Maxfilter, self).__init__(proj_name, verbose=verbose)
+                 verbose=False, cluster=None):
+        super(Maxfilter, self).__init__(proj_name, verbose=verbose,
+                                        cluster=cluster)
 
         log_dir = _get_absolute_proj_path(log_dir, self.proj_name)
         mkdir_p(log_dir)
 
-        self.info = dict(bad=bad, log_dir=log_dir, io_mapping=[])
+        self.info = dict(bad=bad, log_dir=log_dir, io_mapping=[],
+                         origins=dict(), detected_bad=dict())
         # Consider placing other vars here
 
+    def estimate_origins(self, in_fnames, n_jobs=None, use_cache=True):
+        """Fit the head origins of many recordings concurrently.
+
+        A sphere is fitted to the headshape points in the measurement info
+        of each recording (the data are not read). Split parts of the same
+        recording (name.fif, name-1.fif, ...) share a single fit. The fits
+        are used by `build_cmd` when the origin is None.
+
+        Parameters
+        ----------
+        in_fnames : list of str
+            The input files.
+        n_jobs : int | None
+            The number of processes to fit in. If None (default), one per
+            CPU.
+        use_cache : bool
+            If True (default), reuse the fits of earlier sessions, stored in
+            'head_origins.json' in the stormdb cache directory (~/.stormdb),
+            unless the recording has changed since.
+
+        Returns
+        -------
+        fits : dict
+            The (radius, origin in head coordinates, origin in device
+            coordinates)-tuple of each input file, in mm.
+        """
+        return self._map_recordings(
+            in_fnames, _fit_origin, self.info['origins'],
+            cache_name='head_origins.json' if use_cache else None,
+            n_jobs=n_jobs, what='Estimating head origins')
+
+    def detect_bad_channels(self, in_fnames, n_jobs=None, cluster=None,
+                            use_cache=True, **kwargs):
+        """Detect the noisy and flat MEG channels of many recordings.
+
+        `mne.preprocessing.find_bad_channels_maxwell` is run on each
+        recording, concurrently (once for all split parts of a recording).
+        The channels found are added to the bad channels of the recording
+        by `build_cmd`, so no separate (autobad) MaxFilter pass is needed.
+
+        Parameters
+        ----------
+        in_fnames : list of str
+            The input files.
+        n_jobs : int | None
+            The number of processes to use. If None (default), one per CPU.
+        cluster : str | instance of Cluster | None
+            If not None, run a job per recording on this cluster (e.g., the
+            cluster of the batch), and wait for them to finish, instead of
+            running in processes on the current machine.
+        use_cache : bool
+            If True (default), reuse the channels found in earlier sessions
+            (with the same options), stored in 'bad_channels.json' in the
+            stormdb cache directory (~/.stormdb), unless the recording has
+            changed since.
+        **kwargs : keyword arguments
+            Options for find_bad_channels_maxwell, such as calibration,
+            cross_talk or limit.
+
+        Returns
+        -------
+        bads : dict
+            The list of bad channels of each input file.
+        """
+        return self._map_recordings(
+            in_fnames, _find_bad_channels, self.info['detected_bad'],
+            cache_name='bad_channels.json' if use_cache else None,
+            params=kwargs, n_jobs=n_jobs, cluster=cluster,
+            what='Detecting bad channels')
+
+    def _map_recordings(self, in_fnames, func, results, cache_name=None,
+                        params=None, n_jobs=None, cluster=None, what=''):
+        """Compute func(fname, params) once per recording, in parallel
+
+        The results are stored by recording (see `_acquisition_key`) in
+        results, and if cache_name is given, also on disk. Returns the
+        result of each input file.
+        """
+        groups = dict()  # the input files of each recording
+        for fname in in_fnames:
+            key = _acquisition_key(fname)
+            if key in results:
+                continue
+            if not check_source_readable(fname):
+                raise IOError('Input file {} not readable!'.format(fname))
+            groups.setdefault(key, []).append(fname)
+
+        cache = None
+        if cache_name is not None:
+            cache = _RecordingCache(cache_name)
+            params = json.loads(json.dumps(params))  # as read from the cache
+            for key, fnames in list(groups.items()):
+                for fname in fnames:
+                    result = cache.get(fname, params)
+                    if result is not None:
+                        results[key] = result
+                        del groups[key]
+                        break
+
+        if len(groups) > 0:
+            self.logger.info('{0:s} of {1:d} recordings..'.format(
+                what, len(groups)))
+            first = [fnames[0] for fnames in groups.values()]
+            if n_jobs is None:
+                n_jobs = os.cpu_count() or 1
+            if cluster is not None:
+                computed = self._map_on_cluster(func, first, params, cluster)
+            elif n_jobs == 1 or len(first) == 1:
+                computed = [func(fname, params) for fname in first]
+            else:
+                with ProcessPoolExecutor(
+                        max_workers=min(n_jobs, len(first))) as executor:
+                    computed = list(executor.map(func, first,
+                                                 [params] * len(first)))
+            for (key, fnames), result in zip(groups.items(), computed):
+                results[key] = result
+                if cache is not None:
+                    for fname in fnames:
+                        cache.set(fname, result, params)
+            if cache is not None:
+                cache.save()
+            self.logger.info('[done]')
+        return dict((fname, results[_acquisition_key(fname)])
+                    for fname in in_fnames)
+
+    def _map_on_cluster(self, func, fnames, params, cluster):
+        """Compute func(fname, params) in a cluster job per file"""
+        batch = ClusterBatch(self.proj_name, cluster=cluster)
+        out_dir = tempfile.mkdtemp(dir=self.info['log_dir'])
+        out_fnames = []
+        for ii, fname in enumerate(fnames):
+            out_fnames.append(op.join(out_dir, '{:d}.json'.format(ii)))
+            cmd = ('python -c "import json; from {mod:s} import {func:s}; '
+                   'json.dump({func:s}({fname!r}, {params!r}), '
+                   'open({out!r}, \'w\'))"'.format(
+                       mod=__name__, func=func.__name__, fname=fname,
+                       params=params, out=out_fnames[-1]))
+            batch.add_job(cmd, job_name=func.__name__.strip('_'),
+                          log_dir=self.info['log_dir'], working_dir=out_dir,
+                          inputs=[fname], outputs=[out_fnames[-1]])
+        try:
+            failed = batch.submit()
+            if len(failed) == 0:
+                batch.wait()
+            results = []
+            for fname, out_fname in zip(fnames, out_fnames):
+                if not op.exists(out_fname):
+                    raise RuntimeError('Job for {0} failed, see the logs in '
+                                       '{1}'.format(fname,
+                                                    self.info['log_dir']))
+                with open(out_fname, 'r') as fid:
+                    results.append(json.load(fid))
+        finally:
+            shutil.rmtree(out_dir)
+        return results
+
     def build_cmd(self, in_fname, out_fname, origin='0 0 40',
                   frame='head', bad=None, autobad='off', skip=None,
                   force=False, st=False, st_buflen=16.0,
@@ -60,11 +423,15 @@ class Maxfilter(ClusterBatch):
                   hpisubt=None, hpicons=True, linefreq=None,
                   cal=None, ctc=None, mx_args='',
                   maxfilter_bin='/neuro/bin/util/maxfilter',
-                  logfile=None, n_threads=4):
+                  logfile=None, n_threads=None, engine='maxfilter', queue=None,
+                  subject=None, chunk_duration=None, chunk_overlap=None):
 
         """Build a NeuroMag MaxFilter command for later execution.
 
-        See the Maxfilter manual for details on the different options!
+        See the Maxfilter manual for details on the different options! With
+        engine='mne', the equivalent SSS, tSSS and movement compensation
+        are run by `mne.preprocessing.maxwell_filter` instead, which does
+        not need the MaxFilter license, and can thus run on any queue.
 
         Things to implement
         * check that cal-file matches date in infile!
@@ -76,8 +443,10 @@ class Maxfilter(ClusterBatch):
             Input file name
         out_fname : str
             Output file name
-        n_threads : int
-            Number of parallel threads to execute on (default: 4)
+        n_threads : int | None
+            Number of parallel threads to execute on. If None (default), 4
+            for the MaxFilter binary, and 1 for MNE-Python (which filters
+            in a single thread).
         maxfilter_bin : str
             Full path to the maxfilter-executable
         logfile : str
@@ -86,7 +455,7 @@ class Maxfilter(ClusterBatch):
             Overwrite existing output (default: False)
         origin : array-like or str
             Head origin in mm. If None it will be estimated from headshape
-            points.
+            points (use `estimate_origins` first to fit many files at once).
         frame : str ('device' or 'head')
             Coordinate frame for head center
         bad : str, list (or None)
@@ -132,7 +501,43 @@ class Maxfilter(ClusterBatch):
             Path to Cross-talk compensation file
         mx_args : str
             Additional command line arguments to pass to MaxFilter
+        engine : str ('maxfilter' or 'mne')
+            Run the MaxFilter binary (default), or MNE-Python's
+            maxwell_filter. The latter supports the options origin, frame,
+            bad, skip (the intervals are left unprocessed), st, st_buflen,
+            st_corr, trans, movecomp (using the head positions estimated
+            from the cHPI-signals), cal, ctc and force.
+        queue : str | list of str | None
+            The queue to run the job on. If None (default), maxfilter.q is
+            used for the MaxFilter binary, and short.q for MNE-Python.
+        subject : str | None
+            The subject of the recording (see `ClusterBatch.kill`).
+        chunk_duration : float | None
+            With engine='mne', split the recording into chunks of about this
+            duration (in sec), filtered by parallel jobs. A final job
+            stitches the chunks together. With st=True, the chunks are whole
+            numbers of tSSS buffers. If None (default), the recording is
+            filtered by a single job.
+        chunk_overlap : float | None
+            The time (in sec) by which the filtered chunks overlap (and which
+            is cut off before stitching), e.g., for the head position
+            estimates to settle. If None (default), one tSSS buffer if st is
+            True, and no overlap otherwise.
         """
+        if engine not in ('maxfilter', 'mne'):
+            raise ValueError('engine must be \'maxfilter\' or \'mne\'.')
+        if chunk_duration is not None and engine != 'mne':
+            raise ValueError('Chunked filtering requires engine=\'mne\'.')
+        if engine == 'mne':
+            unsupported = [name for name, value in (
+                ('autobad', autobad != 'off'), ('headpos', headpos),
+                ('hp', hp is not None), ('hpistep', hpistep is not None),
+                ('hpisubt', hpisubt is not None),
+                ('linefreq', linefreq is not None), ('mx_args', mx_args))
+                if value]
+            if len(unsupported) > 0:
+                raise ValueError('Options not supported with engine=\'mne\': '
+                                 '{0}'.format(', '.join(unsupported)))
         if not check_source_readable(in_fname):
             raise IOError('Input file {} not readable!'.format(in_fname))
         if check_destination_exists(out_fname):
@@ -143,33 +548,20 @@ class Maxfilter(ClusterBatch):
             raise IOError('Output file {} not writable!'.format(out_fname))
         output_dir = op.dirname(out_fname)
 
-        # determine the head origin if necessary
+        # determine the head origin if necessary (see estimate_origins)
         if origin is None:
-            self.logger.info('Estimating head origin from headshape points..')
-            raw = Raw(in_fname, preload=False)
-            with warnings.filterwarnings('error', category=RuntimeWarning):
-                r, o_head, o_dev = fit_sphere_to_headshape(raw.info,
-                                                           dig_kind='auto',
-                                                           units='m')
-            raw.close()
-
-            self.logger.info('Fitted sphere: r = {.1f} mm'.format(r))
-            self.logger.info('Origin head coordinates: {.1f} {.1f} {.1f} mm'.
-                             format(o_head[0], o_head[1], o_head[2]))
-            self.logger.info('Origin device coordinates: {.1f} {.1f} {.1f} mm'.
-                             format(o_dev[0], o_dev[1], o_dev[2]))
-
-            self.logger.info('[done]')
+            r, o_head, o_dev = self.estimate_origins([in_fname])[in_fname]
+            self.logger.info('Fitted sphere: r = {:.1f} mm'.format(r))
+            self.logger.info('Origin head coordinates: {:.1f} {:.1f} {:.1f} '
+                             'mm'.format(o_head[0], o_head[1], o_head[2]))
+            self.logger.info('Origin device coordinates: {:.1f} {:.1f} '
+                             '{:.1f} mm'.format(o_dev[0], o_dev[1], o_dev[2]))
             if frame == 'head':
                 origin = o_head
             elif frame == 'device':
                 origin = o_dev
             else:
-                RuntimeError('invalid frame for origin')
-
-        # Start building command
-        cmd = (maxfilter_bin + ' -f {:s} -o {:s} -v '.format(in_fname,
-                                                             out_fname))
+                raise RuntimeError('invalid frame for origin')
 
         if isinstance(origin, (np.ndarray, list, tuple)):
             origin = '{:.1f} {:.1f} {:.1f}'.format(origin[0],
@@ -177,81 +569,284 @@ class Maxfilter(ClusterBatch):
         elif not isinstance(origin, str):
             raise(ValueError('origin must be list-like or string'))
 
-        cmd += ' -frame {:s} -origin {:s} -v '.format(frame, origin)
-
         if bad is not None:
             # format the channels
             if isinstance(bad, str):
                 bad = bad.split()
-            bad += self.info['bad']  # combine the two
+            bad = bad + self.info['bad']  # combine the two
         else:
             bad = self.info['bad']
+        # and those found by detect_bad_channels
+        bad = bad + [ch for ch in self.info['detected_bad'].get(
+            _acquisition_key(in_fname), []) if ch not in bad]
+
+        if queue is None:
+            # NB maxfilter.q hard-coded here, change if cluster changes
+            queue = 'maxfilter.q' if engine == 'maxfilter' else 'short.q'
+        if n_threads is None:
+            n_threads = 4 if engine == 'maxfilter' else 1
+
+        if engine == 'mne':
+            mne_options = dict(
+                origin=origin, frame=frame, bad=bad, skip=skip, force=force,
+                st=st, st_buflen=st_buflen, st_corr=st_corr, trans=trans,
+                movecomp=movecomp, cal=cal, ctc=ctc)
+            if chunk_duration is not None:
+                self._build_chunked(in_fname, out_fname, chunk_duration,
+                                    chunk_overlap, mne_options, queue=queue,
+                                    n_threads=n_threads, logfile=logfile,
+                                    subject=subject)
+                return
+            cmd = _maxwell_filter_cmd(in_fname, out_fname, **mne_options)
+        else:
+            # Start building command
+            cmd = (maxfilter_bin + ' -f {:s} -o {:s} -v '.format(in_fname,
+                                                                 out_fname))
 
-        # NB add check here that all bads in list actually exist in raw!
-        if len(bad) > 0:
-            # now assume we have a list of str with channel names
-            bad_logic = [ch[3:] if ch.startswith('MEG') else ch for ch in bad]
-            bad_str = ' '.join(bad_logic)
+            cmd += ' -frame {:s} -origin {:s} -v '.format(frame, origin)
 
-            cmd += '-bad {:s} '.format(bad_str)
+            # NB add check here that all bads in list actually exist in raw!
+            if len(bad) > 0:
+                # now assume we have a list of str with channel names
+                bad_logic = [ch[3:] if ch.startswith('MEG') else ch
+                             for ch in bad]
+                bad_str = ' '.join(bad_logic)
 
-        cmd += '-autobad {:s} '.format(autobad)
+                cmd += '-bad {:s} '.format(bad_str)
 
-        if skip is not None:
-            if isinstance(skip, list):
-                skip = ' '.join(['{:.3f} {:.3f}'.format(s[0], s[1])
-                                for s in skip])
-            cmd += '-skip {:s} '.format(skip)
+            cmd += '-autobad {:s} '.format(autobad)
 
-        if force:
-            cmd += '-force '
+            if skip is not None:
+                if isinstance(skip, list):
+                    skip = ' '.join(['{:.3f} {:.3f}'.format(s[0], s[1])
+                                    for s in skip])
+                cmd += '-skip {:s} '.format(skip)
 
-        if st:
-            cmd += '-st '
-            cmd += ' {:.0f} '.format(st_buflen)
-            cmd += '-corr {:.4f} '.format(st_corr)
+            if force:
+                cmd += '-force '
 
-        if trans is not None:
-            cmd += '-trans {:s} '.format(trans)
+            if st:
+                cmd += '-st '
+                cmd += ' {:.0f} '.format(st_buflen)
+                cmd += '-corr {:.4f} '.format(st_corr)
 
-        if movecomp:
-            cmd += '-movecomp '
-            if movecomp == 'inter':
-                cmd += ' inter '
+            if trans is not None:
+                cmd += '-trans {:s} '.format(trans)
 
-        if headpos:
             if movecomp:
-                raise RuntimeError('movecomp and headpos mutually exclusive')
-            cmd += '-headpos '
+                cmd += '-movecomp '
+                if movecomp == 'inter':
+                    cmd += ' inter '
+
+            if headpos:
+                if movecomp:
+                    raise RuntimeError('movecomp and headpos mutually '
+                                       'exclusive')
+                cmd += '-headpos '
 
-        if hp is not None:
-            cmd += '-hp {:s} '.format(hp)
+            if hp is not None:
+                cmd += '-hp {:s} '.format(hp)
 
-        if hpisubt is not None:
-            cmd += 'hpisubt {:s} '.format(hpisubt)
+            if hpisubt is not None:
+                cmd += 'hpisubt {:s} '.format(hpisubt)
 
-        if hpicons:
-            cmd += '-hpicons '
+            if hpicons:
+                cmd += '-hpicons '
 
-        if linefreq is not None:
-            cmd += '-linefreq {:d} '.format(linefreq)
+            if linefreq is not None:
+                cmd += '-linefreq {:d} '.format(linefreq)
 
-        if cal is not None:
-            cmd += '-cal {:s} '.format(cal)
+            if cal is not None:
+                cmd += '-cal {:s} '.format(cal)
 
-        if ctc is not None:
-            cmd += '-ctc {:s} '.format(ctc)
+            if ctc is not None:
+                cmd += '-ctc {:s} '.format(ctc)
 
-        cmd += mx_args
+            cmd += mx_args
 
         if logfile:
-            cmd += ' | tee ' + logfile
+            cmd = _tee_cmd(cmd, logfile)
+
+        self.add_job(cmd, queue=queue, n_threads=n_threads,
+                     job_name=('maxfilter' if engine == 'maxfilter' else
+                               'mne.maxwell_filter'),
+                     log_dir=self.info['log_dir'], working_dir=output_dir,
+                     inputs=[in_fname], outputs=[out_fname], subject=subject)
+        self.info['io_mapping'] += [dict(input=in_fname, output=out_fname,
+                                         logfile=logfile)]
+
+    def _build_chunked(self, in_fname, out_fname, chunk_duration,
+                       chunk_overlap, mne_options, queue, n_threads, logfile,
+                       subject):
+        """Add jobs filtering a recording in chunks, and stitching them"""
+        st_buflen = mne_options['st_buflen'] if mne_options['st'] else None
+        if chunk_overlap is None:
+            chunk_overlap = st_buflen or 0.
+        raw = read_raw_fif(in_fname, allow_maxshield=True, verbose=False)
+        chunks = _chunk_times(raw.times[-1], chunk_duration, chunk_overlap,
+                              st_buflen=st_buflen)
+        output_dir = op.dirname(out_fname)
 
-        # NB maxfilter.q hard-coded here, remember to change if cluster changes
-        self.add_job(cmd, queue='maxfilter.q', n_threads=n_threads,
-                     job_name='maxfilter', log_dir=self.info['log_dir'],
-                     working_dir=output_dir)
-        self.info['io_mapping'] += [dict(input=in_fname, output=out_fname)]
+        # NB the chunk files are removed once stitched: the jobs are up to
+        # date (see ClusterBatch.submit) if the stitched output is
+        chunk_jobs, chunk_fnames = [], []
+        for ii, chunk in enumerate(chunks):
+            chunk_fnames.append('{0}_chunk{1:03d}.fif'.format(
+                op.splitext(out_fname)[0], ii))
+            cmd = _maxwell_filter_cmd(in_fname, chunk_fnames[-1],
+                                      chunk=chunk, **dict(mne_options,
+                                                          force=True))
+            self.add_job(cmd, queue=queue, n_threads=n_threads,
+                         job_name='mne.maxwell_filter_chunk',
+                         log_dir=self.info['log_dir'], working_dir=output_dir,
+                         inputs=[in_fname], outputs=[out_fname],
+                         subject=subject)
+            chunk_jobs.append(self._joblist[-1])
+
+        cmd = _stitch_cmd(chunk_fnames, out_fname, mne_options['force'])
+        if logfile:
+            cmd = _tee_cmd(cmd, logfile)
+        self.add_job(cmd, queue=queue, job_name='mne.maxwell_stitch',
+                     log_dir=self.info['log_dir'], working_dir=output_dir,
+                     depends_on=chunk_jobs, inputs=[in_fname],
+                     outputs=[out_fname], subject=subject)
+        self.info['io_mapping'] += [dict(input=in_fname, output=out_fname,
+                                         logfile=logfile)]
+
+    def build_head_pos(self, in_fname, pos_fname, queue='short.q',
+                       n_threads=1, subject=None):
+        """Build a job estimating the continuous head positions of a recording.
+
+        The head positions are computed from the cHPI signals by MNE-Python
+        (mne.chpi), without the MaxFilter license, and saved as a NumPy
+        array. Positions estimated by MaxFilter itself (`build_cmd` with
+        hp='name.pos') are converted to the same format by `read_head_pos`.
+        Use `summarize_head_positions` to compare the head movement of the
+        recordings, e.g., to decide which need movement compensation.
+
+        Parameters
+        ----------
+        in_fname : str
+            Input file name (the first file of a split recording).
+        pos_fname : str
+            The output file name; must end with '.npy'.
+        queue : str
+            The queue to run the job on (default: 'short.q').
+        n_threads : int
+            Number of parallel threads to execute on (default: 1).
+        subject : str | None
+            The subject of the recording (for `ClusterBatch.kill`).
+        """
+        if not check_source_readable(in_fname):
+            raise IOError('Input file {} not readable!'.format(in_fname))
+        if not pos_fname.endswith('.npy'):
+            raise ValueError('The head positions are saved as a NumPy array, '
+                             'pos_fname must end with .npy')
+        output_dir = op.dirname(pos_fname)
+        if not os.access(output_dir or '.', os.W_OK):
+            raise IOError('Output directory {} not writable!'.format(
+                output_dir))
+
+        script = ["import numpy as np",
+                  "from mne.io import read_raw_fif",
+                  "raw = read_raw_fif({0!r}, allow_maxshield=True)".format(
+                      in_fname)] + _HEAD_POS_SCRIPT
+        script += ["np.save({0!r}, head_pos)".format(pos_fname)]
+        self.add_job('python -c "{0:s}"'.format('; '.join(script)),
+                     queue=queue, n_threads=n_threads,
+                     job_name='mne.compute_head_pos',
+                     log_dir=self.info['log_dir'], working_dir=output_dir,
+                     inputs=[in_fname], outputs=[pos_fname], subject=subject)
+
+    def build_from_series(self, series, out_dir, suffix='_tsss',
+                          subject_dirs=True, n_jobs=None, **kwargs):
+        """Build MaxFilter commands for all recordings of database series.
+
+        MEG recordings longer than 2 GB are split into several files
+        (name.fif, name-1.fif, ...). Each recording is processed as a whole,
+        by a single job on its first file. If the origin is None, the
+        origins of all recordings are fitted at once (see
+        `estimate_origins`).
+
+        Parameters
+        ----------
+        series : dict | list of dict
+            The series, as returned by `Query.filter_series`.
+        out_dir : str
+            The output directory, absolute or relative to the project
+            directory (e.g., 'scratch/maxfiltered').
+        suffix : str
+            Added to the name of the first file of the recording, to get the
+            name of the output file ('name_tsss.fif') and the MaxFilter log
+            file ('name_tsss.log'). Default: '_tsss'.
+        subject_dirs : bool
+            If True (default), write the output of each subject to a
+            sub-directory named by the subject code.
+        n_jobs : int | None
+            The number of processes to fit origins in (if needed).
+        **kwargs : keyword arguments
+            Options for `build_cmd`, e.g., st=True.
+
+        Returns
+        -------
+        io_mapping : list of tuple
+            The (input, output) file names of the commands built.
+        """
+        if isinstance(series, dict):
+            series = [series]
+        out_dir = _get_absolute_proj_path(out_dir, self.proj_name)
+
+        recordings = []  # (first file, subject) of each recording
+        for ser in series:
+            keys = set()
+            for fname in ser['files']:  # the first file of a recording first
+                in_fname = op.join(ser['path'], fname)
+                key = _acquisition_key(in_fname)
+                if (not fname.endswith(('.fif', '.fif.gz')) or
+                        key in keys):
+                    continue
+                keys.add(key)
+                recordings.append((in_fname, ser.get('subjectcode')))
+        if kwargs.get('origin', '0 0 40') is None:
+            self.estimate_origins([in_fname for in_fname, _ in recordings],
+                                  n_jobs=n_jobs)
+
+        io_mapping = []
+        for in_fname, subject in recordings:
+            subj_out_dir = out_dir
+            if subject_dirs and subject is not None:
+                subj_out_dir = op.join(out_dir, subject)
+            mkdir_p(subj_out_dir)
+            outbase = op.join(subj_out_dir, op.basename(in_fname).split(
+                '.fif')[0] + suffix)
+            self.build_cmd(in_fname, outbase + '.fif',
+                           logfile=outbase + '.log', subject=subject,
+                           **kwargs)
+            io_mapping.append((in_fname, outbase + '.fif'))
+        return io_mapping
+
+    def summarize_logs(self, n_jobs=None, out_fname=None):
+        """Tabulate the quality measures of the MaxFilter runs built.
+
+        The log files of the commands built with a logfile (such as by
+        `build_from_series`) are parsed in parallel, see
+        `summarize_maxfilter_logs` for details.
+
+        Parameters
+        ----------
+        n_jobs : int | None
+            The number of processes to use. If None (default), one per CPU.
+        out_fname : str | None
+            If given, also write the table to this (tab-separated) file.
+
+        Returns
+        -------
+        table : list of dict
+            The measures of each log file found.
+        """
+        return summarize_maxfilter_logs(
+            [io['logfile'] for io in self.info['io_mapping']
+             if io.get('logfile')], n_jobs=n_jobs, out_fname=out_fname)
 
     def print_input_output_mapping(self):
         for io in self.info['io_mapping']:
@@ -273,13 +868,11 @@ class Maxfilter(ClusterBatch):
         self.logger.info('All inputs readable & outputs writable.')
 
 
-def Xscan(Maxfilter):
+class Xscan(Maxfilter):
     """Elekta xscan: SSS-based bad channel detection.
     """
     def __init__(self, proj_name, bad=[], verbose=True):
-        super(Xscan, self).__init__(proj_name)
-
-        self.info = dict(bad=bad, io_mapping=[])
+        super(Xscan, self).__init__(proj_name, bad=bad, verbose=verbose)
         print('xscan not implemented yet.')
 
     # def detect_bad_chans_xscan(self, in_fname, use_tsss=False, n_jobs=1,
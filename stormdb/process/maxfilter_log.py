@@ -0,0 +1,141 @@
+"""
+=========================
+Quality assurance of MaxFilter runs, from their log files
+
+The logs written by MaxFilter (and by MNE-Python's maxwell_filter) are
+parsed line by line for the bad channels, the tSSS subspace rejections,
+the head position (HPI) fits, warnings and the running time. The patterns
+below are deliberately lenient, as the wording differs between versions.
+=========================
+
+"""
+# Author: Chris Bailey <cjb@cfin.au.dk>
+#
+# License: MIT
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# "Static bad channels (2): 0113 2443", "Detected bad channels: MEG 1722"
+_BAD_RE = re.compile(r'bad\s+(?:meg\s+)?channels.*?:(.*)$', re.I)
+_CHANNEL_RE = re.compile(r'(?:MEG\s?)?(\d{4})\b')
+# "4 out of 80 inner components were rejected (subspace correlation)"
+# (MaxFilter), "Projecting 6 intersecting tSSS components for 0.000 - 9.999
+# sec" (MNE-Python)
+_TSSS_RE = re.compile(r'(\d+)\s+(?:out\s+of\s+\d+\s+)?(?:[a-z-]+\s+)*?'
+                      r'(?:components|vectors)\b', re.I)
+_TSSS_LINE_RE = re.compile(r'intersect|subspace|tSSS|reject', re.I)
+# "#t = 1.000, #e = 0.165 cm, #g = 0.997, #v = 0.211 cm/s, ..." (MaxFilter)
+_HPI_ERROR_RE = re.compile(r'#e\s*=\s*([\d.]+)\s*(mm|cm)', re.I)
+_HPI_GOF_RE = re.compile(r'#g\s*=\s*([\d.]+)', re.I)
+_WARNING_RE = re.compile(r'\bwarning\b', re.I)
+# "Total processing time 123.4 s", "... took 2.1 min"
+_RUNTIME_RE = re.compile(r'(?:total|elapsed|took).*?([\d.]+)\s*'
+                         r'(s|sec|seconds|min|minutes)\b', re.I)
+
+
+def parse_maxfilter_log(fname):
+    """Extract the quality measures of a MaxFilter run from its log file.
+
+    Parameters
+    ----------
+    fname : str
+        The log file (e.g., written with `Maxfilter.build_cmd` by logfile).
+
+    Returns
+    -------
+    stats : dict
+        The log file ('fname'), the bad channels reported ('bad', e.g.
+        ['MEG0113']), the number of tSSS buffers reported
+        ('tsss_buffers'), and the total and largest number of subspace
+        components rejected in a buffer ('tsss_rejected' and
+        'tsss_max_rejected'), the largest HPI fit error ('hpi_max_error',
+        in mm) and the lowest goodness of fit ('hpi_min_gof'), the
+        (unique) warnings ('warnings') and the running time ('runtime', in
+        sec). Measures that are not in the log are None.
+    """
+    bad, rejected, warnings_ = set(), [], []
+    hpi_errors, hpi_gofs, runtime = [], [], None
+    with open(fname, 'r', errors='replace') as fid:
+        for line in fid:
+            if _WARNING_RE.search(line):
+                warning = line.strip()
+                if warning not in warnings_:
+                    warnings_.append(warning)
+            match = _BAD_RE.search(line)
+            if match is not None:
+                bad.update('MEG' + ch for ch in
+                           _CHANNEL_RE.findall(match.group(1)))
+                continue
+            match = _TSSS_RE.search(line)
+            if match is not None and _TSSS_LINE_RE.search(line):
+                rejected.append(int(match.group(1)))
+                continue
+            for err, unit in _HPI_ERROR_RE.findall(line):
+                hpi_errors.append(float(err) * (10. if unit == 'cm' else 1.))
+            hpi_gofs += [float(gof) for gof in _HPI_GOF_RE.findall(line)]
+            match = _RUNTIME_RE.search(line)
+            if match is not None:
+                runtime = float(match.group(1))
+                if match.group(2).startswith('min'):
+                    runtime *= 60.
+
+    return dict(fname=fname, bad=sorted(bad),
+                tsss_buffers=len(rejected) if rejected else None,
+                tsss_rejected=sum(rejected) if rejected else None,
+                tsss_max_rejected=max(rejected) if rejected else None,
+                hpi_max_error=max(hpi_errors) if hpi_errors else None,
+                hpi_min_gof=min(hpi_gofs) if hpi_gofs else None,
+                warnings=warnings_, runtime=runtime)
+
+
+def summarize_maxfilter_logs(fnames, n_jobs=None, out_fname=None):
+    """Tabulate the quality measures of many MaxFilter runs (for QA).
+
+    Parameters
+    ----------
+    fnames : list of str
+        The log files. Missing files (e.g., of jobs that have not run yet)
+        are skipped.
+    n_jobs : int | None
+        The number of processes to parse the logs in. If None (default),
+        one per CPU.
+    out_fname : str | None
+        If given, also write the table to this file, as tab-separated
+        values (with a header line, the bad channels separated by spaces
+        and the number of warnings).
+
+    Returns
+    -------
+    table : list of dict
+        The measures of each log file, see `parse_maxfilter_log`.
+    """
+    fnames = [fname for fname in fnames if os.path.exists(fname)]
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs == 1 or len(fnames) < 2:
+        table = [parse_maxfilter_log(fname) for fname in fnames]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs,
+                                                 len(fnames))) as executor:
+            table = list(executor.map(
+                parse_maxfilter_log, fnames,
+                chunksize=max(1, len(fnames) // n_jobs)))
+
+    if out_fname is not None:
+        columns = ['fname', 'bad', 'tsss_buffers', 'tsss_rejected',
+                   'tsss_max_rejected', 'hpi_max_error', 'hpi_min_gof',
+                   'warnings', 'runtime']
+        with open(out_fname, 'w') as fid:
+            fid.write('\t'.join(columns) + '\n')
+            for stats in table:
+                values = []
+                for column in columns:
+                    value = stats[column]
+                    if column == 'warnings':
+                        value = len(value)
+                    elif isinstance(value, list):
+                        value = ' '.join(value)
+                    values.append('' if value is None else str(value))
+                fid.write('\t'.join(values) + '\n')
+    return table
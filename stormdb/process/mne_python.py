@@ -1,32 +1,86 @@
 import os
+import json
+import shlex
 from .utils import (_get_absolute_proj_path)
 from ..base import (enforce_path_exists, check_destination_writable,
                     check_source_readable, mkdir_p)
 from ..cluster import ClusterBatch
 
+# the steps of MNEPython.raw_pipeline, and their required arguments
+_PIPELINE_STEPS = dict(filter=('l_freq', 'h_freq'), notch_filter=('freqs',),
+                       resample=('sfreq',), apply_ica=('fname',), epochs=())
+
+
+def _check_output_writable(fname):
+    """Check that an output file can be (over)written"""
+    if os.path.exists(fname):
+        return os.access(fname, os.W_OK)
+    return check_destination_writable(fname)
+
 
 class MNEPython(ClusterBatch):
     """Clusterised mne-python commands.
+
+    Existing output files are overwritten, unless they are up to date and
+    the batch is submitted with ``incremental=True`` (see
+    `ClusterBatch.submit`).
+
+    With ``worker=True``, each job runs its task (the method and its
+    arguments, as JSON) with `stormdb.process.mne_worker`, instead of a
+    ``python -c`` script. Jobs packed with `ClusterBatch.pack` then run all
+    their tasks in a single worker, which runs as many tasks at a time as
+    the pack has slots for, and imports mne-python, NumPy and SciPy once per
+    worker process, rather than once per task. The arguments must then be
+    JSON-serializable.
     """
     def __init__(self, proj_name, bad=[], verbose=False,
-                 log_dir='scratch/qsub_logs'):
-        super(MNEPython, self).__init__(proj_name, verbose=verbose)
+                 log_dir='scratch/qsub_logs', cluster=None, worker=False):
+        super(MNEPython, self).__init__(proj_name, verbose=verbose,
+                                        cluster=cluster)
 
         log_dir = _get_absolute_proj_path(log_dir, self.proj_name)
         mkdir_p(log_dir)
 
-        self.info = dict(bad=bad, io_mapping=[], log_dir=log_dir)
+        self.info = dict(bad=bad, io_mapping=[], log_dir=log_dir,
+                         worker=worker)
+
+    def _add_task_job(self, cmd, task, kwargs, **job_kwargs):
+        """Add a job running cmd, or the task in a worker (in worker mode)
+
+        Tasks without a command (cmd=None) always run in a worker.
+        """
+        worker = self.info['worker'] or cmd is None
+        if worker:
+            try:
+                task = dict(task=task, kwargs=json.loads(json.dumps(kwargs)))
+            except TypeError as err:
+                raise ValueError('The arguments of a worker task must be '
+                                 'JSON-serializable ({0}), use worker=False '
+                                 'instead.'.format(err))
+            cmd = 'python -m stormdb.process.mne_worker --task {0}'.format(
+                shlex.quote(json.dumps(task)))
+        job_kwargs.setdefault('n_threads', 1)
+        self.add_job(cmd, log_dir=self.info['log_dir'], **job_kwargs)
+        if worker:
+            self._joblist[-1]._worker_task = task
+
+    def _pack_runner(self, jobs):
+        if not all(getattr(job, '_worker_task', None) is not None
+                   for job in jobs):
+            return super(MNEPython, self)._pack_runner(jobs)
+        return ('python -m stormdb.process.mne_worker',
+                [dict(job._worker_task) for job in jobs])
 
     def raw_filter(self, in_fname, out_fname, l_freq, h_freq, **kwargs):
         if not check_source_readable(in_fname):
             raise IOError('Input file {0} not readable!'.format(in_fname))
-        if not check_destination_writable(out_fname):
+        if not _check_output_writable(out_fname):
             raise IOError('Output file {0} not writable!'.format(out_fname))
 
         script = ("from mne.io import read_raw_fif;"
                   "raw = read_raw_fif('{in_fname:s}', preload=True);"
                   "raw.filter({l_freq}, {h_freq}{kwargs:});"
-                  "raw.save('{out_fname:s}')")
+                  "raw.save('{out_fname:s}', overwrite=True)")
         filtargs = ', '.join("{!s}={!r}".format(key, val) for
                              (key, val) in kwargs.items())
         filtargs = ', ' + filtargs if len(kwargs) > 0 else filtargs
@@ -35,8 +89,78 @@ class MNEPython(ClusterBatch):
                              l_freq=l_freq, h_freq=h_freq, kwargs=filtargs)
         cmd += "\""
 
-        self.add_job(cmd, n_threads=1, job_name='mne.raw.filter',
-                     log_dir=self.info['log_dir'])
+        self._add_task_job(cmd, 'raw_filter',
+                           dict(kwargs, in_fname=in_fname, out_fname=out_fname,
+                                l_freq=l_freq, h_freq=h_freq),
+                           job_name='mne.raw.filter', inputs=[in_fname],
+                           outputs=[out_fname])
+        self.info['io_mapping'] += [dict(input=in_fname, output=out_fname)]
+
+    def raw_pipeline(self, in_fname, out_fname, steps, n_threads=1):
+        """Process a raw recording in several steps, in a single job.
+
+        The recording is read once, and each step works on the Raw object
+        in memory, so only the final output is written (to the shared
+        filesystem). The job always runs in a worker (see `MNEPython`).
+
+        Parameters
+        ----------
+        in_fname : str
+            The raw recording.
+        out_fname : str
+            The output file: the processed raw recording, or the epochs, if
+            the last step is 'epochs' (then ending with '-epo.fif').
+        steps : list of tuple
+            The (step, kwargs) to apply, in order. The steps are 'filter',
+            'notch_filter' and 'resample' (the Raw methods, with kwargs as
+            arguments), 'apply_ica' (kwargs: the 'fname' of the ICA solution,
+            and the arguments of ICA.apply, e.g., exclude) and, last,
+            'epochs' (kwargs: the arguments of mne.Epochs, and either the
+            'events_fname' of the events, or the arguments of
+            mne.find_events as 'find_events'). The events are found in the
+            recording as read, before resampling.
+        n_threads : int
+            The number of threads of the job (default: 1), e.g. for
+            filtering with n_jobs.
+
+        Examples
+        --------
+        Filter, resample, remove ICA components and epoch a recording::
+
+            >>> mp.raw_pipeline(raw_fname, epo_fname, [  # doctest: +SKIP
+            ...     ('filter', dict(l_freq=1., h_freq=40.)),
+            ...     ('resample', dict(sfreq=250.)),
+            ...     ('apply_ica', dict(fname=ica_fname, exclude=[0, 3])),
+            ...     ('epochs', dict(event_id=dict(visual=1), tmin=-0.2,
+            ...                     tmax=0.5, find_events=dict(
+            ...                         stim_channel='STI101')))])
+        """
+        inputs = [in_fname]
+        for istep, (step, kwargs) in enumerate(steps):
+            if step not in _PIPELINE_STEPS:
+                raise ValueError('Unknown step {0}'.format(step))
+            missing = [key for key in _PIPELINE_STEPS[step]
+                       if key not in kwargs]
+            if len(missing) > 0:
+                raise ValueError('Step {0} requires {1}.'.format(
+                    step, ', '.join(missing)))
+            if step == 'epochs' and istep != len(steps) - 1:
+                raise ValueError('Epoching must be the last step.')
+            if step == 'apply_ica':
+                inputs.append(kwargs['fname'])
+            if step == 'epochs' and kwargs.get('events_fname') is not None:
+                inputs.append(kwargs['events_fname'])
+        for fname in inputs:
+            if not check_source_readable(fname):
+                raise IOError('Input file {0} not readable!'.format(fname))
+        if not _check_output_writable(out_fname):
+            raise IOError('Output file {0} not writable!'.format(out_fname))
+
+        self._add_task_job(None, 'raw_pipeline',
+                           dict(in_fname=in_fname, out_fname=out_fname,
+                                steps=[list(step) for step in steps]),
+                           job_name='mne.raw.pipeline', inputs=inputs,
+                           outputs=[out_fname], n_threads=n_threads)
         self.info['io_mapping'] += [dict(input=in_fname, output=out_fname)]
 
     def setup_source_space(self, subject, src_fname, **kwargs):
@@ -65,13 +189,14 @@ class MNEPython(ClusterBatch):
         subjects_dir = self._triage_subjects_dir_from_kwargs(kwargs)
 
         enforce_path_exists(os.path.join(subjects_dir, subject))
-        if not check_destination_writable(src_fname):
+        if not _check_output_writable(src_fname):
             raise IOError('Output file {0} not writable!'.format(src_fname))
 
         # NB Since mne-python 0.15, fname=None is deprecated and removed here
         script = ("from mne import setup_source_space, write_source_spaces;"
                   "src = setup_source_space('{subject:s}'{kwargs:});"
-                  "write_source_spaces(fname='{src_fname:s}', src=src)")
+                  "write_source_spaces(fname='{src_fname:s}', src=src, "
+                  "overwrite=True)")
         filtargs = ', '.join("{!s}={!r}".format(key, val) for
                              (key, val) in kwargs.items())
         filtargs = ', ' + filtargs if len(kwargs) > 0 else filtargs
@@ -80,8 +205,10 @@ class MNEPython(ClusterBatch):
                              kwargs=filtargs)
         cmd += "\""
 
-        self.add_job(cmd, n_threads=1, job_name='mne.src_space',
-                     log_dir=self.info['log_dir'])
+        self._add_task_job(cmd, 'setup_source_space',
+                           dict(kwargs, subject=subject, src_fname=src_fname),
+                           job_name='mne.src_space', outputs=[src_fname],
+                           subject=subject)
         self.info['io_mapping'] += [dict(input=subject, output=src_fname)]
 
     def prepare_bem_model(self, subject, bem_fname, **kwargs):
@@ -105,14 +232,14 @@ class MNEPython(ClusterBatch):
         """
         subjects_dir = self._triage_subjects_dir_from_kwargs(kwargs)
         enforce_path_exists(os.path.join(subjects_dir, subject))
-        if not check_destination_writable(bem_fname):
+        if not _check_output_writable(bem_fname):
             raise IOError('Output file {0} not writable!'.format(bem_fname))
 
         script = ("from mne import make_bem_model, make_bem_solution, "
                   "write_bem_solution;"
                   "surfs = make_bem_model('{subject:s}', ico=None{kwargs:});"
                   "bem = make_bem_solution(surfs);"
-                  "write_bem_solution('{bem_fname:s}', bem)")
+                  "write_bem_solution('{bem_fname:s}', bem, overwrite=True)")
         filtargs = ', '.join("{!s}={!r}".format(key, val) for
                              (key, val) in kwargs.items())
         filtargs = ', ' + filtargs if len(kwargs) > 0 else filtargs
@@ -121,8 +248,10 @@ class MNEPython(ClusterBatch):
                              kwargs=filtargs)
         cmd += "\""
 
-        self.add_job(cmd, n_threads=1, job_name='mne.prep_bem',
-                     log_dir=self.info['log_dir'])
+        self._add_task_job(cmd, 'prepare_bem_model',
+                           dict(kwargs, subject=subject, bem_fname=bem_fname),
+                           job_name='mne.prep_bem', outputs=[bem_fname],
+                           subject=subject)
         self.info['io_mapping'] += [dict(input=subject, output=bem_fname)]
 
     def make_forward_solution(self, meas_fname, trans_fname, bem_fname,
@@ -156,14 +285,14 @@ class MNEPython(ClusterBatch):
         for fname in (meas_fname, trans_fname, bem_fname, src_fname):
             if not check_source_readable(fname):
                 raise IOError('Input file {} not readable!'.format(fname))
-        if not check_destination_writable(fwd_fname):
-            raise IOError('Output file {} not writable!'.format(bem_fname))
+        if not _check_output_writable(fwd_fname):
+            raise IOError('Output file {} not writable!'.format(fwd_fname))
 
         script = ("from mne import make_forward_solution, "
                   "write_forward_solution;"
                   "fwd = make_forward_solution('{meas:s}', '{trans:s}', "
                   "'{src:s}', '{bem:s}'{kwargs:});"
-                  "write_forward_solution('{fwd:s}', fwd)")
+                  "write_forward_solution('{fwd:s}', fwd, overwrite=True)")
         filtargs = ', '.join("{!s}={!r}".format(key, val) for
                              (key, val) in kwargs.items())
         filtargs = ', ' + filtargs if len(kwargs) > 0 else filtargs
@@ -172,8 +301,14 @@ class MNEPython(ClusterBatch):
                              src=src_fname, fwd=fwd_fname, kwargs=filtargs)
         cmd += "\""
 
-        self.add_job(cmd, n_threads=1, job_name='mne.fwd_solve',
-                     log_dir=self.info['log_dir'])
+        self._add_task_job(cmd, 'make_forward_solution',
+                           dict(kwargs, meas_fname=meas_fname,
+                                trans_fname=trans_fname, bem_fname=bem_fname,
+                                src_fname=src_fname, fwd_fname=fwd_fname),
+                           job_name='mne.fwd_solve',
+                           inputs=[meas_fname, trans_fname, bem_fname,
+                                   src_fname],
+                           outputs=[fwd_fname])
         self.info['io_mapping'] += [dict(input=meas_fname, output=fwd_fname)]
 
     def _triage_subjects_dir_from_kwargs(self, kwargs):
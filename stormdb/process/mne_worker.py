@@ -0,0 +1,176 @@
+"""
+=========================
+Run mne-python tasks in a few long-lived interpreters
+=========================
+
+Usage: python -m stormdb.process.mne_worker <spec.json>
+       python -m stormdb.process.mne_worker --task '<task as JSON>'
+
+MNE-Python (with NumPy and SciPy) is imported once per worker process,
+rather than once per task. The tasks of a spec-file are run by a pool of
+'n_workers' processes (one after the other in this interpreter for a single
+worker). A task is a dict with the name of an `MNEPython` method ('task') and
+its arguments ('kwargs'); a spec-file is written by `ClusterBatch.pack` for
+jobs of an `MNEPython` batch in worker mode. As for `stormdb.runner`, each
+task of a spec-file gets its own log file, and its exit status and
+resource use are stored in the results. The worker exits with status 1 if
+any of the tasks failed.
+"""
+# Author: Chris Bailey <cjb@cfin.au.dk>
+#
+# License: MIT
+import os
+import sys
+import json
+import time
+import resource
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout, redirect_stderr
+
+
+def raw_filter(in_fname, out_fname, l_freq, h_freq, **kwargs):
+    from mne.io import read_raw_fif
+    raw = read_raw_fif(in_fname, preload=True)
+    raw.filter(l_freq, h_freq, **kwargs)
+    raw.save(out_fname, overwrite=True)
+
+
+def setup_source_space(subject, src_fname, **kwargs):
+    from mne import setup_source_space, write_source_spaces
+    src = setup_source_space(subject, **kwargs)
+    write_source_spaces(fname=src_fname, src=src, overwrite=True)
+
+
+def prepare_bem_model(subject, bem_fname, **kwargs):
+    from mne import make_bem_model, make_bem_solution, write_bem_solution
+    surfs = make_bem_model(subject, ico=None, **kwargs)
+    bem = make_bem_solution(surfs)
+    write_bem_solution(bem_fname, bem, overwrite=True)
+
+
+def make_forward_solution(meas_fname, trans_fname, bem_fname, src_fname,
+                          fwd_fname, **kwargs):
+    from mne import make_forward_solution, write_forward_solution
+    fwd = make_forward_solution(meas_fname, trans_fname, src_fname,
+                                bem_fname, **kwargs)
+    write_forward_solution(fwd_fname, fwd, overwrite=True)
+
+
+def raw_pipeline(in_fname, out_fname, steps):
+    """Process a raw recording in memory, see `MNEPython.raw_pipeline`"""
+    import mne
+    raw = mne.io.read_raw_fif(in_fname, preload=True)
+    events = None
+    if len(steps) > 0 and steps[-1][0] == 'epochs':
+        # NB the events are found before resampling, which moves them along
+        epochs_kwargs = dict(steps[-1][1])
+        events_fname = epochs_kwargs.pop('events_fname', None)
+        find_kwargs = epochs_kwargs.pop('find_events', dict())
+        if events_fname is not None:
+            events = mne.read_events(events_fname)
+        else:
+            events = mne.find_events(raw, **find_kwargs)
+        steps = steps[:-1]
+
+    for step, kwargs in steps:
+        print('Step {0}(**{1!r})'.format(step, kwargs))
+        if step == 'filter':
+            raw.filter(**kwargs)
+        elif step == 'notch_filter':
+            raw.notch_filter(**kwargs)
+        elif step == 'resample':
+            if events is not None:
+                raw, events = raw.resample(events=events, **kwargs)
+            else:
+                raw.resample(**kwargs)
+        elif step == 'apply_ica':
+            kwargs = dict(kwargs)
+            ica = mne.preprocessing.read_ica(kwargs.pop('fname'))
+            ica.apply(raw, **kwargs)
+        else:
+            raise ValueError('Unknown step {0}'.format(step))
+
+    if events is not None:
+        epochs = mne.Epochs(raw, events, **epochs_kwargs)
+        epochs.save(out_fname, overwrite=True)
+    else:
+        raw.save(out_fname, overwrite=True)
+
+
+TASKS = dict(raw_filter=raw_filter, setup_source_space=setup_source_space,
+             prepare_bem_model=prepare_bem_model,
+             make_forward_solution=make_forward_solution,
+             raw_pipeline=raw_pipeline)
+
+
+def _run(task, log):
+    """Run a task, writing its output and errors to log"""
+    with redirect_stdout(log), redirect_stderr(log):
+        print('Executing {0}(**{1!r})'.format(task['task'], task['kwargs']))
+        try:
+            TASKS[task['task']](**task['kwargs'])
+        except Exception:
+            traceback.print_exc()
+            return 1
+    return 0
+
+
+def run_task(task):
+    """Run a single task, return its exit status and resource use"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu, maxrss = usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+    start = time.time()
+    cwd = os.getcwd()
+    if task.get('working_dir'):
+        os.chdir(task['working_dir'])
+    try:
+        if task.get('log') is None:
+            exit_status = _run(task, sys.stdout)
+        else:
+            with open(task['log'], 'w') as log:
+                exit_status = _run(task, log)
+    finally:
+        os.chdir(cwd)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # The peak memory is that of the worker so far, which is the peak of
+    # this task only if it was reached during the task (unknown otherwise)
+    maxvmem = None
+    if usage.ru_maxrss > maxrss:
+        maxvmem = usage.ru_maxrss * 1024.  # kilobytes on Linux
+    return dict(exit_status=exit_status, wallclock=time.time() - start,
+                cpu=usage.ru_utime + usage.ru_stime - cpu, maxvmem=maxvmem)
+
+
+def run_spec(spec_fname):
+    """Run all tasks in a spec-file, return the list of results"""
+    with open(spec_fname, 'r') as fid:
+        spec = json.load(fid)
+    if spec.get('n_workers', 1) > 1:
+        # a process each, as tasks change the working directory and output
+        with ProcessPoolExecutor(max_workers=spec['n_workers']) as executor:
+            results = list(executor.map(run_task, spec['tasks']))
+    else:
+        results = [run_task(task) for task in spec['tasks']]
+
+    tmp_fname = spec['results'] + '.tmp'
+    with open(tmp_fname, 'w') as fid:
+        json.dump(results, fid)
+    os.rename(tmp_fname, spec['results'])
+    return results
+
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == '--task':
+        return run_task(json.loads(argv[2]))['exit_status']
+    if len(argv) != 2:
+        print(__doc__)
+        return 2
+    results = run_spec(argv[1])
+    n_failed = len([res for res in results if res['exit_status'] != 0])
+    print('{:d} tasks run, {:d} failed.'.format(len(results), n_failed))
+    return 1 if n_failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
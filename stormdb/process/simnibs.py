@@ -67,6 +67,9 @@ class SimNIBS(ClusterBatch):
         'scratch/qsub_logs' in the project folder.
     verbose : bool
         If True, print out extra information as we go (default: False).
+    cluster : str | instance of Cluster | None
+        The cluster (scheduler backend) to run the jobs on, e.g. 'local' for
+        the current machine. If None (default), the SGE-cluster is used.
 
     Attributes
     ----------
@@ -75,8 +78,9 @@ class SimNIBS(ClusterBatch):
         'output_dir': SimNIBS output directory
     """
     def __init__(self, proj_name=None, output_dir=None,
-                 log_dir='scratch/qsub_logs', verbose=False):
-        super(SimNIBS, self).__init__(proj_name, verbose=verbose)
+                 log_dir='scratch/qsub_logs', verbose=False, cluster=None):
+        super(SimNIBS, self).__init__(proj_name, verbose=verbose,
+                                      cluster=cluster)
 
         if output_dir is None:
             if 'SN_SUBJECTS_DIR' in os.environ.keys():
@@ -265,6 +269,7 @@ class SimNIBS(ClusterBatch):
             if mri is not None:
                 mr_inputs_str += ' ' + mri
 
+        subject_id = subject
         if analysis_name is not None:
             if not isinstance(analysis_name, string_types):
                 raise ValueError('Analysis name suffix must be a string.')
@@ -276,7 +281,8 @@ class SimNIBS(ClusterBatch):
         if link_to_fs_dir is not None:
             cmd += [link_cmd]
 
-        self.add_job(cmd, job_name='mri2mesh', **job_options)
+        self.add_job(cmd, job_name='mri2mesh', subject=subject_id,
+                     **job_options)
 
     def create_bem_surfaces(self, subject, n_vertices=5120,
                             analysis_name=None, make_coreg_head=True,
@@ -447,7 +453,8 @@ class SimNIBS(ClusterBatch):
                                      head_fname=head_fname)
 
         # One job per subject, since these are "cheap" operations
-        self.add_job(cmd, job_name='cr_bem_simnibs', **job_options)
+        self.add_job(cmd, job_name='cr_bem_simnibs', subject=subject,
+                     **job_options)
 
     def _mri2mesh_outputs(self, subject, analysis_name):
         if analysis_name is not None:
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from stormdb.process import (read_head_pos, summarize_head_pos,
+                             summarize_head_positions)
+from nose.tools import assert_equal, assert_true, assert_raises
+
+
+pos_text = """ Time       q1       q2       q3       q4       q5       q6       g-value  error    velocity
+    0.000  0.00000  0.00000  0.00000  0.00100  0.00200  0.04000  0.99000  0.00100  0.00000
+    1.000  0.00000  0.00000  0.08716  0.00100  0.00200  0.04300  0.98000  0.00200  0.00300
+    2.000  0.00000  0.00000  0.00000  0.00100  0.00600  0.04300  0.97000  0.00150  0.00400
+"""  # noqa
+
+
+def test_head_pos():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pos_fname = os.path.join(tmp_dir, 'rest_raw.pos')
+        with open(pos_fname, 'w') as fid:
+            fid.write(pos_text)
+        pos = read_head_pos(pos_fname)
+        assert_equal(pos.shape, (3, 10))
+        npy_fname = os.path.join(tmp_dir, 'rest_raw.npy')
+        assert_true(os.path.exists(npy_fname))  # converted once
+        np.testing.assert_array_equal(read_head_pos(pos_fname), pos)
+
+        summary = summarize_head_pos(pos)
+        assert_equal(summary['n_times'], 3)
+        assert_equal(summary['duration'], 2.)
+        np.testing.assert_allclose(summary['max_displacement'], 5.)
+        np.testing.assert_allclose(summary['path_length'], 7.)
+        np.testing.assert_allclose(summary['max_rotation'], 10., rtol=1e-3)
+        np.testing.assert_allclose(summary['max_velocity'], 4.)
+        np.testing.assert_allclose(summary['max_error'], 2.)
+        assert_raises(ValueError, summarize_head_pos, pos[:, :9])
+
+        summaries = summarize_head_positions([pos_fname, npy_fname], n_jobs=1)
+        assert_equal([s['fname'] for s in summaries], [pos_fname, npy_fname])
+        assert_equal(summaries[0]['path_length'], summaries[1]['path_length'])
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,179 @@
+import os
+import ast
+import shutil
+import tempfile
+import numpy as np
+import mne
+from stormdb.process import Maxfilter
+from stormdb.process.maxfilter import (_maxwell_filter_cmd, _acquisition_key,
+                                       _RecordingCache, _chunk_times,
+                                       _stitch_cmd)
+from nose.tools import assert_equal, assert_true, assert_false
+
+
+proj_name = 'MEG_EEG-Training'
+
+
+def _calls(cmd, func_name):
+    """Compile the script of a 'python -c' command, return the keyword
+    arguments of each call of a function (or method) in it, in order"""
+    assert_true(cmd.startswith('python -c "') and cmd.endswith('"'))
+    script = cmd[len('python -c "'):-1]
+    assert_false('"' in script)  # would end the shell string
+    tree = ast.parse(script)
+    compile(tree, '<cmd>', 'exec')
+    calls = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        name = getattr(node.func, 'id', getattr(node.func, 'attr', None))
+        if name == func_name:
+            calls.append((node.col_offset, dict(
+                (kw.arg, kw.value.id if isinstance(kw.value, ast.Name)
+                 else ast.literal_eval(kw.value)) for kw in node.keywords)))
+    return [kwargs for _, kwargs in sorted(calls, key=lambda c: c[0])]
+
+
+def test_maxwell_filter_cmd():
+    cmd = _maxwell_filter_cmd(
+        'rest_raw.fif', 'rest_tsss.fif', origin='0 0 40', frame='head',
+        bad=['0113', 'MEG2443'], skip=None, force=False, st=False,
+        st_buflen=16., st_corr=0.96, trans=None, movecomp=False,
+        cal='sss_cal.dat', ctc='ct_sparse.fif')
+    kwargs, = _calls(cmd, 'maxwell_filter')
+    assert_equal(kwargs['origin'], (0., 0., 0.04))
+    assert_equal(kwargs['coord_frame'], 'head')
+    assert_equal((kwargs['calibration'], kwargs['cross_talk']),
+                 ('sss_cal.dat', 'ct_sparse.fif'))
+    assert_false('st_duration' in kwargs or 'destination' in kwargs or
+                 'head_pos' in kwargs)
+    assert_equal(_calls(cmd, 'save'), [dict(overwrite=False)])
+    assert_true("['MEG0113', 'MEG2443']" in cmd)
+
+    # MaxFilter's device frame, tSSS, movement compensation, and a chunk
+    cmd = _maxwell_filter_cmd(
+        'rest_raw.fif', 'rest_tsss.fif', origin='0 0 40', frame='device',
+        bad=[], skip='0 10', force=True, st=True, st_buflen=10.,
+        st_corr=0.98, trans='default', movecomp=True, cal=None, ctc=None,
+        chunk=(50., 120., 60., 110.))
+    kwargs, = _calls(cmd, 'maxwell_filter')
+    assert_equal(kwargs['coord_frame'], 'meg')
+    assert_equal((kwargs['st_duration'], kwargs['st_correlation']),
+                 (10., 0.98))
+    assert_equal(kwargs['destination'], (0., 0., 0.04))
+    assert_equal(kwargs['head_pos'], 'head_pos')
+    assert_equal(_calls(cmd, 'compute_head_pos'), [dict()])
+    assert_equal(_calls(cmd, 'crop'), [dict(), dict(include_tmax=False)])
+    assert_true('raw.crop(50.0, 120.0)' in cmd)
+    assert_true('raw_sss.crop(60.0, 110.0, include_tmax=False)' in cmd)
+    assert_equal(_calls(cmd, 'save'), [dict(overwrite=True)])
+
+
+def test_acquisition_key():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        names = ['rest_raw.fif', 'rest_raw-1.fif', 'rest_raw-2.fif',
+                 'run-1.fif', 'run-2.fif', 'sub-01.fif', 'sub-02.fif']
+        fnames = [os.path.join(tmp_dir, name) for name in names]
+        for fname in fnames:
+            open(fname, 'w').close()
+        # only the parts of a split recording share the key
+        assert_equal([_acquisition_key(fname) for fname in fnames],
+                     fnames[:1] * 3 + fnames[3:])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_recording_cache():
+    tmp_dir = tempfile.mkdtemp()
+    cache_dir = os.environ.get('STORMDB_CACHE_DIR')
+    os.environ['STORMDB_CACHE_DIR'] = tmp_dir
+    try:
+        fname = os.path.join(tmp_dir, 'rest_raw.fif')
+        with open(fname, 'w') as fid:
+            fid.write('data')
+        cache = _RecordingCache('origins.json')
+        assert_true(cache.get(fname) is None)
+        cache.set(fname, [90., [0., 0., 40.]], params=dict(limit=5))
+        cache.save()
+        cache = _RecordingCache('origins.json')  # as stored
+        assert_equal(cache.get(fname, params=dict(limit=5)),
+                     [90., [0., 0., 40.]])
+        assert_true(cache.get(fname) is None)  # other parameters
+        with open(fname, 'a') as fid:
+            fid.write('changed')
+        assert_true(cache.get(fname, params=dict(limit=5)) is None)
+        with open(cache.fname, 'w') as fid:
+            fid.write('{"partially written')
+        assert_equal(_RecordingCache('origins.json')._results, dict())
+    finally:
+        if cache_dir is None:
+            del os.environ['STORMDB_CACHE_DIR']
+        else:
+            os.environ['STORMDB_CACHE_DIR'] = cache_dir
+        shutil.rmtree(tmp_dir)
+
+
+def _check_chunks(chunks):
+    """The parts of the chunks that are kept make up the whole recording"""
+    end = 0.
+    for tmin, tmax, start, stop in chunks:
+        assert_equal(tmin + start, end)
+        assert_true(tmax is None or tmin + stop <= tmax)
+        end = None if stop is None else tmin + stop
+    assert_true(end is None)
+
+
+def test_chunk_times():
+    # the last, partial chunk gets the rest of the recording
+    chunks = _chunk_times(250., 100., 0.)
+    assert_equal(chunks, [(0., 100., 0., 100.), (100., None, 0., None)])
+    _check_chunks(chunks)
+    # the overlaps are filtered, and cut off again
+    chunks = _chunk_times(250., 100., 10.)
+    assert_equal(chunks, [(0., 110., 0., 100.), (90., None, 10., None)])
+    _check_chunks(chunks)
+    # whole tSSS buffers: chunks of 6 x 16 s, overlapping by one buffer
+    chunks = _chunk_times(400., 100., 10., st_buflen=16.)
+    assert_equal(chunks, [(0., 112., 0., 96.), (80., 208., 16., 112.),
+                          (176., 304., 16., 112.), (272., None, 16., None)])
+    _check_chunks(chunks)
+    # shorter than a chunk
+    assert_equal(_chunk_times(50., 100., 10.), [(0., None, 0., None)])
+    assert_equal(_chunk_times(50., 100., 10., st_buflen=16.),
+                 [(0., None, 0., None)])
+
+
+def test_stitch_cmd():
+    chunk_fnames = ['rest_tsss_chunk000.fif', 'rest_tsss_chunk001.fif']
+    cmd = _stitch_cmd(chunk_fnames, 'rest_tsss.fif', force=True)
+    assert_equal(_calls(cmd, 'save'), [dict(overwrite=True)])
+    assert_equal(len(_calls(cmd, 'concatenate_raws')), 1)
+    assert_true(repr(chunk_fnames) in cmd)
+
+
+def test_build_chunked():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        in_fname = os.path.join(tmp_dir, 'rest_raw.fif')
+        info = mne.create_info(['MEG0113'], 10., 'mag')
+        mne.io.RawArray(np.zeros((1, 4000)), info).save(in_fname)
+        out_fname = os.path.join(tmp_dir, 'rest_tsss.fif')
+        mf = Maxfilter(proj_name, log_dir=tmp_dir, cluster='local')
+        mf.build_cmd(in_fname, out_fname, engine='mne', st=True,
+                     st_buflen=16., chunk_duration=100.,
+                     logfile=os.path.join(tmp_dir, 'rest_tsss.log'))
+        chunk_jobs, stitch = mf._joblist[:-1], mf._joblist[-1]
+        assert_equal(len(chunk_jobs), 4)
+        # the stitch job runs once all chunks are filtered
+        assert_equal(stitch.depends_on, chunk_jobs)
+        assert_equal([job.n_threads for job in mf._joblist], [1] * 5)
+        chunk_fnames = [os.path.join(tmp_dir, 'rest_tsss_chunk{0:03d}'
+                                     '.fif'.format(ii)) for ii in range(4)]
+        for job, fname in zip(chunk_jobs, chunk_fnames):
+            assert_equal(_calls(job.cmd, 'save'), [dict(overwrite=True)])
+            assert_true(repr(fname) in job.cmd)
+        assert_true(repr(chunk_fnames) in stitch.cmd)
+        assert_equal(mf.info['io_mapping'][-1]['output'], out_fname)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+from stormdb.process import parse_maxfilter_log, summarize_maxfilter_logs
+from nose.tools import assert_equal, assert_true
+
+
+log_text = """Static bad channels (2): 0113 2443
+Detected bad channels: MEG 1722
+    4 out of 80 inner SSS components were rejected (subspace correlation)
+    Time 10.000 ... 20.000 s: 6 intersecting subspace components
+#t = 0.000, #e = 0.165 cm, #g = 0.997, #v = 0.211 cm/s
+#t = 1.000, #e = 0.300 cm, #g = 0.981, #v = 0.101 cm/s
+Warning: 1 HPI coil not fitted
+Warning: 1 HPI coil not fitted
+Total processing time 123.5 s
+"""
+
+
+def test_parse_maxfilter_log():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        log_fname = os.path.join(tmp_dir, 'rest_tsss.log')
+        with open(log_fname, 'w') as fid:
+            fid.write(log_text)
+        stats = parse_maxfilter_log(log_fname)
+        assert_equal(stats['bad'], ['MEG0113', 'MEG1722', 'MEG2443'])
+        assert_equal(stats['tsss_buffers'], 2)
+        assert_equal(stats['tsss_rejected'], 10)
+        assert_equal(stats['tsss_max_rejected'], 6)
+        assert_true(abs(stats['hpi_max_error'] - 3.) < 1e-9)
+        assert_equal(stats['hpi_min_gof'], 0.981)
+        assert_equal(stats['warnings'], ['Warning: 1 HPI coil not fitted'])
+        assert_equal(stats['runtime'], 123.5)
+
+        empty_fname = os.path.join(tmp_dir, 'empty.log')
+        open(empty_fname, 'w').close()
+        table_fname = os.path.join(tmp_dir, 'qa.tsv')
+        table = summarize_maxfilter_logs(
+            [log_fname, empty_fname, os.path.join(tmp_dir, 'missing.log')],
+            n_jobs=2, out_fname=table_fname)
+        assert_equal([stats['fname'] for stats in table],
+                     [log_fname, empty_fname])
+        assert_equal(table[1]['tsss_rejected'], None)
+        with open(table_fname, 'r') as fid:
+            lines = fid.read().splitlines()
+        assert_equal(len(lines), 3)
+        assert_equal(lines[1].split('\t')[1], 'MEG0113 MEG1722 MEG2443')
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+from stormdb.process import MNEPython
+from nose.tools import assert_equal, assert_raises, assert_true
+
+
+proj_name = 'MEG_EEG-Training'
+
+
+def test_raw_pipeline():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fnames = [os.path.join(tmp_dir, name) for name in
+                  ('rest_raw.fif', 'rest-ica.fif', 'rest-eve.fif')]
+        for fname in fnames:
+            open(fname, 'w').close()
+        in_fname, ica_fname, events_fname = fnames
+        out_fname = os.path.join(tmp_dir, 'rest-epo.fif')
+        mp = MNEPython(proj_name, log_dir=tmp_dir, cluster='local')
+        steps = [('filter', dict(l_freq=1., h_freq=40., n_jobs=2)),
+                 ('resample', dict(sfreq=250.)),
+                 ('apply_ica', dict(fname=ica_fname, exclude=[0, 3])),
+                 ('epochs', dict(event_id=dict(visual=1), tmin=-0.2,
+                                 tmax=0.5, events_fname=events_fname))]
+        mp.raw_pipeline(in_fname, out_fname, steps, n_threads=2)
+        job, = mp._joblist
+        # a single job, running the steps in order in a worker
+        assert_equal(job._worker_task, dict(
+            task='raw_pipeline',
+            kwargs=dict(in_fname=in_fname, out_fname=out_fname,
+                        steps=[list(step) for step in steps])))
+        assert_true(job.cmd.startswith(
+            'python -m stormdb.process.mne_worker --task '))
+        assert_equal(job.inputs, fnames)
+        assert_equal(job.outputs, [out_fname])
+        assert_equal(job.n_threads, 2)
+
+        # steps are checked before a job is added
+        for bad_steps in ([('apply_ica', dict(exclude=[0]))],
+                          [('filter', dict(l_freq=1.))],
+                          [('epochs', dict()), ('resample', dict(sfreq=1.))],
+                          [('crop', dict(tmax=10.))]):
+            assert_raises(ValueError, mp.raw_pipeline, in_fname, out_fname,
+                          bad_steps)
+        assert_raises(IOError, mp.raw_pipeline, in_fname, out_fname,
+                      [('apply_ica', dict(fname=ica_fname + '.missing'))])
+        assert_equal(len(mp._joblist), 1)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,51 @@
+import os
+import json
+import shutil
+import tempfile
+from stormdb.process import mne_worker
+from nose.tools import assert_equal, assert_true
+
+
+def _touch(fname):
+    if os.path.exists(fname):
+        raise IOError('{0} exists'.format(fname))
+    open(fname, 'w').close()
+
+
+def _write_spec(tmp_dir, n_workers, fnames):
+    tasks = [dict(task='touch', kwargs=dict(fname=fname),
+                  working_dir=tmp_dir,
+                  log=os.path.join(tmp_dir, 'task_{0}.log'.format(ii)))
+             for ii, fname in enumerate(fnames)]
+    spec = dict(n_workers=n_workers, tasks=tasks,
+                results=os.path.join(tmp_dir, 'results.json'))
+    spec_fname = os.path.join(tmp_dir, 'spec.json')
+    with open(spec_fname, 'w') as fid:
+        json.dump(spec, fid)
+    return spec_fname, spec
+
+
+def test_run_spec():
+    tmp_dir = tempfile.mkdtemp()
+    mne_worker.TASKS['touch'] = _touch
+    try:
+        # the second one fails
+        spec_fname, spec = _write_spec(tmp_dir, 1, ['out.txt'] * 2)
+        results = mne_worker.run_spec(spec_fname)
+        assert_equal([res['exit_status'] for res in results], [0, 1])
+        assert_true(os.path.exists(os.path.join(tmp_dir, 'out.txt')))
+        with open(spec['results']) as fid:
+            assert_equal(json.load(fid), results)
+        with open(spec['tasks'][1]['log']) as fid:
+            assert_true('out.txt exists' in fid.read())
+
+        # several workers, the results are in the order of the tasks
+        fnames = ['out_{0}.txt'.format(ii) for ii in range(4)]
+        spec_fname, spec = _write_spec(tmp_dir, 2, fnames + ['out.txt'])
+        results = mne_worker.run_spec(spec_fname)
+        assert_equal([res['exit_status'] for res in results], [0] * 4 + [1])
+        for fname in fnames:
+            assert_true(os.path.exists(os.path.join(tmp_dir, fname)))
+    finally:
+        del mne_worker.TASKS['touch']
+        shutil.rmtree(tmp_dir)
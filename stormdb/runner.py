@@ -0,0 +1,71 @@
+"""
+=========================
+Run a pack of shell commands concurrently inside a single cluster job
+=========================
+
+Usage: python -m stormdb.runner <spec.json>
+
+The spec-file is written by `ClusterBatch.pack`. It defines the commands
+('tasks') to run, the number of commands to run concurrently ('n_workers')
+and the file to write the results to ('results'). Each command gets its own
+log file, and its exit status and resource use are stored in the results.
+The runner exits with status 1 if any of the commands failed.
+"""
+# Author: Chris Bailey <cjb@cfin.au.dk>
+#
+# License: MIT
+import os
+import sys
+import json
+import time
+import subprocess as subp
+from concurrent.futures import ThreadPoolExecutor
+
+from .base import _exit_status
+
+
+def run_task(task):
+    """Run a single command, return its exit status and resource use"""
+    env = dict(os.environ)
+    env['NSLOTS'] = env['OMP_NUM_THREADS'] = str(task.get('n_threads', 1))
+    start = time.time()
+    with open(task['log'], 'w') as log:
+        log.write('Executing following command on {0} threads:\n{1}\n'.format(
+            env['NSLOTS'], task['cmd']))
+        log.flush()
+        proc = subp.Popen(['bash', '-c', task['cmd']],
+                          cwd=task.get('working_dir'), env=env, stdout=log,
+                          stderr=subp.STDOUT)
+        _, wait_status, usage = os.wait4(proc.pid, 0)
+    return dict(exit_status=_exit_status(wait_status),
+                wallclock=time.time() - start,
+                cpu=usage.ru_utime + usage.ru_stime,
+                maxvmem=usage.ru_maxrss * 1024.)  # kilobytes on Linux
+
+
+def run_spec(spec_fname):
+    """Run all commands in a spec-file, return the list of results"""
+    with open(spec_fname, 'r') as fid:
+        spec = json.load(fid)
+    with ThreadPoolExecutor(max_workers=spec['n_workers']) as executor:
+        results = list(executor.map(run_task, spec['tasks']))
+
+    tmp_fname = spec['results'] + '.tmp'
+    with open(tmp_fname, 'w') as fid:
+        json.dump(results, fid)
+    os.rename(tmp_fname, spec['results'])
+    return results
+
+
+def main(argv):
+    if len(argv) != 2:
+        print(__doc__)
+        return 2
+    results = run_spec(argv[1])
+    n_failed = len([res for res in results if res['exit_status'] != 0])
+    print('{:d} commands run, {:d} failed.'.format(len(results), n_failed))
+    return 1 if n_failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
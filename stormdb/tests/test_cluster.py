@@ -1,5 +1,17 @@
-from stormdb.cluster import Cluster, ClusterJob, ClusterBatch
-from nose.tools import assert_true, assert_equal, assert_raises
+import os
+import json
+import asyncio
+import stat
+import shutil
+import time
+import tempfile
+from stormdb.cluster import (Cluster, ClusterJob, ClusterBatch, LocalCluster,
+                             SlurmCluster, RetryPolicy, get_cluster,
+                             _parse_qacct, _parse_qstat_xml, _parse_qconf,
+                             _parse_qstat_summary, _SHARED_POLLERS)
+from stormdb.history import JobHistory
+from stormdb.runner import run_spec
+from nose.tools import assert_true, assert_false, assert_equal, assert_raises
 
 
 test_cmd = 'sleep 5'
@@ -8,6 +20,21 @@ test_subject_name = '0002_M55'
 test_queue = 'short.q'
 highmem_queue = 'highmem.q'
 working_dir = '/tmp'  # assume this is always present
+_environ = dict()
+
+
+def setup_module():
+    # keep the job history (etc.) of the test jobs out of the user's cache
+    _environ['STORMDB_CACHE_DIR'] = os.environ.get('STORMDB_CACHE_DIR')
+    os.environ['STORMDB_CACHE_DIR'] = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(os.environ['STORMDB_CACHE_DIR'], ignore_errors=True)
+    if _environ['STORMDB_CACHE_DIR'] is None:
+        del os.environ['STORMDB_CACHE_DIR']
+    else:
+        os.environ['STORMDB_CACHE_DIR'] = _environ['STORMDB_CACHE_DIR']
 
 
 def test_job_exceptions():
@@ -32,3 +59,439 @@ def test_job_working_dir():
     assert_true('$ -wd {:s}\n'.format(working_dir) in job._qsub_script)
 
     job.submit()
+
+
+def test_local_cluster():
+    assert_true(isinstance(get_cluster('local'), LocalCluster))
+    assert_raises(ValueError, get_cluster, 'nonexistent-backend')
+    batch = ClusterBatch(proj_name, cluster=LocalCluster(n_slots=2))
+    batch.add_job('echo single', working_dir=working_dir)
+    batch.add_job('echo double', n_threads=2, queue='maxfilter.q',
+                  working_dir=working_dir)
+    batch.add_job('exit 3', working_dir=working_dir)
+    batch.add_job('echo never', working_dir=working_dir,
+                  depends_on=batch._joblist[-1])
+    assert_equal(batch.submit(), [])
+    assert_true(batch.wait(timeout=30, poll_interval=0.1))
+    assert_equal([job.exit_status for job in batch._joblist],
+                 [0, 0, 3, None])
+    assert_equal([job._failed() for job in batch._joblist],
+                 [False, False, True, True])
+    assert_equal(batch._joblist[-1].status, 'Dependency failed')
+    batch.add_job('sleep 10', working_dir=working_dir)
+    n_submitted = batch.cluster._counter
+    batch.submit()  # only the new job
+    assert_equal(batch.cluster._counter, n_submitted + 1)
+    assert_false(batch.wait(timeout=0.5, poll_interval=0.1))
+    batch.kill()
+    batch.cluster.shutdown()
+
+
+def test_retry_policy():
+    assert_raises(ValueError, RetryPolicy, max_attempts=0)
+    flag = tempfile.mktemp(dir=working_dir)
+    batch = ClusterBatch(proj_name, cluster=LocalCluster(n_slots=4))
+    # fails on the first attempt only
+    batch.add_job('test -e {0} || {{ touch {0}; exit 2; }}'.format(flag),
+                  working_dir=working_dir)
+    batch.add_job('echo MemoryError; exit 1', working_dir=working_dir)
+    # held until the jobs they depend on have succeeded (after retries)
+    for dep in batch._joblist[:2]:
+        batch.add_job('test -e {0}'.format(flag), working_dir=working_dir,
+                      depends_on=dep)
+    batch.submit(retry=RetryPolicy(max_attempts=3, backoff=0.1))
+    assert_false(batch._joblist[2]._submitted)
+    assert_true(batch.wait(timeout=30, poll_interval=0.1))
+    flaky, oom, after_flaky, after_oom = batch._joblist
+    assert_equal(after_flaky.exit_status, 0)
+    assert_equal((after_oom.exit_status, after_oom.status),
+                 (None, 'Dependency failed'))
+    assert_equal(flaky.exit_status, 0)
+    assert_equal(len(flaky.attempts), 1)
+    assert_equal(flaky.n_threads, 1)
+    assert_equal(oom.exit_status, 1)
+    assert_equal(len(oom.attempts), 2)
+    assert_equal(oom.n_threads, 4)  # memory doubled on each attempt
+    batch.cluster.shutdown()
+    os.unlink(flag)
+
+
+def test_async_watch():
+    cluster = LocalCluster(n_slots=2)
+
+    async def _run_batch(exit_status):
+        batch = ClusterBatch(proj_name, cluster=cluster)
+        batch.add_job('exit {:d}'.format(exit_status), working_dir=working_dir)
+        batch.add_job('sleep 0.5', working_dir=working_dir)
+        assert_equal(await batch.submit_async(), [])
+        return [job.exit_status async for job in
+                batch.watch(timeout=30, poll_interval=0.1)]
+
+    async def _run_batches():
+        return await asyncio.gather(_run_batch(0), _run_batch(2))
+
+    # batches watched concurrently, in order of completion
+    assert_equal(asyncio.run(_run_batches()), [[0, 0], [2, 0]])
+
+    # a job resubmitted once nothing else is watched is still polled
+    flag = tempfile.mktemp(dir=working_dir)
+
+    async def _run_flaky():
+        batch = ClusterBatch(proj_name, cluster=cluster)
+        batch.add_job('test -e {0} || {{ touch {0}; exit 2; }}'.format(flag),
+                      working_dir=working_dir)
+        batch.add_job('test -e {0}'.format(flag), working_dir=working_dir,
+                      depends_on=batch._joblist[0])
+        await batch.submit_async(retry=RetryPolicy(max_attempts=2,
+                                                   backoff=0.2))
+        return [job.exit_status async for job in
+                batch.watch(timeout=30, poll_interval=0.1)]
+
+    assert_equal(asyncio.run(_run_flaky()), [0, 0])
+
+    async def _run_incremental():
+        batch = ClusterBatch(proj_name, cluster=cluster)
+        batch.add_job('touch ' + flag, working_dir=working_dir,
+                      outputs=[flag])
+        assert_equal(await batch.submit_async(incremental=True), [])
+        return batch._joblist[0]._skipped
+
+    assert_true(asyncio.run(_run_incremental()))  # flag is up to date
+    assert_equal(len(_SHARED_POLLERS), 0)
+    cluster.shutdown()
+    os.unlink(flag)
+
+
+SLURM_STUBS = dict(
+    sbatch='echo "4242;cluster"',
+    squeue=('echo "4242 R general node07"; echo "4243 PD general";'
+            'echo "4244_1 R general node08"'),
+    sinfo=('case "$*" in *"%m %c") echo "64000 16"; echo "32000 16";; '
+           '*"%P %C") echo "general* 10/20/2/32";; '
+           '*) echo "general*"; echo "highmem";; esac'),
+    scancel='exit 0',
+    sacct=('echo "4242|COMPLETED|0:0|61|01:02.500||general|node07";'
+           'echo "4242.batch|COMPLETED|0:0|61|01:02.500|1.5G||node07";'
+           'echo "4243|FAILED|2:0|5|00:01||general|node07";'
+           'echo "4244_1|CANCELLED by 1000|0:15|3|00:00||general|node08";'
+           'echo "4245|RUNNING|0:0|3|00:00||general|node08";'
+           'echo "4246|CANCELLED|0:0|0|00:00||general|None assigned"'))
+
+
+def _make_stub_executables(stubs):
+    """Create stub executables in a temporary dir, and prepend it to PATH"""
+    stub_dir = tempfile.mkdtemp()
+    for name, body in stubs.items():
+        fname = os.path.join(stub_dir, name)
+        with open(fname, 'w') as fid:
+            fid.write('#!/bin/bash\n{0}\n'.format(body))
+        os.chmod(fname, os.stat(fname).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+    return stub_dir
+
+
+def _remove_stub_executables(stub_dir):
+    """Remove the stub executables, and their dir from PATH"""
+    os.environ['PATH'] = os.pathsep.join(
+        path for path in os.environ['PATH'].split(os.pathsep)
+        if path != stub_dir)
+    shutil.rmtree(stub_dir, ignore_errors=True)
+
+
+def test_slurm_cluster():
+    stub_dirs = [_make_stub_executables(dict(SLURM_STUBS, sbatch=(
+        'echo "$*" > "$(dirname "$0")/sbatch.args"; echo "4242;cluster"')))]
+    try:
+        cluster = SlurmCluster(queue_map={'short.q': 'general'})
+        assert_equal(cluster.partitions, ['general', 'highmem'])
+        assert_true('short.q' in cluster.queues)
+        cluster._check_queue('short.q')
+        assert_raises(ValueError, cluster._check_queue, 'long.q')
+        assert_equal(cluster.get_memlimit_per_process('short.q'), '2000M')
+        load = cluster.get_load_dict()[0]
+        assert_equal((load['name'], load['used'], load['avail']),
+                     ('general', '10', '20'))
+        assert_equal(cluster._submit('job.sh', None, dependencies=['1']),
+                     '4242')
+        with open(os.path.join(stub_dirs[0], 'sbatch.args')) as fid:
+            assert_equal(fid.read().split(), [
+                '--parsable', '--dependency=afterok:1',
+                '--kill-on-invalid-dep=yes', 'job.sh'])
+        states = cluster._job_states(['4242', '4243', '4244_1', '99'])
+        assert_equal(states, {'4242': ('r', 'general@node07'),
+                              '4243': ('qw', ''),
+                              '4244_1': ('r', 'general@node08')})
+        records = cluster._accounting(['4242', '4243', '4244_1', '4245'])
+        assert_equal(sorted(records.keys()), ['4242', '4243', '4244_1'])
+        assert_equal([records[jobid]['exit_status'] for jobid in
+                      ('4242', '4243', '4244_1')], [0, 2, 143])
+        assert_equal(records['4242']['wallclock'], 61.)
+        assert_equal(records['4242']['cpu'], 62.5)
+        assert_equal(records['4242']['maxvmem'], 1.5 * 1024 ** 3)
+        # cancelled as its dependency failed
+        record = cluster._accounting(['4246'])['4246']
+        assert_equal((record['exit_status'], record['error']),
+                     (None, 'Cancelled before it ran'))
+        cluster._kill(['4242'])
+        # the partitions and their memory limits are only queried once
+        stub_dirs.append(_make_stub_executables(dict(sinfo='exit 1')))
+        cluster._check_queue('short.q')
+        assert_equal(cluster.get_memlimit_per_process('short.q'), '2000M')
+    finally:
+        for stub_dir in stub_dirs:
+            _remove_stub_executables(stub_dir)
+
+
+def test_select_queues():
+    stubs = dict(SLURM_STUBS, sinfo=(
+        'case "$*" in *"%m %c") echo "64000 16";; '
+        '*"%P %C") echo "general* 1/3/0/4"; echo "highmem 7/1/0/8";; '
+        '*) echo "general*"; echo "highmem";; esac'))
+    stub_dir = _make_stub_executables(stubs)
+    try:
+        cluster = SlurmCluster(queue_map={'short.q': 'general'})
+        # fill the free slots first, then balance the waiting slots per slot
+        assert_equal(cluster._select_queues([(1, None)] * 5,
+                                            ['short.q', 'highmem']),
+                     ['short.q', 'short.q', 'short.q', 'highmem', 'highmem'])
+        assert_equal(cluster._select_queues([(6, None)],
+                                            ['short.q', 'highmem']),
+                     ['highmem'])  # too large for short.q
+        assert_raises(ValueError, cluster._select_queues, [(32, None)],
+                      ['short.q', 'highmem'])
+    finally:
+        _remove_stub_executables(stub_dir)
+
+
+def test_plan():
+    stubs = dict(SLURM_STUBS, sinfo=(
+        'case "$*" in *"%m %c") echo "64000 16";; '
+        '*"%P %C") echo "general* 1/3/0/4";; '
+        '*) echo "general*"; echo "highmem";; esac'))
+    stub_dir = _make_stub_executables(stubs)
+    out_dir = tempfile.mkdtemp()
+    try:
+        history = JobHistory(os.path.join(out_dir, 'history.jsonl'))
+        for _ in range(5):
+            history.record('plan', dict(exit_status=0, wallclock=3600., cpu=1.,
+                                        maxvmem=1e9), 1, 8e9, cluster='slurm')
+        batch = ClusterBatch(proj_name, cluster=SlurmCluster(
+            queue_map={'short.q': 'general'}))
+        for ii in range(6):
+            batch.add_job('echo {:d}'.format(ii), job_name='plan',
+                          working_dir=out_dir)
+        done = os.path.join(out_dir, 'done.txt')
+        open(done, 'w').close()
+        batch.add_job('touch ' + done, job_name='unknown', working_dir=out_dir,
+                      outputs=[done])
+        plan = batch.plan(incremental=True, history=history)
+        assert_equal(plan['skipped'], batch._joblist[-1:])
+        stats = plan['queues']['short.q']
+        assert_equal((stats['n_jobs'], stats['n_unknown']), (6, 0))
+        assert_equal(stats['slot_hours'], 6.)
+        # 3 jobs start now, 1 once the busy slot frees up, 2 after the first 3
+        assert_equal(plan['makespan'], 2.)
+        assert_false(batch._joblist[-1]._skipped)
+        plan = batch.plan(history=history)
+        assert_equal(plan['queues']['short.q']['n_unknown'], 1)
+    finally:
+        _remove_stub_executables(stub_dir)
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_bulk_kill():
+    out_dir = tempfile.mkdtemp()
+    killed_fname = os.path.join(out_dir, 'scancel.txt')
+    stub_dir = _make_stub_executables(dict(SLURM_STUBS, squeue=(
+        'echo "4242 R general node07"; echo "4243 PD general"; '
+        'echo "4244_0 R general node08"; echo "4244_1 PD general"'),
+        scancel='echo "$*" >> {0}'.format(killed_fname)))
+    try:
+        batch = ClusterBatch(proj_name, cluster=SlurmCluster(
+            queue_map={'short.q': 'general'}))
+        # 4245 has finished
+        for jobid, subject in (('4242', 'a'), ('4243', 'b'), ('4244_0', 'a'),
+                               ('4244_1', 'b'), ('4245', 'a')):
+            batch.add_job('echo ' + jobid, working_dir=out_dir,
+                          subject=subject)
+            batch._joblist[-1]._jobid = jobid
+            batch._joblist[-1]._submitted = True
+        assert_raises(ValueError, batch.kill, state='finished')
+        killed = batch.kill(state='waiting', subject='b')
+        assert_equal([job._jobid for job in killed], ['4243', '4244_1'])
+        assert_equal(batch.kill(job_name='no-such-job'), [])
+        # the remaining array task is killed by the ID of the array
+        assert_equal(len(batch.kill()), 2)
+        with open(killed_fname) as fid:
+            assert_equal(fid.read(), '4243 4244_1\n4244 4242\n')
+    finally:
+        _remove_stub_executables(stub_dir)
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_batch_journal():
+    stub_dir = _make_stub_executables(SLURM_STUBS)
+    log_dir = tempfile.mkdtemp()
+    try:
+        batch = ClusterBatch(proj_name, cluster=SlurmCluster(
+            queue_map={'short.q': 'general'}))
+        batch.add_job('echo journal', working_dir=log_dir, log_dir=log_dir)
+        assert_true(batch.journal is None)
+        batch.submit()
+        assert_equal(os.path.dirname(batch.journal), log_dir)
+        batch.kill()
+
+        loaded = ClusterBatch.load(batch.journal)
+        assert_true(isinstance(loaded.cluster, SlurmCluster))
+        assert_equal(loaded.cluster.queue_map, {'short.q': 'general'})
+        job = loaded._joblist[0]
+        assert_equal((job._jobid, job.cmd, job.queue), ('4242', 'echo journal',
+                                                        'short.q'))
+        assert_true(job._killed)
+        not_journal = os.path.join(log_dir, 'not_a_journal.jsonl')
+        with open(not_journal, 'w') as fid:
+            fid.write('{"event": "submit"}\n')
+        assert_raises(ValueError, ClusterBatch.load, not_journal)
+    finally:
+        _remove_stub_executables(stub_dir)
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+def test_submit_failures():
+    # the job printing "fail_me" cannot be submitted
+    stub_dir = _make_stub_executables(dict(
+        SLURM_STUBS, qsub='echo "Unable to run job"; exit 1',
+        sbatch=('if grep -q fail_me "${@: -1}"; then '
+                'echo "sbatch: error: invalid account"; exit 1; fi; '
+                'echo "4242;cluster"')))
+    log_dir = tempfile.mkdtemp()
+    try:
+        assert_raises(RuntimeError, Cluster()._submit, 'job.sh', None)
+        batch = ClusterBatch(proj_name, cluster=SlurmCluster(
+            queue_map={'short.q': 'general'}))
+        for cmd in ('echo 1', 'echo fail_me', 'echo 2', 'echo 3'):
+            batch.add_job(cmd, working_dir=log_dir, log_dir=log_dir)
+        failed = batch.submit(n_workers=3)
+        assert_equal([job.cmd for job, _ in failed], ['echo fail_me'])
+        assert_true('invalid account' in failed[0][1])
+        assert_equal([job._submitted for job in batch._joblist],
+                     [True, False, True, True])
+        batch.kill()
+    finally:
+        _remove_stub_executables(stub_dir)
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+QACCT_OUTPUT = """==============================================================
+qname        short.q
+hostname     node03.hyades
+jobname      maxfilter
+jobnumber    1001
+taskid       undefined
+failed       0
+exit_status  0
+ru_wallclock 3600s
+cpu          14000.250s
+maxvmem      2.500G
+==============================================================
+qname        highmem.q
+hostname     node12.hyades
+jobname      recon-all
+jobnumber    1002
+taskid       undefined
+failed       100  : assumedly after job
+exit_status  137                  (Killed)
+ru_wallclock 12
+cpu          11.5
+maxvmem      512.000M"""
+
+
+def test_parse_qacct():
+    records = _parse_qacct(QACCT_OUTPUT.split('\n'))
+    assert_equal(sorted(records.keys()), ['1001', '1002'])
+    assert_equal(records['1001']['exit_status'], 0)
+    assert_equal(records['1001']['wallclock'], 3600.)
+    assert_equal(records['1001']['cpu'], 14000.25)
+    assert_equal(records['1001']['maxvmem'], 2.5 * 1024 ** 3)
+    assert_equal(records['1001']['queue_host'], 'short.q@node03.hyades')
+    assert_equal(records['1002']['exit_status'], 137)
+    assert_equal(records['1002']['failed'], 100)
+    assert_equal(records['1002']['maxvmem'], 512 * 1024 ** 2)
+
+
+QSTAT_JOB = """  <job_list state="{state}">
+    <JB_job_number>{jobid:d}</JB_job_number>
+    <JAT_prio>0.55500</JAT_prio>
+    <JB_name>a rather long job name {jobid:d}</JB_name>
+    <JB_owner>user</JB_owner>
+    <state>{code}</state>
+    <queue_name>{queue}</queue_name>
+    <slots>4</slots>
+  </job_list>
+"""
+
+
+def _make_qstat_xml(n_running, n_pending):
+    """Synthetic output of qstat -xml"""
+    running = [QSTAT_JOB.format(state='running', jobid=ii, code='r',
+                                queue='short.q@node{:02d}.hyades'.format(
+                                    ii % 20))
+               for ii in range(n_running)]
+    pending = [QSTAT_JOB.format(state='pending', jobid=ii, code='qw',
+                                queue='')
+               for ii in range(n_running, n_running + n_pending)]
+    return ("<?xml version='1.0'?>\n<job_info>\n<queue_info>\n" +
+            ''.join(running) + '</queue_info>\n<job_info>\n' +
+            ''.join(pending) + '</job_info>\n</job_info>\n')
+
+
+def test_parse_qstat():
+    jobs = _parse_qstat_xml(_make_qstat_xml(1, 1))
+    assert_equal([(job.jobid, job.state, job.queue_host, job.slots)
+                   for job in jobs],
+                  [('0', 'r', 'short.q@node00.hyades', 4), ('1', 'qw', '', 4)])
+    assert_equal(jobs[0].name, 'a rather long job name 0')
+
+    # parsing large outputs must stay fast
+    output = _make_qstat_xml(5000, 5000)
+    start = time.time()
+    jobs = _parse_qstat_xml(output)
+    assert_equal(len(jobs), 10000)
+    assert_true(time.time() - start < 2.)
+
+    conf = _parse_qconf(['qname                 short.q',
+                         'pe_list               make smp \\',
+                         '                      threaded',
+                         'h_vmem                8G,[node01.hyades=16G]'])
+    assert_equal(conf['pe_list'], 'make smp threaded')
+    assert_equal(conf['h_vmem'], '8G,[node01.hyades=16G]')
+
+    loads = _parse_qstat_summary([
+        'CLUSTER QUEUE   CQLOAD   USED    RES  AVAIL  TOTAL aoACDS  cdsuE',
+        '-' * 66,
+        'highmem.q         0.50      8      0      8     16      0      0',
+        'short.q           0.10      4      0    100    104      0      0'])
+    assert_equal([(load.name, load.avail, load.total) for load in loads],
+                 [('highmem.q', 8, 16), ('short.q', 100, 104)])
+
+
+def test_runner():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        tasks = [dict(cmd='echo $NSLOTS; exit {0}'.format(ii), n_threads=2,
+                      working_dir=tmp_dir,
+                      log=os.path.join(tmp_dir, 'task_{0}.log'.format(ii)))
+                 for ii in range(3)]
+        spec = dict(n_workers=2, tasks=tasks,
+                    results=os.path.join(tmp_dir, 'results.json'))
+        spec_fname = os.path.join(tmp_dir, 'spec.json')
+        with open(spec_fname, 'w') as fid:
+            json.dump(spec, fid)
+        results = run_spec(spec_fname)
+        assert_equal([res['exit_status'] for res in results], [0, 1, 2])
+        with open(spec['results']) as fid:
+            assert_equal(json.load(fid), results)
+        with open(tasks[0]['log']) as fid:
+            assert_equal(fid.read().split('\n')[-2], '2')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
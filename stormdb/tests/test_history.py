@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+from stormdb.history import JobHistory
+from nose.tools import assert_true, assert_equal
+
+
+def _record(wallclock, cpu, maxvmem, exit_status=0):
+    return dict(exit_status=exit_status, wallclock=wallclock, cpu=cpu,
+                maxvmem=maxvmem)
+
+
+def test_job_history():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, 'history.jsonl')
+        history = JobHistory(fname, max_records=10)
+        assert_equal(history.suggest('maxfilter'), None)
+        for ii in range(12):
+            # jobs requesting 4 threads but using ~1.5, memory ~ input size
+            history.record('maxfilter', _record(100., 150., 2e9), 4, 8e9,
+                           input_size=1e9)
+        history.record('maxfilter', _record(5., 1., 1e8, exit_status=1), 4,
+                       8e9)
+        history.record('recon-all', _record(1e4, 1e4, 3e9), 1, 8e9)
+        assert_equal(len(history.get_records('maxfilter')), 10)
+        assert_equal(len(history.get_records('maxfilter',
+                                             successful=False)), 10)
+
+        usage = history.suggest('maxfilter', headroom=1.)
+        assert_equal(usage['n_threads'], 2)
+        assert_equal(usage['memory'], 2e9)
+        # memory and runtime are scaled by the input size
+        usage = history.suggest('maxfilter', input_size=2e9, headroom=1.)
+        assert_equal(usage['memory'], 4e9)
+        assert_equal(usage['wallclock'], 200.)
+        assert_equal(history.suggest('recon-all'), None)  # too few records
+
+        history.compact()
+        with open(fname) as fid:
+            assert_equal(len(fid.readlines()), 11)
+        assert_true(history.suggest('maxfilter') is not None)
+
+        # the peak memory of tasks in a shared worker may be unknown
+        for ii in range(5):
+            history.record('mne.raw.filter',
+                           _record(10., 10., 1e9 if ii == 0 else None), 1, 4e9)
+        assert_equal(history.suggest('mne.raw.filter', headroom=1.)['memory'],
+                     1e9)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+from stormdb.incremental import DigestStore, is_up_to_date
+from nose.tools import assert_true, assert_false, assert_equal
+
+
+def _write(fname, content, mtime):
+    with open(fname, 'w') as fid:
+        fid.write(content)
+    os.utime(fname, (mtime, mtime))
+
+
+def test_is_up_to_date():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        in_fname, out_fname = (os.path.join(tmp_dir, 'in.fif'),
+                               os.path.join(tmp_dir, 'out.fif'))
+        assert_false(is_up_to_date([in_fname], []))
+        _write(in_fname, 'raw', 1000)
+        assert_false(is_up_to_date([in_fname], [out_fname]))  # no output yet
+        _write(out_fname, 'filtered', 2000)
+        assert_true(is_up_to_date([in_fname], [out_fname]))
+        assert_true(is_up_to_date([], [out_fname]))
+        _write(in_fname, 'raw', 3000)  # touched
+        assert_false(is_up_to_date([in_fname], [out_fname]))
+
+        # with digests, touching (or copying) inputs does not matter
+        digests = DigestStore(os.path.join(tmp_dir, 'digests.json'))
+        _write(in_fname, 'raw', 1000)
+        assert_true(is_up_to_date([in_fname], [out_fname], digests=digests))
+        digests.save()
+        digests = DigestStore(digests.fname)
+        _write(in_fname, 'raw', 3000)
+        assert_true(is_up_to_date([in_fname], [out_fname], digests=digests))
+        # but changed contents do, even if the output is newer
+        _write(in_fname, 'new raw', 1000)
+        assert_false(is_up_to_date([in_fname], [out_fname], digests=digests))
+        assert_equal(len(digests.digest([in_fname])), 40)
+    finally:
+        shutil.rmtree(tmp_dir)